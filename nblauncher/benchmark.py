@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+=====================
+Throughput Benchmarks
+=====================
+
+:File:
+    benchmark.py
+"""
+
+
+__all__ = ["make_roster", "make_material", "fake_backend", "benchmark",
+        "main"]
+
+
+import logging
+import sys
+import os
+import shutil
+import socket
+import getpass
+import tempfile
+import time
+import json
+import argparse
+
+from contextlib import contextmanager
+
+import tornado.ioloop
+
+import nblauncher.genericutils as gutil
+import nblauncher.notebooks as nbl
+import nblauncher.fakeutils as fake
+
+from nblauncher.tracing import TRACER
+
+
+LOGGER = logging.getLogger()
+
+# in the order in which a course uses them
+PHASES = ["setup", "send", "launch", "shutdown", "retrieve", "remove"]
+# number of users in the default synthetic rosters
+SIZES = [10, 100, 1000, 5000]
+# the default synthetic material: number of files and their size in bytes
+MATERIAL_FILES = 20
+MATERIAL_FILE_SIZE = 1 << 12
+# files of the synthetic material are spread over this many directories
+MATERIAL_DIRS = 4
+CONFIG = u"""[Setup]
+user_list={root}/students.csv
+tutorial_dir=course
+material_dir={root}/material/notebooks
+password_length=12
+group=benchmark
+profile=benchmark
+delivery={delivery}
+state_dir={root}/state
+store_dir={root}/store
+readonly_assets=
+[Launch]
+cert_file={root}/cert.pem
+server_address=127.0.0.1
+web_title=Benchmark
+launch_dir=
+port={port:d}
+port_range=10000-65535
+ready_timeout=60
+on_demand=yes
+idle_timeout=0
+status_interval=10
+portal_workers=1
+proxy=no
+[Shutdown]
+storage_dir={root}/storage
+owner={owner}
+"""
+
+
+def make_roster(filename, size):
+    """
+    Writes a user database with synthetic users.
+
+    Parameters
+    ----------
+    filename: `str`
+        System path that specifies where the file should be written.
+    size: `int`
+        The number of users.
+    """
+    users = [{"name": u"Student", "surname": u"{0:05d}".format(i),
+            "username": u"bench{0:05d}".format(i),
+            "email": u"bench{0:05d}@example.org".format(i),
+            "sys-pass": u"", "nb-pass": u"", "port": u""}\
+            for i in range(size)]
+    gutil.write_database(filename, users)
+
+def make_material(root, files=MATERIAL_FILES, size=MATERIAL_FILE_SIZE):
+    """
+    Creates synthetic course material.
+
+    Parameters
+    ----------
+    root: `str`
+        The material directory.
+    files: `int` (optional)
+        The number of files.
+    size: `int` (optional)
+        The size of each file in bytes.
+    """
+    for i in range(files):
+        directory = os.path.join(root, u"part{0:d}".format(i % MATERIAL_DIRS))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, u"notebook{0:d}.ipynb".format(i)),
+                "wb") as file_handle:
+            file_handle.write(os.urandom(size))
+
+def free_port():
+    """
+    A TCP port that is currently not in use.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+@contextmanager
+def fake_backend(home_root, owner):
+    """
+    Lets the commands of `nblauncher.notebooks` manage accounts in memory.
+
+    The in-memory `fakeutils` replace the system specific utilities and the
+    passwd and group databases behind the account cache, every question is
+    answered with yes.
+
+    Parameters
+    ----------
+    home_root: `str`
+        Directory in which the home directories are created.
+    owner: `str`
+        The owner of retrieved files, an account that exists up front.
+    """
+    cache = gutil.ACCOUNT_CACHE
+    saved = (nbl.usrt, cache.passwd, cache.group)
+    (nbl.usrt, cache.passwd, cache.group) = (fake, fake, fake)
+    cache.clear()
+    fake.reset(home_root)
+    fake.add_user(owner)
+    nbl.raw_input = lambda prompt: "y"
+    try:
+        yield
+    finally:
+        (nbl.usrt, cache.passwd, cache.group) = saved
+        cache.clear()
+        del nbl.raw_input
+
+def run_phase(phase, config, users, executor):
+    """
+    Runs one command of `nblauncher.notebooks`.
+
+    The launch command starts no servers (on demand) and is stopped as soon
+    as the website is being served.
+    """
+    if phase == "launch":
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_callback(io_loop.stop)
+        try:
+            nbl.launch(config, users, executor)
+        finally:
+            # the next launch needs a new IOLoop
+            io_loop.close(all_fds=True)
+            tornado.ioloop.IOLoop.clear_current()
+            tornado.ioloop.IOLoop.clear_instance()
+    else:
+        getattr(nbl, phase)(config, users, executor)
+
+def benchmark(size, phases=PHASES, jobs=1, delivery=u"copy",
+        files=MATERIAL_FILES, file_size=MATERIAL_FILE_SIZE):
+    """
+    Runs the commands against a synthetic roster in a temporary directory.
+
+    Parameters
+    ----------
+    size: `int`
+        The number of users.
+    phases: `list` (optional)
+        The commands that are run in this order.
+    jobs: `int` (optional)
+        The number of users that are processed concurrently.
+    delivery: `str` (optional)
+        How the material is delivered.
+    files: `int` (optional)
+        The number of files of the synthetic material.
+    file_size: `int` (optional)
+        The size of each of those files in bytes.
+
+    Returns
+    -------
+    A list with one dictionary per phase of the number of users, the seconds
+    it took, the number of subprocesses forked, and the number of bytes copied.
+    """
+    root = tempfile.mkdtemp(prefix="nblauncher-benchmark-")
+    owner = getpass.getuser()
+    results = list()
+    try:
+        make_roster(os.path.join(root, "students.csv"), size)
+        make_material(os.path.join(root, "material", "notebooks"), files,
+                file_size)
+        open(os.path.join(root, "cert.pem"), "wb").close()
+        os.makedirs(os.path.join(root, "home"))
+        config_file = os.path.join(root, "notebooks.cfg")
+        with open(config_file, "wb") as file_handle:
+            file_handle.write(CONFIG.format(root=root, delivery=delivery,
+                    port=free_port(), owner=owner).encode("utf-8"))
+        config = gutil.parse_config(config_file)
+        (users, csv_dialect) = gutil.read_database(config["user list"])
+        executor = nbl.UserExecutor(jobs)
+        with fake_backend(os.path.join(root, "home"), owner):
+            for phase in phases:
+                if phase == "shutdown":
+                    # servers that are found in the process table
+                    for usr in users:
+                        fake.add_process(usr["username"],
+                                u"ipython notebook --port={0}".format(
+                                usr["port"]))
+                TRACER.reset()
+                start = time.time()
+                run_phase(phase, config, users, executor)
+                elapsed = time.time() - start
+                summary = TRACER.summary()
+                results.append({"phase": phase, "users": size,
+                        "seconds": elapsed, "forks": summary["forks"],
+                        "bytes": summary["bytes"]})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def report(results):
+    """
+    Prints a table of the throughput per phase.
+    """
+    print(u"{0:>7} {1:<10} {2:>10} {3:>10} {4:>8} {5:>12}".format(u"users",
+            u"phase", u"seconds", u"users/s", u"forks", u"bytes"))
+    for row in results:
+        rate = row["users"] / row["seconds"] if row["seconds"] > 0.0 else\
+                float("inf")
+        print(u"{0:>7d} {1:<10} {2:>10.3f} {3:>10.1f} {4:>8d} {5:>12d}".format(
+                row["users"], row["phase"], row["seconds"], rate, row["forks"],
+                row["bytes"]))
+
+def parse_arguments(argv):
+    """
+    Parses the command line arguments of the benchmark.
+
+    Parameters
+    ----------
+    argv: `list`
+        The command line arguments without the program name.
+    """
+    parser = argparse.ArgumentParser(prog="python -m nblauncher.benchmark",
+            description="throughput of the nblauncher commands with in-memory"\
+            " accounts, no superuser privileges are needed")
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES,
+            help="numbers of users in the synthetic rosters"\
+            " (default: %(default)s)")
+    parser.add_argument("-p", "--phases", nargs="+", type=str.lower,
+            choices=PHASES, default=PHASES,
+            help="commands that are run in this order (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="number of users that are processed concurrently"\
+            " (default: %(default)s)")
+    parser.add_argument("-d", "--delivery", default=u"copy",
+            choices=[u"copy", u"link", u"archive"],
+            help="how the material is delivered (default: %(default)s)")
+    parser.add_argument("-f", "--files", type=int, default=MATERIAL_FILES,
+            help="number of files of the material (default: %(default)s)")
+    parser.add_argument("-s", "--file-size", type=int,
+            default=MATERIAL_FILE_SIZE,
+            help="size of each file in bytes (default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help="also write the results to a JSON file")
+    return parser.parse_args(argv)
+
+def main(argv):
+    """
+    Runs the benchmark for every roster size and reports the results.
+    """
+    args = parse_arguments(argv)
+    if args.jobs < 1:
+        raise ValueError(u"the number of jobs must be positive")
+    # the website template is looked up in the working directory
+    if not os.path.exists("template.html"):
+        raise IOError(u"run the benchmark from the directory that contains"\
+                u" 'template.html'")
+    results = list()
+    for size in args.sizes:
+        results.extend(benchmark(size, args.phases, args.jobs, args.delivery,
+                args.files, args.file_size))
+    report(results)
+    if args.output:
+        with open(args.output, "wb") as file_handle:
+            json.dump(results, file_handle, indent=1)
+
+def main_command():
+    LOGGER.setLevel(logging.ERROR)
+    LOGGER.addHandler(logging.StreamHandler())
+    rec = 0
+    try:
+        main(sys.argv[1:])
+    except Exception as err:
+        rec = err.errno if hasattr(err, "errno") else 1
+        LOGGER.critical(str(err))
+    finally:
+        logging.shutdown()
+    sys.exit(rec)
+
+
+if __name__ == "__main__":
+    main_command()
+
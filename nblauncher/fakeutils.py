@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+=======================================
+Utility Functions for an In-Memory Fake
+=======================================
+
+:File:
+    fakeutils.py
+"""
+
+
+__all__ = ["add_user", "add_users", "add_group", "add_password",
+        "append_to_group", "append_all_to_group", "find_processes",
+        "kill_process", "kill_processes", "active_ports", "process_stats",
+        "delete_user", "delete_group", "getpwnam", "getpwall", "getgrnam",
+        "getgrall", "reset", "add_process"]
+
+
+import os
+import logging
+import shutil
+import threading
+
+from collections import namedtuple
+
+from .genericutils import KILL_TIMEOUT, ACCOUNT_CACHE, GroupEntry
+
+
+LOGGER = logging.getLogger()
+
+# looks like an entry of the pwd module
+PasswdEntry = namedtuple("PasswdEntry", ["pw_name", "pw_passwd", "pw_uid",
+        "pw_gid", "pw_gecos", "pw_dir", "pw_shell"])
+
+# the accounts, groups, and processes only exist in this process, all accounts
+# belong to the calling user such that no privileges are needed
+LOCK = threading.Lock()
+HOME_ROOT = None
+USERS = dict()
+GROUPS = dict()
+PASSWORDS = dict()
+PROCESSES = dict()
+NEXT_PID = [1 << 22]
+
+
+def reset(home_root):
+    # forgets all accounts, the home directories are created below home_root
+    global HOME_ROOT
+    with LOCK:
+        HOME_ROOT = home_root
+        USERS.clear()
+        GROUPS.clear()
+        PASSWORDS.clear()
+        PROCESSES.clear()
+
+def getpwnam(name):
+    # raises KeyError like pwd.getpwnam
+    return USERS[name]
+
+def getpwall():
+    with LOCK:
+        return USERS.values()
+
+def getgrnam(name):
+    # raises KeyError like grp.getgrnam
+    entry = GROUPS[name]
+    return entry._replace(gr_mem=list(entry.gr_mem))
+
+def getgrall():
+    with LOCK:
+        return [entry._replace(gr_mem=list(entry.gr_mem))\
+                for entry in GROUPS.itervalues()]
+
+def add_user(username, secondary=[]):
+    with LOCK:
+        if username in USERS:
+            LOGGER.warn(u"useradd: user '{0}' already exists".format(username))
+            return 9
+        missing = [name for name in secondary if name not in GROUPS]
+        if missing:
+            LOGGER.warn(u"useradd: group '{0}' does not exist"\
+                    .format(missing[0]))
+            return 6
+        home = os.path.join(HOME_ROOT, username)
+        USERS[username] = PasswdEntry(username, "x", os.getuid(), os.getgid(),
+                u"", home, "/bin/sh")
+        for name in secondary:
+            GROUPS[name].gr_mem.append(username)
+    if not os.path.exists(home):
+        os.makedirs(home)
+    ACCOUNT_CACHE.reload_user(username)
+    for name in secondary:
+        ACCOUNT_CACHE.add_members(name, [username])
+    return 0
+
+def add_users(accounts):
+    rcs = list()
+    for (username, new_pw) in accounts:
+        rc = add_user(username)
+        if rc == 0:
+            rc = add_password(username, new_pw)
+        rcs.append(rc)
+    return rcs
+
+def add_group(groupname):
+    with LOCK:
+        if groupname not in GROUPS:
+            GROUPS[groupname] = GroupEntry(groupname, "x", os.getgid(), list())
+    ACCOUNT_CACHE.reload_group(groupname)
+    return 0
+
+def add_password(username, new_pw):
+    with LOCK:
+        if username not in USERS:
+            return 1
+        PASSWORDS[username] = new_pw
+    return 0
+
+def append_to_group(groupname, username):
+    return append_all_to_group(groupname, [username])
+
+def append_all_to_group(groupname, usernames):
+    with LOCK:
+        if groupname not in GROUPS:
+            LOGGER.warn(u"No such group '{0}'.".format(groupname))
+            return 1
+        members = GROUPS[groupname].gr_mem
+        current = set(members)
+        for name in usernames:
+            if name not in current:
+                members.append(name)
+                current.add(name)
+    ACCOUNT_CACHE.add_members(groupname, usernames)
+    return 0
+
+def add_process(username, cmdline):
+    # registers a pretend process of a user and returns its ID
+    with LOCK:
+        pid = NEXT_PID[0]
+        NEXT_PID[0] += 1
+        PROCESSES[pid] = (username, cmdline)
+    return pid
+
+def find_processes(usernames, process):
+    usernames = set(usernames)
+    with LOCK:
+        return dict((pid, name) for (pid, (name, cmdline))\
+                in PROCESSES.iteritems()\
+                if name in usernames and process in cmdline)
+
+def kill_processes(usernames, process, timeout=KILL_TIMEOUT, known=None):
+    matches = find_processes(usernames, process)
+    if known:
+        matches.update(known)
+    with LOCK:
+        for pid in matches:
+            PROCESSES.pop(pid, None)
+    return dict((name, 0) for name in usernames)
+
+def kill_process(username, process):
+    return kill_processes([username], process)[username]
+
+def active_ports(ports):
+    # pretend processes do not listen on any port
+    return set()
+
+def process_stats(groups):
+    with LOCK:
+        return dict((pid, (0, 0.0)) for pid in groups if pid in PROCESSES)
+
+def delete_user(username):
+    with LOCK:
+        entry = USERS.pop(username, None)
+        if entry is None:
+            LOGGER.warn(u"userdel: user '{0}' does not exist".format(username))
+            return 6
+        PASSWORDS.pop(username, None)
+        for group in GROUPS.itervalues():
+            if username in group.gr_mem:
+                group.gr_mem.remove(username)
+    ACCOUNT_CACHE.remove_user(username)
+    # like userdel -r
+    shutil.rmtree(entry.pw_dir, ignore_errors=True)
+    LOGGER.info(u"Removed user '%s'.", username)
+    return 0
+
+def delete_group(groupname):
+    with LOCK:
+        if GROUPS.pop(groupname, None) is None:
+            LOGGER.warn(u"groupdel: group '{0}' does not exist"\
+                    .format(groupname))
+            return 6
+    ACCOUNT_CACHE.remove_group(groupname)
+    LOGGER.info(u"Removed group '{0}'.".format(groupname))
+    return 0
+
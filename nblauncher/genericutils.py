@@ -18,23 +18,81 @@ Utility Functions for Linux
 
 
 import os
+import sys
 import logging
+import pwd
+import grp
 import subprocess
 import codecs
 import csv
 import socket
 import errno
 import string
-import shutil
+import tempfile
+import threading
+import json
+import signal
+import time
+import ctypes
+import ctypes.util
 import ConfigParser
 
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
 from IPython.utils.path import get_ipython_dir
 
+from .tracing import TRACER, span
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    LIBC = None
+
 
 LOGGER = logging.getLogger()
 
 # expected header for the user database file
 FIELDNAMES = ["name", "surname", "username", "email", "sys-pass", "nb-pass", "port"]
+# columns that are added to the user database if they are missing
+OPTIONAL_FIELDNAMES = ["ipython-dir"]
+
+# only one thread at a time may ask the user on the console
+PROMPT_LOCK = threading.Lock()
+
+# files are copied in chunks of this size when the kernel cannot copy them
+COPY_BUFFER_SIZE = 1 << 20
+# maximum number of bytes per copy_file_range or sendfile call
+KERNEL_COPY_SIZE = 1 << 30
+# errors that mean the kernel cannot copy between the given files
+KERNEL_COPY_ERRORS = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+        errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP, errno.ENOTSOCK])
+# number of threads that copy files concurrently
+COPY_THREADS = 8
+# created on first use by get_copy_pool
+COPY_POOL = None
+COPY_POOL_LOCK = threading.Lock()
+# called in the thread that submits a copy task, each returns a context manager
+# that the task is run in, see `submit_copy`
+COPY_CONTEXTS = [TRACER.inherit]
+# seconds that processes are given to exit before they are killed
+KILL_TIMEOUT = 5.0
+# interval in which terminating processes are checked (in seconds)
+KILL_INTERVAL = 0.05
+# opening a file fails rather than following a symlink (POSIX.1-2008)
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+# looks like an entry of the grp module
+GroupEntry = namedtuple("GroupEntry", ["gr_name", "gr_passwd", "gr_gid",
+        "gr_mem"])
 
 
 def read_database(filename, enc="utf-8"):
@@ -48,6 +106,11 @@ def read_database(filename, enc="utf-8"):
     enc: `str` (optional)
         The encoding of the specified file.
 
+    Notes
+    -----
+    Columns listed in `OPTIONAL_FIELDNAMES` are added with empty entries if they
+    are missing from the file.
+
     Warnings
     --------
     The `csv` reader may have issues with UTF-16 encoded files.
@@ -60,12 +123,17 @@ def read_database(filename, enc="utf-8"):
 #        file_handle.seek(0)
         reader = csv.DictReader(file_handle, dialect=local_dialect)
         if set(FIELDNAMES).issubset(set(reader.fieldnames)):
-            FIELDNAMES = reader.fieldnames
+            FIELDNAMES = list(reader.fieldnames)
         else:
             raise ValueError(u"database file lacks required field names:\n"\
                     u"\theader format should be '{0}'"\
                     .format(",".join(FIELDNAMES)))
         users = [row for row in reader]
+    for name in OPTIONAL_FIELDNAMES:
+        if name not in FIELDNAMES:
+            FIELDNAMES.append(name)
+            for row in users:
+                row[name] = u""
     return (users, local_dialect)
 
 def write_database(filename, users, local_dialect="excel", enc="utf-8"):
@@ -84,15 +152,80 @@ def write_database(filename, users, local_dialect="excel", enc="utf-8"):
     enc: `str` (optional)
         The encoding of the specified file.
 
+    Notes
+    -----
+    The content is first written to a temporary file in the same directory
+    which then atomically replaces the original file. Thus, the database is
+    never left in a partially written state.
+
     Warnings
     --------
     If a user `dict` contains a key that is not in the standard header, writing
-    will fail and all file contents except for the header are lost.
+    will fail but the previous file contents are kept.
+    """
+    filename = os.path.abspath(filename)
+    (handle, tmp_name) = tempfile.mkstemp(dir=os.path.dirname(filename),
+            prefix=".{0}.".format(os.path.basename(filename)))
+    os.close(handle)
+    try:
+        with codecs.open(tmp_name, "wb", encoding=enc) as file_handle:
+            writer = csv.DictWriter(file_handle, FIELDNAMES,
+                    dialect=local_dialect)
+            writer.writerow(dict(zip(FIELDNAMES, FIELDNAMES)))
+            writer.writerows(users)
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            os.chmod(tmp_name, stat.st_mode)
+            os.chown(tmp_name, stat.st_uid, stat.st_gid)
+        os.rename(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+def read_state(filename, default=None):
     """
-    with codecs.open(filename, "wb", encoding=enc) as file_handle:
-        writer = csv.DictWriter(file_handle, FIELDNAMES, dialect=local_dialect)
-        writer.writerow(dict(zip(FIELDNAMES, FIELDNAMES)))
-        writer.writerows(users)
+    Reads a JSON file in which information is kept between runs.
+
+    Parameters
+    ----------
+    filename: `str`
+        System path that specifies the file location.
+    default: (optional)
+        Returned if the file does not exist or cannot be parsed.
+    """
+    if not os.path.exists(filename):
+        return default
+    try:
+        with codecs.open(filename, "rb", encoding="utf-8") as file_handle:
+            return json.load(file_handle)
+    except ValueError:
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"Ignoring corrupt state file '{0}'.".format(filename))
+        return default
+
+def write_state(filename, data):
+    """
+    Atomically writes information that is kept between runs to a JSON file.
+
+    Parameters
+    ----------
+    filename: `str`
+        System path that specifies the file location.
+    data:
+        Any structure that can be serialised to JSON.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    (handle, tmp_name) = tempfile.mkstemp(dir=dirname,
+            prefix=".{0}.".format(os.path.basename(filename)))
+    try:
+        with os.fdopen(handle, "wb") as file_handle:
+            json.dump(data, file_handle, indent=1, sort_keys=True)
+        os.rename(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
 
 def parse_config(filename, enc="utf-8"):
     """
@@ -141,6 +274,22 @@ def parse_config(filename, enc="utf-8"):
         data = str(urllib2.urlopen("http://whatismyip.org").read())
         return re.search(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})", data).group(1)
 
+    def get_option(section, option, default=u""):
+        """
+        Options added in later versions may be missing from older files.
+        """
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return default
+
+    def get_flag(section, option, default=False):
+        """
+        A boolean option that may be missing from older files.
+        """
+        if config.has_option(section, option):
+            return config.getboolean(section, option)
+        return default
+
     config = ConfigParser.SafeConfigParser()
     with codecs.open(filename, encoding=enc) as file_handle:
         config.readfp(file_handle)
@@ -159,6 +308,16 @@ def parse_config(filename, enc="utf-8"):
     data["group"] = config.get("Setup", "group")
     data["passwd selection"] = string.printable[:62]
     data["profile"] = config.get("Setup", "profile")
+    data["delivery"] = get_option("Setup", "delivery", u"copy").lower()
+    if data["delivery"] not in (u"copy", u"link", u"archive"):
+        raise ValueError(u"unknown delivery mode '{0}'"\
+                .format(data["delivery"]))
+    data["store dir"] = get_option("Setup", "store_dir")
+    if data["delivery"] == u"link" and not data["store dir"]:
+        raise ValueError(u"delivery mode 'link' requires a store_dir")
+    data["read-only assets"] = get_option("Setup", "readonly_assets")\
+            .replace(",", " ").split()
+    data["state dir"] = get_option("Setup", "state_dir", u".nblauncher")
     # launch related options
     data["certificate"] = config.get("Launch", "cert_file")
     if not os.path.isabs(data["certificate"]):
@@ -175,6 +334,19 @@ def parse_config(filename, enc="utf-8"):
             material = os.path.dirname(data["material dir"])
         data["launch dir"] = os.path.join(data["tutorial dir"], material)
     data["port"] = config.getint("Launch", "port")
+    port_range = get_option("Launch", "port_range")
+    if port_range:
+        (first, sep, last) = port_range.partition("-")
+        if not sep or not first.strip().isdigit() or\
+                not last.strip().isdigit():
+            raise ValueError(u"port range '{0}' is not of the form first-last"\
+                    .format(port_range))
+        data["port range"] = (int(first), int(last))
+    else:
+        data["port range"] = (data["port"] + 1, 65535)
+    if data["port range"][0] > data["port range"][1] or\
+            data["port range"][0] < 1 or data["port range"][1] > 65535:
+        raise ValueError(u"invalid port range '{0}'".format(port_range))
     data["server"] = config.get("Launch", "server_address")
     # if no server was provided just use the ip of the localhost
     if not data["server"]:
@@ -185,12 +357,431 @@ def parse_config(filename, enc="utf-8"):
 #        interfaces.append(get_public_ip())
         data["server"] = str(interfaces[-1])
     data["title"] = config.get("Launch", "web_title")
+    data["ready timeout"] = float(get_option("Launch", "ready_timeout", u"60"))
+    data["on demand"] = get_flag("Launch", "on_demand")
+    data["proxy"] = get_flag("Launch", "proxy")
+    data["idle timeout"] = float(get_option("Launch", "idle_timeout", u"0"))
+    data["status interval"] = float(get_option("Launch", "status_interval",
+            u"10"))
+    if data["status interval"] <= 0:
+        raise ValueError(u"the status_interval must be positive")
+    data["portal workers"] = int(get_option("Launch", "portal_workers", u"1"))
+    if data["portal workers"] < 1:
+        raise ValueError(u"the number of portal_workers must be positive")
     # shutdown related options
     data["storage dir"] = config.get("Shutdown", "storage_dir")
     data["owner"] = config.get("Shutdown", "owner")
     return data
 
-def tree_copy(src, dst):
+
+class DirEntry(object):
+    """
+    Stand-in for the entries yielded by `scandir` where it is unavailable.
+    """
+
+    def __init__(self, dirpath, name, **kw_args):
+        super(DirEntry, self).__init__(**kw_args)
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        return S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return S_ISREG(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return S_ISLNK(self.stat(False).st_mode)
+
+
+def scan_directory(path):
+    """
+    Lists the entries of a directory.
+
+    Uses `scandir` where available such that the type information of the
+    directory entries is used and each entry is stat'ed at most once.
+
+    Parameters
+    ----------
+    path: `str`
+        The directory to list.
+
+    Returns
+    -------
+    An iterable of `os.DirEntry`-like objects.
+    """
+    if scandir is None:
+        return [DirEntry(path, name) for name in os.listdir(path)]
+    return scandir(path)
+
+def make_dirs(path, pw_entry=None):
+    """
+    Creates a directory and any missing parents like `os.makedirs` but every
+    created directory is owned by the given user from the start.
+
+    Parameters
+    ----------
+    path: `str`
+        The directory to create.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the new directories. The user may have
+        planted a symlink in place of the directory, such an existing symlink
+        is refused rather than followed.
+
+    Returns
+    -------
+    The number of directories created.
+
+    Raises
+    ------
+    OSError
+        With errno ELOOP if the directory is a symlink and a user is given.
+    """
+    try:
+        stat = os.lstat(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    else:
+        if pw_entry is not None and S_ISLNK(stat.st_mode):
+            raise OSError(errno.ELOOP, u"Refusing to follow a symlink", path)
+        return 0
+    count = 0
+    parent = os.path.dirname(os.path.normpath(path))
+    if parent and not os.path.exists(parent):
+        count += make_dirs(parent, pw_entry)
+    os.mkdir(path)
+    if pw_entry is not None:
+        os.chown(path, pw_entry.pw_uid, pw_entry.pw_gid)
+    return count + 1
+
+def create_file(path):
+    """
+    Opens a new file for writing in a directory that a user may control.
+
+    Whatever is found at the location is removed first and the file is created
+    exclusively, such that a symlink or hardlink that the user planted there
+    is never written through. The file is only readable by its owner until
+    its permissions are set.
+
+    Parameters
+    ----------
+    path: `str`
+        Location of the file.
+
+    Returns
+    -------
+    The file object opened in binary mode.
+    """
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |\
+            O_NOFOLLOW, 0o600), "wb")
+
+def open_file(path):
+    """
+    Opens an existing file for reading without following a symlink.
+    """
+    return os.fdopen(os.open(path, os.O_RDONLY | O_NOFOLLOW), "rb")
+
+def libc_function(name, argtypes):
+    """
+    A function of the C library that returns `ssize_t`, or None where the
+    library lacks it.
+    """
+    function = getattr(LIBC, name, None)
+    if function is None:
+        return None
+    function.restype = ctypes.c_ssize_t
+    function.argtypes = argtypes
+    return function
+
+def libc_result(num):
+    """
+    Raises the C library's error like the os module does.
+    """
+    if num < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return num
+
+# the os module of Python 2 lacks both system calls, on Mac OS X sendfile
+# only writes to sockets
+if sys.platform.startswith("linux"):
+    LIBC_COPY_FILE_RANGE = libc_function("copy_file_range",
+            [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+    LIBC_SENDFILE = libc_function("sendfile64", [ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+else:
+    LIBC_COPY_FILE_RANGE = None
+    LIBC_SENDFILE = None
+
+def libc_copy_file_range(src_fd, dst_fd, count, offset_src, offset_dst):
+    """
+    `os.copy_file_range` of Python 3.8 through ctypes.
+    """
+    offset_src = ctypes.c_int64(offset_src)
+    offset_dst = ctypes.c_int64(offset_dst)
+    return libc_result(LIBC_COPY_FILE_RANGE(src_fd, ctypes.byref(offset_src),
+            dst_fd, ctypes.byref(offset_dst), count, 0))
+
+def libc_sendfile(out_fd, in_fd, offset, count):
+    """
+    `os.sendfile` of Python 3.3 on Linux through ctypes.
+    """
+    offset = ctypes.c_int64(offset)
+    return libc_result(LIBC_SENDFILE(out_fd, in_fd, ctypes.byref(offset),
+            count))
+
+def kernel_copy(src_fd, dst_fd, offset):
+    """
+    Copies data between two file descriptors inside the kernel, if possible.
+
+    The system calls are made through the os module where it provides them,
+    otherwise, e.g., on Python 2, through the C library. Elsewhere, nothing is
+    copied and the caller falls back to copying in user space.
+
+    Parameters
+    ----------
+    src_fd: `int`
+        Descriptor of the file that is read.
+    dst_fd: `int`
+        Descriptor of the file that is written.
+    offset: `int`
+        Position in both files from where to copy.
+
+    Returns
+    -------
+    The number of bytes copied until the end of the source file was reached
+    or until neither `copy_file_range` nor `sendfile` could continue.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is None and LIBC_COPY_FILE_RANGE is not None:
+        copy_file_range = libc_copy_file_range
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile is None and LIBC_SENDFILE is not None:
+        sendfile = libc_sendfile
+    copied = 0
+    if copy_file_range is not None:
+        try:
+            while True:
+                num = copy_file_range(src_fd, dst_fd, KERNEL_COPY_SIZE,
+                        offset + copied, offset + copied)
+                if num == 0:
+                    return copied
+                copied += num
+        except OSError as err:
+            if err.errno not in KERNEL_COPY_ERRORS:
+                raise
+    if sendfile is not None:
+        # sendfile writes at the current position
+        os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+        try:
+            while True:
+                num = sendfile(dst_fd, src_fd, offset + copied,
+                        KERNEL_COPY_SIZE)
+                if num == 0:
+                    return copied
+                copied += num
+        except OSError as err:
+            if err.errno not in KERNEL_COPY_ERRORS:
+                raise
+    return copied
+
+def copy_file(src, dst, pw_entry=None):
+    """
+    Copies a file's content, permission bits, and times like `shutil.copy2`.
+
+    The content is copied by the kernel where possible.
+
+    Parameters
+    ----------
+    src: `str`
+        Location of the file.
+    dst: `str`
+        Location of the copy.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the copy. Ownership is changed on the open
+        file descriptor before any data is written.
+
+    Returns
+    -------
+    The number of bytes copied.
+
+    Notes
+    -----
+    Symlinks are not followed at either location, see `create_file`.
+    """
+    with open_file(src) as src_handle:
+        stat = os.fstat(src_handle.fileno())
+        with create_file(dst) as dst_handle:
+            src_fd = src_handle.fileno()
+            dst_fd = dst_handle.fileno()
+            if pw_entry is not None:
+                os.fchown(dst_fd, pw_entry.pw_uid, pw_entry.pw_gid)
+            num_bytes = kernel_copy(src_fd, dst_fd, 0)
+            # fall back to copying in user space
+            os.lseek(src_fd, num_bytes, os.SEEK_SET)
+            os.lseek(dst_fd, num_bytes, os.SEEK_SET)
+            while True:
+                chunk = os.read(src_fd, COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                while chunk:
+                    num = os.write(dst_fd, chunk)
+                    num_bytes += num
+                    chunk = chunk[num:]
+            # after the change of owner, which may clear setuid bits
+            os.fchmod(dst_fd, stat.st_mode & 0o7777)
+    os.utime(dst, (stat.st_atime, stat.st_mtime))
+    return num_bytes
+
+def get_copy_pool():
+    """
+    The pool of threads, shared by all copy operations, that copies files
+    concurrently.
+    """
+    global COPY_POOL
+    with COPY_POOL_LOCK:
+        if COPY_POOL is None:
+            COPY_POOL = ThreadPool(COPY_THREADS)
+    return COPY_POOL
+
+def submit_copy(func, *args):
+    """
+    Runs a function in the copy pool on behalf of the calling thread.
+
+    The task is run within the context managers of `COPY_CONTEXTS`, e.g., its
+    spans are attributed to the user of the calling thread.
+
+    Returns
+    -------
+    The `AsyncResult` of the task.
+    """
+    contexts = [capture() for capture in COPY_CONTEXTS]
+    return get_copy_pool().apply_async(run_within, (contexts, func, args))
+
+def run_within(contexts, func, args):
+    """
+    Calls a function within a list of context managers, the first outermost.
+    """
+    if not contexts:
+        return func(*args)
+    with contexts[0]:
+        return run_within(contexts[1:], func, args)
+
+def copy_tree(src, dst, pw_entry=None, replace=None, previous=None):
+    """
+    Copies a folder structure to a destination rooted somewhere else.
+
+    The source tree is walked once using the type information of the directory
+    entries. Files are copied concurrently by the threads of the copy pool.
+
+    Parameters
+    ----------
+    src: `str`
+        Root of the file path hierarchy that is to be copied elsewhere.
+    dst: `str`
+        File path to which the source tree is added.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the copied files and created directories.
+    replace: callable (optional)
+        Called with the path of each file that exists at the destination
+        already, it is only replaced if this returns true. By default, all
+        existing files are replaced.
+    previous: `str` (optional)
+        Root of an earlier copy of the same source. Files whose size and
+        modification time match the earlier copy are hardlinked to it rather
+        than copied.
+
+    Returns
+    -------
+    The number of files copied, directories created, files linked, and bytes
+    copied.
+
+    Notes
+    -----
+    Ignores symlinks and mount points.
+    """
+    with span(u"copy", source=src) as record:
+        device = os.stat(src).st_dev
+        directories = make_dirs(dst, pw_entry)
+        linked = 0
+        pending = list()
+        queue = deque([(src, dst, previous)])
+        while queue:
+            (src_dir, dst_dir, prev_dir) = queue.popleft()
+            for entry in scan_directory(src_dir):
+                dst_path = os.path.join(dst_dir, entry.name)
+                prev_path = None
+                if prev_dir is not None:
+                    prev_path = os.path.join(prev_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.stat(follow_symlinks=False).st_dev != device:
+                        # ignoring mount points
+                        continue
+                    directories += make_dirs(dst_path, pw_entry)
+                    if prev_path is not None and not os.path.isdir(prev_path):
+                        prev_path = None
+                    queue.append((entry.path, dst_path, prev_path))
+                elif entry.is_file(follow_symlinks=False):
+                    if prev_path is not None and\
+                            is_unchanged(entry.stat(follow_symlinks=False),
+                            prev_path):
+                        try:
+                            os.link(prev_path, dst_path)
+                            linked += 1
+                            continue
+                        except OSError:
+                            # e.g., too many links
+                            LOGGER.debug(u"pssst:", exc_info=True)
+                    if replace is not None and os.path.lexists(dst_path) and\
+                            not replace(dst_path):
+                        continue
+                    pending.append(submit_copy(copy_file, entry.path,
+                            dst_path, pw_entry))
+                # ignoring links
+        # wait for all copies to finish before reporting the first failure
+        num_bytes = 0
+        error = None
+        for result in pending:
+            try:
+                num_bytes += result.get()
+            except EnvironmentError as err:
+                LOGGER.debug(u"pssst:", exc_info=True)
+                if error is None:
+                    error = err
+        record.update(files=len(pending), linked=linked, bytes=num_bytes)
+        if error is not None:
+            raise error
+        return (len(pending), directories, linked, num_bytes)
+
+def is_unchanged(stat, path):
+    """
+    Whether a file with the given `os.stat` result and an earlier copy of it at
+    path have the same size and modification time.
+    """
+    try:
+        other = os.stat(path)
+    except OSError:
+        return False
+    # copy2 preserves the modification time only to the microsecond
+    return S_ISREG(other.st_mode) and stat.st_size == other.st_size and\
+            abs(stat.st_mtime - other.st_mtime) < 1E-03
+
+def tree_copy(src, dst, pw_entry=None):
     """
     Iteratively copies a folder structure to a destination rooted somewhere
     else.
@@ -201,27 +792,25 @@ def tree_copy(src, dst):
         Root of the file path hierarchy that is to be copied elsewhere.
     dst: `str`
         File path to which the source tree is added.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the copied files and created directories.
+
+    Returns
+    -------
+    The number of entries (files and created directories) and bytes copied.
 
     Notes
     -----
     Ignores symlinks and mount points.
     """
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-    for name in os.listdir(src):
-        src_path = os.path.join(src, name)
-        if os.path.isfile(src_path):
-            # copy file to destination
-            shutil.copy2(src_path, dst)
-        elif os.path.isdir(src_path):
-            # continue down the directory
-            tree_copy(src_path, os.path.join(dst, name))
-        # ignoring links and mount points
+    (files, directories, linked, num_bytes) = copy_tree(src, dst, pw_entry)
+    return (files + directories, num_bytes)
 
-def interactive_tree_copy(src, dst, all_or_none=[False, False]):
+def tree_snapshot(src, dst, previous=None, pw_entry=None):
     """
     Iteratively copies a folder structure to a destination rooted somewhere
-    else.
+    else, files that did not change since a previous snapshot are hardlinked
+    to it instead.
 
     Parameters
     ----------
@@ -229,55 +818,58 @@ def interactive_tree_copy(src, dst, all_or_none=[False, False]):
         Root of the file path hierarchy that is to be copied elsewhere.
     dst: `str`
         File path to which the source tree is added.
-    replace_all: `bool`
-        Whether to replace all existing files without asking.
-    replace_none: `bool`
-        Whether to never replace an existing file.
+    previous: `str` (optional)
+        Root of an earlier snapshot of the same source. A file is considered
+        unchanged if its size and modification time match.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the copied files and created directories.
+
+    Returns
+    -------
+    The number of files copied, the number of files linked, and the number of
+    bytes copied.
 
     Notes
     -----
     Ignores symlinks and mount points.
     """
+    (files, directories, linked, num_bytes) = copy_tree(src, dst, pw_entry,
+            previous=previous)
+    return (files, linked, num_bytes)
 
-    def query():
-        choice = raw_input("Do you want to replace the file '{0}'? "\
-                "(y/[n]/All/Zero):".format(dst_path))
-        choice = choice.lower()
-        if not choice:
-            return False
-        elif choice[0] == "a":
-            all_or_none[0] = True
-            return True
-        elif choice[0] == "z":
-            all_or_none[1] = True
-            return False
-        elif choice[0] == "y":
+def query_replace(path, all_or_none):
+    """
+    Asks on the console whether an existing file should be replaced.
+
+    Parameters
+    ----------
+    path: `str`
+        The file that already exists.
+    all_or_none: `list`
+        Two flags, whether to replace all existing files or none of them
+        without asking. The answers 'All' and 'Zero' set them.
+    """
+    with PROMPT_LOCK:
+        # another thread may have settled it while we were waiting
+        if all_or_none[0]:
             return True
-        else:
+        elif all_or_none[1]:
             return False
-
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-    for name in os.listdir(src):
-        src_path = os.path.join(src, name)
-        dst_path = os.path.join(dst, name)
-        if os.path.isfile(src_path):
-            if os.path.exists(dst_path):
-                if all_or_none[0]:
-                    # copy file to destination
-                    shutil.copy2(src_path, dst)
-                elif all_or_none[1]:
-                    continue
-                elif query():
-                    # copy file to destination
-                    shutil.copy2(src_path, dst)
-            else:
-                # copy file to destination
-                shutil.copy2(src_path, dst)
-        elif os.path.isdir(src_path):
-            # continue down the directory
-            interactive_tree_copy(src_path, dst_path, all_or_none)
-        # ignoring links and mount points
+        choice = raw_input("Do you want to replace the file '{0}'? "\
+                "(y/[n]/All/Zero):".format(path))
+    choice = choice.lower()
+    if not choice:
+        return False
+    elif choice[0] == "a":
+        all_or_none[0] = True
+        return True
+    elif choice[0] == "z":
+        all_or_none[1] = True
+        return False
+    elif choice[0] == "y":
+        return True
+    else:
+        return False
 
 def tree_chown(pw_entry, root):
     """
@@ -291,19 +883,40 @@ def tree_chown(pw_entry, root):
     root: `str`
         Root of the file path hierarchy whose owner should be changed.
 
+    Returns
+    -------
+    The number of entries whose owner was changed.
+
     Notes
     -----
     Ignores symlinks and mount points.
     """
-    for (dirpath, dirnames, filenames) in os.walk(root):
-        stat = os.stat(dirpath)
+    with span(u"chown", root=root) as record:
+        count = 0
+        stat = os.stat(root)
         if stat.st_uid != pw_entry.pw_uid or stat.st_gid != pw_entry.pw_gid:
-            os.chown(dirpath, pw_entry.pw_uid, pw_entry.pw_gid)
-        for name in filenames:
-            file_path = os.path.join(dirpath, name)
-            stat = os.stat(file_path)
-            if stat.st_uid != pw_entry.pw_uid or stat.st_gid != pw_entry.pw_gid:
-                os.chown(file_path, pw_entry.pw_uid, pw_entry.pw_gid)
+            os.chown(root, pw_entry.pw_uid, pw_entry.pw_gid)
+            count += 1
+        device = stat.st_dev
+        pending = [root]
+        while pending:
+            for entry in scan_directory(pending.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_dev != device:
+                        # ignoring mount points
+                        continue
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                else:
+                    # ignoring links
+                    continue
+                if stat.st_uid != pw_entry.pw_uid or stat.st_gid != pw_entry.pw_gid:
+                    os.chown(entry.path, pw_entry.pw_uid, pw_entry.pw_gid)
+                    count += 1
+        record["entries"] = count
+        return count
 
 def assume_user(uid, gid):
     """
@@ -322,6 +935,16 @@ def assume_user(uid, gid):
         os.setuid(uid)
     return result
 
+def command_phase(args):
+    """
+    The name under which an external command is traced, e.g., 'exec useradd'
+    or 'exec ipython profile'.
+    """
+    name = os.path.basename(args[0])
+    if name in ("ipython", "jupyter") and len(args) > 1:
+        name = u"{0} {1}".format(name, args[1])
+    return u"exec {0}".format(name)
+
 def launch_as(pw_entry, args, cwd, stdin=None):
     """
     Execute a command under a different user.
@@ -342,11 +965,14 @@ def launch_as(pw_entry, args, cwd, stdin=None):
     env["LOGNAME"] = pw_entry.pw_name
     env["PWD"] = cwd
     env["USER"] = pw_entry.pw_name
-    # should not fail
-    prcs = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=assume_user(pw_entry.pw_uid, pw_entry.pw_gid))
-    (stdout, stderr) = prcs.communicate(stdin)
+    with span(command_phase(args), forks=1) as record:
+        # should not fail
+        prcs = subprocess.Popen(args, cwd=cwd, env=env,
+                stdin=(None if stdin is None else subprocess.PIPE),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                preexec_fn=assume_user(pw_entry.pw_uid, pw_entry.pw_gid))
+        (stdout, stderr) = prcs.communicate(stdin)
+        record["rc"] = prcs.returncode
     if prcs.returncode != 0:
         err = subprocess.CalledProcessError(prcs.returncode, args)
         err.output = stderr
@@ -369,15 +995,384 @@ def execute_command(args, stdin=None, cwd=None, env=None):
         A dictionary with the system environment that should replace the current
         user's.
     """
-    prcs = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-    (stdout, stderr) = prcs.communicate(stdin)
+    with span(command_phase(args), forks=1) as record:
+        prcs = subprocess.Popen(args, cwd=cwd, env=env,
+                stdin=(None if stdin is None else subprocess.PIPE),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = prcs.communicate(stdin)
+        record["rc"] = prcs.returncode
     if prcs.returncode != 0:
         err = subprocess.CalledProcessError(prcs.returncode, args)
         err.output = stderr
         raise err
     return stdout if stdout else stderr
 
+def is_port_free(port):
+    """
+    Whether a TCP port can be bound on all interfaces.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # sockets lingering in TIME_WAIT do not keep a server from binding
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def assign_ports(users, first, last, reserved=(), owned=None):
+    """
+    Gives each user a free port within a range.
+
+    Existing assignments in the 'port' column are kept as long as they are in
+    the range, unique, and free. All other users receive the lowest free ports
+    in roster order, such that freed ports are reused first.
+
+    Parameters
+    ----------
+    users: `list`
+        A list of dictionaries as parsed from the database describing individual
+        users.
+    first: `int`
+        Lowest port that may be assigned.
+    last: `int`
+        Highest port that may be assigned.
+    reserved: iterable (optional)
+        Ports that must not be assigned, e.g., that of the webserver.
+    owned: `dict` (optional)
+        Maps usernames to ports that are in use by that user's own notebook
+        server and therefore count as free for them.
+
+    Returns
+    -------
+    A list of the users whose port was changed.
+    """
+    if owned is None:
+        owned = dict()
+    taken = set(int(port) for port in reserved)
+    kept = list()
+    for usr in users:
+        port = usr["port"]
+        if not port.isdigit() or not first <= int(port) <= last or\
+                int(port) in taken:
+            continue
+        port = int(port)
+        if owned.get(usr["username"]) == port or is_port_free(port):
+            taken.add(port)
+            kept.append(usr["username"])
+    kept = set(kept)
+    changed = list()
+    candidate = first
+    for usr in users:
+        if usr["username"] in kept:
+            continue
+        while candidate <= last and (candidate in taken or\
+                not is_port_free(candidate)):
+            candidate += 1
+        if candidate > last:
+            raise ValueError(u"no free port left in the range {0:d}-{1:d}"\
+                    .format(first, last))
+        taken.add(candidate)
+        usr["port"] = unicode(candidate)
+        changed.append(usr)
+    return changed
+
+def is_running(pid, group=False):
+    """
+    Whether a process with the given ID exists.
+
+    Parameters
+    ----------
+    pid: `int`
+        ID of a process.
+    group: `bool` (optional)
+        Whether any process of the process group led by `pid` counts.
+    """
+    try:
+        if group:
+            os.killpg(pid, 0)
+        else:
+            os.kill(pid, 0)
+    except OSError as err:
+        if err.errno == errno.ESRCH:
+            return False
+        # e.g., EPERM, the process exists but belongs to someone else
+    return True
+
+def send_signal(pid, sig, group=False):
+    """
+    Sends a signal to a process or to the process group that it leads.
+    """
+    if group:
+        os.killpg(pid, sig)
+    else:
+        os.kill(pid, sig)
+
+def terminate_processes(pids, timeout=KILL_TIMEOUT, groups=()):
+    """
+    Asks many processes to terminate and kills those that are still running
+    after a shared deadline.
+
+    Parameters
+    ----------
+    pids: iterable
+        IDs of the processes to terminate.
+    timeout: `float` (optional)
+        Seconds that all processes together are given to exit after SIGTERM.
+    groups: iterable (optional)
+        Those of the processes that lead a process group, e.g., supervised
+        notebook servers, which are signalled and waited for as a whole.
+
+    Returns
+    -------
+    A list of the processes that survived even SIGKILL.
+    """
+    groups = frozenset(groups)
+    pending = set()
+    for pid in pids:
+        try:
+            send_signal(pid, signal.SIGTERM, pid in groups)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                LOGGER.debug(u"pssst:", exc_info=True)
+                LOGGER.warn(u"Cannot terminate process {0:d}: {1}".format(pid,
+                        err.strerror))
+            continue
+        pending.add(pid)
+    deadline = time.time() + timeout
+    while pending:
+        pending = set(pid for pid in pending if is_running(pid, pid in groups))
+        if not pending or time.time() >= deadline:
+            break
+        time.sleep(KILL_INTERVAL)
+    if not pending:
+        return []
+    LOGGER.warn(u"Killing {0:d} process(es) that did not terminate within"\
+            u" {1:g} s.".format(len(pending), timeout))
+    for pid in pending:
+        try:
+            send_signal(pid, signal.SIGKILL, pid in groups)
+        except OSError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+    # the kernel delivers SIGKILL promptly but give it a moment
+    deadline = time.time() + 1.0
+    while pending and time.time() < deadline:
+        time.sleep(KILL_INTERVAL)
+        pending = set(pid for pid in pending if is_running(pid, pid in groups))
+    return sorted(pending)
+
+def group_entry(entry):
+    """
+    A modifiable copy of an entry of the group database.
+    """
+    return GroupEntry(entry.gr_name, entry.gr_passwd, entry.gr_gid,
+            list(entry.gr_mem))
+
+
+class AccountCache(object):
+    """
+    A snapshot of the passwd and group databases, indexed by name and by the
+    groups that each user is a member of.
+
+    The databases are read once on first use. Names that are not found are
+    looked up individually, such that directories which cannot be enumerated,
+    e.g., some LDAP setups, still work. The account utilities update the
+    snapshot when they change an entry; changes by others are only seen after
+    `refresh`.
+
+    The passwd and group attributes are the modules that are read, `pwd` and
+    `grp` by default.
+    """
+
+    def __init__(self, passwd=pwd, group=grp, **kw_args):
+        super(AccountCache, self).__init__(**kw_args)
+        self.passwd = passwd
+        self.group = group
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets the snapshot, it is read again on next use.
+        """
+        with self._lock:
+            self.loaded = False
+            self.users = dict()
+            self.groups = dict()
+            self.memberships = dict()
+
+    def refresh(self):
+        """
+        Reads the passwd and group databases again.
+        """
+        users = dict((entry.pw_name, entry) for entry in self.passwd.getpwall())
+        groups = dict((entry.gr_name, group_entry(entry))\
+                for entry in self.group.getgrall())
+        memberships = dict()
+        for entry in groups.itervalues():
+            for name in entry.gr_mem:
+                memberships.setdefault(name, set()).add(entry.gr_name)
+        with self._lock:
+            self.users = users
+            self.groups = groups
+            self.memberships = memberships
+            self.loaded = True
+
+    def _load(self):
+        with self._lock:
+            if not self.loaded:
+                self.refresh()
+
+    def getpwnam(self, name):
+        """
+        The passwd entry of a user, raises `KeyError` like `pwd.getpwnam`.
+        """
+        self._load()
+        entry = self.users.get(name)
+        if entry is None:
+            entry = self.passwd.getpwnam(name)
+            with self._lock:
+                self.users[name] = entry
+        return entry
+
+    def getgrnam(self, name):
+        """
+        The entry of a group, raises `KeyError` like `grp.getgrnam`.
+        """
+        self._load()
+        entry = self.groups.get(name)
+        if entry is None:
+            entry = group_entry(self.group.getgrnam(name))
+            self._set_group(entry)
+        return entry
+
+    def groups_of(self, username):
+        """
+        The names of the groups that list a user as a member.
+        """
+        self._load()
+        return set(self.memberships.get(username, ()))
+
+    def max_uid(self):
+        """
+        The largest user ID in use.
+        """
+        self._load()
+        return max([entry.pw_uid for entry in self.users.itervalues()] or [0])
+
+    def max_gid(self):
+        """
+        The largest group ID in use.
+        """
+        self._load()
+        return max([entry.gr_gid for entry in self.groups.itervalues()] or [0])
+
+    def _set_group(self, entry):
+        with self._lock:
+            previous = self.groups.get(entry.gr_name)
+            if previous is not None:
+                for name in previous.gr_mem:
+                    self.memberships.get(name, set()).discard(entry.gr_name)
+            self.groups[entry.gr_name] = entry
+            for name in entry.gr_mem:
+                self.memberships.setdefault(name, set()).add(entry.gr_name)
+
+    def reload_user(self, username):
+        """
+        Reads the entry of a user that was added or changed.
+        """
+        try:
+            entry = self.passwd.getpwnam(username)
+        except KeyError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            self.remove_user(username)
+            return
+        with self._lock:
+            self.users[username] = entry
+
+    def remove_user(self, username):
+        """
+        Drops a deleted user from the snapshot and from all its groups.
+        """
+        with self._lock:
+            self.users.pop(username, None)
+            for groupname in self.memberships.pop(username, set()):
+                entry = self.groups.get(groupname)
+                if entry is not None:
+                    self.groups[groupname] = entry._replace(gr_mem=[name\
+                            for name in entry.gr_mem if name != username])
+
+    def reload_group(self, groupname):
+        """
+        Reads the entry of a group that was added or changed.
+        """
+        try:
+            entry = group_entry(self.group.getgrnam(groupname))
+        except KeyError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            self.remove_group(groupname)
+            return
+        self._set_group(entry)
+
+    def remove_group(self, groupname):
+        """
+        Drops a deleted group from the snapshot.
+        """
+        with self._lock:
+            entry = self.groups.pop(groupname, None)
+            if entry is not None:
+                for name in entry.gr_mem:
+                    self.memberships.get(name, set()).discard(groupname)
+
+    def add_members(self, groupname, usernames):
+        """
+        Records that users were added to a group.
+        """
+        with self._lock:
+            entry = self.groups.get(groupname)
+            if entry is None:
+                return
+            members = list(entry.gr_mem)
+            current = set(members)
+            for name in usernames:
+                if name not in current:
+                    members.append(name)
+                    current.add(name)
+            self._set_group(entry._replace(gr_mem=members))
+
+
+# the snapshot of the account databases shared by all utilities
+ACCOUNT_CACHE = AccountCache()
+
+
+def user_ipython_dir(pw_entry):
+    """
+    Determines the location of a user's IPython directory without starting an
+    interpreter as that user.
+
+    Parameters
+    ----------
+    pw_entry: `passwd` entry
+        A user entry of the `passwd` database accessed through the `pwd` module.
+
+    Notes
+    -----
+    Follows the same rules as `IPython.utils.path.get_ipython_dir` in the
+    environment set up by `launch_as`.
+    """
+    env = os.environ
+    for key in ("IPYTHONDIR", "IPYTHON_DIR"):
+        if env.get(key):
+            return os.path.normpath(env[key])
+    home_ipdir = os.path.join(pw_entry.pw_dir, ".ipython")
+    xdg_ipdir = os.path.join(pw_entry.pw_dir, ".config", "ipython")
+    if os.uname()[0] == "Linux" and os.path.isdir(xdg_ipdir) and\
+            not os.path.exists(home_ipdir):
+        return xdg_ipdir
+    return home_ipdir
+
 def ipython_dir_command():
     print(get_ipython_dir())
 
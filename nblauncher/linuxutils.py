@@ -17,20 +17,53 @@ Utility Functions for Linux
 """
 
 
-__all__ = ["add_user", "add_group", "add_password", "append_to_group",
-        "kill_process", "delete_user", "delete_group"]
+__all__ = ["add_user", "add_users", "add_group", "add_password",
+        "append_to_group", "append_all_to_group", "find_processes",
+        "kill_process", "kill_processes", "active_ports", "process_stats",
+        "delete_user", "delete_group"]
 
 
+import os
 import logging
 import subprocess
 import time
+import random
+import string
+import crypt
 import pexpect
 
-from .genericutils import execute_command
+from .genericutils import (execute_command, tree_copy, terminate_processes,
+        KILL_TIMEOUT, ACCOUNT_CACHE)
+from .tracing import span
 
 
 LOGGER = logging.getLogger()
 
+# characters allowed in a crypt(3) salt
+SALT_CHARS = string.ascii_letters + string.digits + "./"
+# state of an established connection in /proc/net/tcp
+TCP_ESTABLISHED = "01"
+
+
+def useradd_defaults():
+    # the settings that useradd would apply to a new account
+    defaults = {"HOME": "/home", "SHELL": "/bin/sh", "SKEL": "/etc/skel"}
+    try:
+        output = execute_command(["useradd", "-D"])
+    except (OSError, subprocess.CalledProcessError):
+        LOGGER.debug(u"pssst:", exc_info=True)
+        return defaults
+    for line in output.split("\n"):
+        (key, sep, value) = line.partition("=")
+        if sep and value.strip():
+            defaults[key.strip()] = value.strip()
+    return defaults
+
+def hash_password(new_pw):
+    # salted SHA-512 hash as understood by chpasswd -e
+    rand = random.SystemRandom()
+    salt = "".join(rand.choice(SALT_CHARS) for i in range(16))
+    return crypt.crypt(new_pw.encode("utf-8"), "$6${0}$".format(salt))
 
 def add_user(username, secondary=[]):
     rc = 0
@@ -43,8 +76,71 @@ def add_user(username, secondary=[]):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.reload_user(username)
+        for groupname in secondary:
+            ACCOUNT_CACHE.add_members(groupname, [username])
     return rc
 
+def add_users(accounts):
+    # creates all (username, password) accounts with a single write to each of
+    # /etc/passwd and /etc/shadow, falls back to one account at a time
+    accounts = list(accounts)
+    if not accounts:
+        return []
+    defaults = useradd_defaults()
+    rand = random.SystemRandom()
+    lines = list()
+    for (username, new_pw) in accounts:
+        # newusers insists on hashing a plain text password itself, so it
+        # only receives a throwaway one here
+        throwaway = "".join(rand.choice(SALT_CHARS) for i in range(32))
+        lines.append(u"{0}:{1}::::{2}:{3}\n".format(username, throwaway,
+                os.path.join(defaults["HOME"], username), defaults["SHELL"]))
+    try:
+        execute_command(["newusers"], stdin=u"".join(lines).encode("utf-8"))
+    except (OSError, subprocess.CalledProcessError):
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"Batch creation of accounts failed, adding them one at a"\
+                u" time.")
+        rcs = list()
+        for (username, new_pw) in accounts:
+            # newusers may have created some of the accounts before it failed,
+            # those only lack their password and skeleton files
+            ACCOUNT_CACHE.reload_user(username)
+            try:
+                pw_entry = ACCOUNT_CACHE.getpwnam(username)
+            except KeyError:
+                rc = add_user(username)
+            else:
+                rc = 0
+                if os.path.isdir(defaults["SKEL"]) and\
+                        os.path.isdir(pw_entry.pw_dir) and\
+                        not os.listdir(pw_entry.pw_dir):
+                    tree_copy(defaults["SKEL"], pw_entry.pw_dir, pw_entry)
+            if rc == 0:
+                rc = add_password(username, new_pw)
+            rcs.append(rc)
+        return rcs
+    for (username, new_pw) in accounts:
+        ACCOUNT_CACHE.reload_user(username)
+    # newusers does not populate the home directories like useradd -m does
+    if os.path.isdir(defaults["SKEL"]):
+        for (username, new_pw) in accounts:
+            pw_entry = ACCOUNT_CACHE.getpwnam(username)
+            tree_copy(defaults["SKEL"], pw_entry.pw_dir, pw_entry)
+    # set all pre-hashed passwords in one go
+    lines = [u"{0}:{1}\n".format(username, hash_password(new_pw))\
+            for (username, new_pw) in accounts]
+    try:
+        execute_command(["chpasswd", "-e"], stdin=u"".join(lines).encode("utf-8"))
+    except (OSError, subprocess.CalledProcessError):
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"Batch update of passwords failed, setting them one at a"\
+                u" time.")
+        return [add_password(username, new_pw) for (username, new_pw) in accounts]
+    return [0] * len(accounts)
+
 def add_group(groupname):
     rc = 0
     try:
@@ -53,6 +149,8 @@ def add_group(groupname):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.reload_group(groupname)
     return rc
 
 def add_password(username, new_pw):
@@ -69,11 +167,12 @@ def add_password(username, new_pw):
     # TODO: error catching
     rc = 0
     try:
-        password = pexpect.spawn(u"passwd {0}".format(username))
-        for repeat in (1, 2):
-            password.expect(u"password: ")
-            password.sendline(new_pw)
-            time.sleep(0.1)
+        with span(u"exec passwd", forks=1):
+            password = pexpect.spawn(u"passwd {0}".format(username))
+            for repeat in (1, 2):
+                password.expect(u"password: ")
+                password.sendline(new_pw)
+                time.sleep(0.1)
     except Exception as err:
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(str(err))
@@ -88,19 +187,136 @@ def append_to_group(groupname, username):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.add_members(groupname, [username])
     return rc
 
-def kill_process(username, process):
-    # must not fail, i.e., user must exist on the system
+def append_all_to_group(groupname, usernames):
+    # the final member list is computed from one snapshot of the group and
+    # written in a single update of /etc/group and /etc/gshadow, the group is
+    # read again since the whole member list is replaced
+    rc = 0
+    ACCOUNT_CACHE.reload_group(groupname)
     try:
-        execute_command(["pkill", "-u", username, "-f", process])
+        members = list(ACCOUNT_CACHE.getgrnam(groupname).gr_mem)
+    except KeyError:
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"No such group '{0}'.".format(groupname))
+        return 1
+    current = set(members)
+    added = 0
+    for name in usernames:
+        if name not in current:
+            members.append(name)
+            current.add(name)
+            added += 1
+    if added == 0:
+        return rc
+    try:
+        execute_command(["gpasswd", "-M", ",".join(members), groupname])
     except subprocess.CalledProcessError as err:
+        LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
-    time.sleep(0.2)
-    # verify that indeed all processes have been terminated
-    if 0 == subprocess.call(["pgrep", "-u", username, "-f", process]):
-        LOGGER.warn(u"User '{0}' still has running notebook kernel(s).".format(
-                username))
+        rc = err.returncode
+    else:
+        ACCOUNT_CACHE.add_members(groupname, members)
+    return rc
+
+def find_processes(usernames, process):
+    # a single pass over /proc, maps the ID of every process of the given users
+    # whose command line contains process to the username
+    owners = dict()
+    for name in usernames:
+        try:
+            owners[ACCOUNT_CACHE.getpwnam(name).pw_uid] = name
+        except KeyError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+    matches = dict()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        path = os.path.join("/proc", entry)
+        try:
+            uid = os.stat(path).st_uid
+            if uid not in owners:
+                continue
+            with open(os.path.join(path, "cmdline"), "rb") as file_handle:
+                cmdline = file_handle.read().replace("\0", " ")
+        except (IOError, OSError):
+            # the process exited in the meantime
+            continue
+        if process in cmdline:
+            matches[int(entry)] = owners[uid]
+    return matches
+
+def kill_processes(usernames, process, timeout=KILL_TIMEOUT, known=None):
+    # terminates the matching processes of all users at once, known maps
+    # the IDs of supervised servers to usernames, whose whole process groups
+    # are terminated, returns an rc per username
+    matches = find_processes(usernames, process)
+    if known:
+        matches.update(known)
+    survivors = terminate_processes(matches, timeout, groups=known or ())
+    rcs = dict((name, 0) for name in usernames)
+    for pid in survivors:
+        rcs[matches[pid]] = 1
+    for name in usernames:
+        if rcs[name] != 0:
+            LOGGER.warn(u"User '{0}' still has running notebook kernel(s)."\
+                    .format(name))
+    return rcs
+
+def kill_process(username, process):
+    # must not fail, i.e., user must exist on the system
+    return kill_processes([username], process)[username]
+
+def active_ports(ports):
+    # the subset of the given local ports that have an established connection,
+    # reads the kernel's socket tables once
+    ports = set(int(port) for port in ports)
+    active = set()
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table, "rb") as file_handle:
+                lines = file_handle.readlines()[1:]
+        except IOError:
+            # e.g., no IPv6 support
+            LOGGER.debug(u"pssst:", exc_info=True)
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4 or fields[3] != TCP_ESTABLISHED:
+                continue
+            port = int(fields[1].rsplit(":", 1)[1], 16)
+            if port in ports:
+                active.add(port)
+    return active
+
+def process_stats(groups):
+    # a single pass over /proc, sums the resident memory (in bytes) and the
+    # CPU time (in seconds) of all processes in each of the process groups
+    groups = set(groups)
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    stats = dict()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", entry, "stat"), "rb") as file_handle:
+                line = file_handle.read()
+        except IOError:
+            # the process exited in the meantime
+            continue
+        # the command name may contain spaces and parentheses
+        fields = line[line.rindex(")") + 2:].split()
+        pgid = int(fields[2])
+        if pgid not in groups:
+            continue
+        (rss, cpu) = stats.get(pgid, (0, 0.0))
+        stats[pgid] = (rss + int(fields[21]) * page_size,
+                cpu + (int(fields[11]) + int(fields[12])) / ticks)
+    return stats
 
 def delete_user(username):
     rc = 0
@@ -111,6 +327,7 @@ def delete_user(username):
         execute_command(["passwd", "-d", username])
         # delete the user account
         execute_command(["userdel", "-r", username])
+        ACCOUNT_CACHE.remove_user(username)
         LOGGER.info(u"Removed user '%s'.", username)
     except subprocess.CalledProcessError as err:
         LOGGER.debug(u"pssst:", exc_info=True)
@@ -122,6 +339,7 @@ def delete_group(groupname):
     rc = 0
     try:
         execute_command(["groupdel", groupname])
+        ACCOUNT_CACHE.remove_group(groupname)
         LOGGER.info(u"Removed group '{0}'.".format(groupname))
     except subprocess.CalledProcessError as err:
         LOGGER.debug(u"pssst:", exc_info=True)
@@ -17,15 +17,16 @@ Utility Functions for Mac
 """
 
 
-__all__ = ["add_user", "add_group", "add_password", "append_to_group",
-        "kill_process", "delete_user", "delete_group"]
+__all__ = ["add_user", "add_users", "add_group", "add_password",
+        "append_to_group", "append_all_to_group", "find_processes",
+        "kill_process", "kill_processes", "active_ports", "process_stats",
+        "delete_user", "delete_group"]
 
 import logging
 import subprocess
-import grp
-import pwd
 
-from .genericutils import execute_command
+from .genericutils import (execute_command, terminate_processes, KILL_TIMEOUT,
+        ACCOUNT_CACHE)
 
 
 LOGGER = logging.getLogger()
@@ -39,7 +40,7 @@ class GetUID(object):
 
     def __init__(self, **kw_args):
         super(GetUID, self).__init__(**kw_args)
-        max_uid = max(pw_entry.pw_uid for pw_entry in pwd.getpwall())
+        max_uid = ACCOUNT_CACHE.max_uid()
         self.__class__.uid = max(self.__class__.uid, max_uid)
 
     def __call__(self):
@@ -55,7 +56,7 @@ class GetGID(object):
 
     def __init__(self, **kw_args):
         super(GetGID, self).__init__(**kw_args)
-        max_gid = max(gr_entry.gr_gid for gr_entry in grp.getgrall())
+        max_gid = ACCOUNT_CACHE.max_gid()
         self.__class__.gid = max(self.__class__.gid, max_gid)
 
     def __call__(self):
@@ -79,7 +80,7 @@ def add_user(username, secondary=[]):
         # set new unique user ID
         execute_command(["dscl", ".", "-create", user, "UniqueID", str(new_uid())])
         # set user's primary group ID property to be 'staff'
-        staff = grp.getgrnam("staff")
+        staff = ACCOUNT_CACHE.getgrnam("staff")
         execute_command(["dscl", ".", "-create", user, "PrimaryGroupID",
                 str(staff.gr_gid)])
         # set home directory
@@ -94,8 +95,23 @@ def add_user(username, secondary=[]):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.reload_user(username)
+        for group in secondary:
+            ACCOUNT_CACHE.add_members(group, [username])
     return rc
 
+def add_users(accounts):
+    # dscl offers no bulk interface, so (username, password) accounts are
+    # created one at a time
+    rcs = list()
+    for (username, new_pw) in accounts:
+        rc = add_user(username)
+        if rc == 0:
+            rc = add_password(username, new_pw)
+        rcs.append(rc)
+    return rcs
+
 def add_group(groupname):
     rc = 0
     group = "/Groups/{0}".format(groupname)
@@ -112,6 +128,8 @@ def add_group(groupname):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.reload_group(groupname)
     return rc
 
 def add_password(username, new_pw):
@@ -134,48 +152,134 @@ def append_to_group(groupname, username):
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
         rc = err.returncode
+    else:
+        ACCOUNT_CACHE.add_members(groupname, [username])
     return rc
 
-def pgrep(username, process):
-    pids = list()
+def append_all_to_group(groupname, usernames):
+    # the final member list is computed from one snapshot of the group and
+    # written in a single update of the directory service, the group is read
+    # again since the whole member list is replaced
+    rc = 0
+    ACCOUNT_CACHE.reload_group(groupname)
     try:
-        plist = execute_command(["ps", "-u", username, "-xo", "pid,command,args"])
+        members = list(ACCOUNT_CACHE.getgrnam(groupname).gr_mem)
+    except KeyError:
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"No such group '{0}'.".format(groupname))
+        return 1
+    current = set(members)
+    added = 0
+    for name in usernames:
+        if name not in current:
+            members.append(name)
+            current.add(name)
+            added += 1
+    if added == 0:
+        return rc
+    try:
+        execute_command(["dscl", ".", "-create", "/Groups/{0}".format(groupname),
+                "GroupMembership"] + members)
     except subprocess.CalledProcessError as err:
+        LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(err.output.strip())
-        return pids
+        rc = err.returncode
+    else:
+        ACCOUNT_CACHE.add_members(groupname, members)
+    return rc
+
+def find_processes(usernames, process):
+    # a single listing of all processes, maps the ID of every process of the
+    # given users whose command line contains process to the username
+    usernames = set(usernames)
+    matches = dict()
+    try:
+        plist = execute_command(["ps", "-axo", "pid=,user=,command="])
+    except subprocess.CalledProcessError as err:
+        LOGGER.warn(err.output.strip())
+        return matches
     for line in plist.split("\n"):
-        if process in line:
-            pids.append(int(line.split()[0]))
-    return pids
+        fields = line.split(None, 2)
+        if len(fields) < 3 or fields[1] not in usernames:
+            continue
+        if process in fields[2]:
+            matches[int(fields[0])] = fields[1]
+    return matches
+
+def kill_processes(usernames, process, timeout=KILL_TIMEOUT, known=None):
+    # terminates the matching processes of all users at once, known maps
+    # the IDs of supervised servers to usernames, whose whole process groups
+    # are terminated, returns an rc per username
+    matches = find_processes(usernames, process)
+    if known:
+        matches.update(known)
+    # processes that ignore SIGTERM are killed at the deadline
+    survivors = terminate_processes(matches, timeout, groups=known or ())
+    rcs = dict((name, 0) for name in usernames)
+    for pid in survivors:
+        rcs[matches[pid]] = 1
+    for name in usernames:
+        if rcs[name] != 0:
+            LOGGER.warn(u"User '{0}' still has running notebook kernel(s)."\
+                    .format(name))
+    return rcs
 
 def kill_process(username, process):
     # must not fail, i.e., user must exist on the system
-    for pid in pgrep(username, process):
-        try:
-            execute_command(["kill", str(pid)])
-        except subprocess.CalledProcessError as err:
-            LOGGER.warn(err.output.strip())
-    # force quit remaining matches
-#    nasties = pgrep(username, process)
-#    if not nasties:
-#        return
-#    for pid in nasties:
-#        try:
-#            execute_command(["kill", "-9", str(pid)])
-#        except subprocess.CalledProcessError as err:
-#            LOGGER.warn(err.output.strip())
-#    time.sleep(0.1)
-    # verify that indeed all processes have been terminated
-    if pgrep(username, process):
-        LOGGER.warn(u"User '{0}' still has running notebook kernel(s).".format(
-                username))
+    return kill_processes([username], process)[username]
+
+def active_ports(ports):
+    # the subset of the given local ports that have an established connection,
+    # lists all sockets once
+    ports = set(int(port) for port in ports)
+    active = set()
+    try:
+        listing = execute_command(["netstat", "-an", "-p", "tcp"])
+    except subprocess.CalledProcessError as err:
+        LOGGER.warn(err.output.strip())
+        return active
+    for line in listing.split("\n"):
+        fields = line.split()
+        if len(fields) < 6 or fields[5] != "ESTABLISHED":
+            continue
+        # local address, e.g., 127.0.0.1.8889 or *.8889
+        port = fields[3].rsplit(".", 1)[-1]
+        if port.isdigit() and int(port) in ports:
+            active.add(int(port))
+    return active
+
+def process_stats(groups):
+    # a single listing of all processes, sums the resident memory (in bytes)
+    # and the CPU time (in seconds) of all processes in each of the groups
+    groups = set(groups)
+    stats = dict()
+    try:
+        listing = execute_command(["ps", "-axo", "pgid=,rss=,time="])
+    except subprocess.CalledProcessError as err:
+        LOGGER.warn(err.output.strip())
+        return stats
+    for line in listing.split("\n"):
+        fields = line.split()
+        if len(fields) < 3 or int(fields[0]) not in groups:
+            continue
+        pgid = int(fields[0])
+        # [[days-]hours:]minutes:seconds
+        (days, sep, clock) = fields[2].rpartition("-")
+        cpu = 0.0
+        for part in clock.split(":"):
+            cpu = cpu * 60.0 + float(part)
+        if sep:
+            cpu += int(days) * 86400.0
+        (rss, total) = stats.get(pgid, (0, 0.0))
+        stats[pgid] = (rss + int(fields[1]) * 1024, total + cpu)
+    return stats
 
 def delete_user(username):
     rc = 0
     user = "/Users/{0}".format(username)
     try:
         # remove user from all secondary groups
-        groups = [group for group in grp.getgrall() if username in group.gr_mem]
+        groups = ACCOUNT_CACHE.groups_of(username)
 #        groups = execute_command(["dscl", ".", "-search", "/Groups", username])
         # id also returns system groups: unsuitable
 #        groups = execute_command(["id", "-nG", usr["username"]])
@@ -186,7 +290,7 @@ def delete_user(username):
 #                continue
             try:
                 execute_command(["dscl", ".", "-delete",
-                    "/Groups/{0}".format(group.gr_name), "GroupMembership",
+                    "/Groups/{0}".format(group), "GroupMembership",
                     username])
             except subprocess.CalledProcessError:
                 LOGGER.debug(u"pssst:", exc_info=True)
@@ -202,6 +306,7 @@ def delete_user(username):
         execute_command(["dscl", ".", "-delete", user])
         # delete home dir
         execute_command(["rm", "-rf", user])
+        ACCOUNT_CACHE.remove_user(username)
         LOGGER.info(u"Removed user '{0}'.".format(username))
     except subprocess.CalledProcessError as err:
         LOGGER.debug(u"pssst:", exc_info=True)
@@ -214,6 +319,7 @@ def delete_group(groupname):
     try:
         execute_command(["dscl", ".", "-delete",
                 "/Groups/{0}".format(groupname)])
+        ACCOUNT_CACHE.remove_group(groupname)
         LOGGER.info(u"Removed group '{0}'.".format(groupname))
     except subprocess.CalledProcessError as err:
         LOGGER.debug(u"pssst:", exc_info=True)
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+=====================
+Material Distribution
+=====================
+
+:File:
+    material.py
+"""
+
+
+__all__ = ["file_digest", "reflink", "build_manifest", "manifest_digest",
+        "pack_archive", "extract_member", "ContentStore", "Material"]
+
+
+import os
+import logging
+import hashlib
+import fcntl
+import fnmatch
+import shutil
+import tempfile
+import tarfile
+
+from contextlib import closing
+
+from .genericutils import (query_replace, read_state, write_state, make_dirs,
+        copy_file, create_file, submit_copy)
+from .tracing import span
+
+
+LOGGER = logging.getLogger()
+
+# ioctl request that shares the extents of one file with another (Linux)
+FICLONE = 0x40049409
+# files are read in chunks of this size
+CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """
+    Computes the SHA1 hex digest of a file's content.
+
+    Parameters
+    ----------
+    path: `str`
+        Location of the file.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def reflink(src, dst, pw_entry=None):
+    """
+    Creates a copy-on-write clone of a file.
+
+    Parameters
+    ----------
+    src: `str`
+        Location of the existing file.
+    dst: `str`
+        Location of the clone, must not exist yet.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the clone.
+
+    Returns
+    -------
+    `True` if the file system supports cloning and the clone was created,
+    `False` otherwise.
+    """
+    with open(src, "rb") as src_handle:
+        with create_file(dst) as dst_handle:
+            try:
+                fcntl.ioctl(dst_handle.fileno(), FICLONE, src_handle.fileno())
+                if pw_entry is not None:
+                    os.fchown(dst_handle.fileno(), pw_entry.pw_uid,
+                            pw_entry.pw_gid)
+            except (IOError, OSError):
+                LOGGER.debug(u"pssst:", exc_info=True)
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.remove(dst)
+    return cloned
+
+def build_manifest(root, previous=None, exclude=()):
+    """
+    Lists all files below a directory with their size, modification time, and
+    content digest.
+
+    Parameters
+    ----------
+    root: `str`
+        Root of the file path hierarchy.
+    previous: `dict` (optional)
+        An earlier manifest of the same directory. Digests of files whose size
+        and modification time did not change are taken from it instead of
+        reading the files again.
+    exclude: iterable (optional)
+        Directories that are left out, e.g., because they hold state files.
+
+    Returns
+    -------
+    A list of the relative paths of all directories and the manifest, a `dict`
+    mapping relative file paths to `dict`s with keys 'size', 'mtime', and
+    'sha1'.
+
+    Notes
+    -----
+    Ignores symlinks and mount points.
+    """
+    if previous is None:
+        previous = dict()
+    exclude = set(os.path.abspath(path) for path in exclude)
+    directories = list()
+    manifest = dict()
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        # ignoring links and mount points
+        dirnames[:] = [name for name in dirnames\
+                if not os.path.islink(os.path.join(dirpath, name)) and\
+                not os.path.ismount(os.path.join(dirpath, name)) and\
+                not os.path.abspath(os.path.join(dirpath, name)) in exclude]
+        for name in dirnames:
+            directories.append(os.path.relpath(os.path.join(dirpath, name),
+                    root))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            rel_path = os.path.relpath(path, root)
+            stat = os.stat(path)
+            entry = previous.get(rel_path)
+            if entry is None or entry["size"] != stat.st_size or\
+                    entry["mtime"] != stat.st_mtime:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime,
+                        "sha1": file_digest(path)}
+            manifest[rel_path] = entry
+    return (directories, manifest)
+
+def manifest_digest(manifest):
+    """
+    A digest that changes whenever a file is added to, removed from, or
+    modified in the manifest.
+    """
+    digest = hashlib.sha1()
+    for rel_path in sorted(manifest):
+        digest.update(rel_path.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(manifest[rel_path]["sha1"].encode("ascii"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def pack_archive(root, directories, manifest, archive_dir):
+    """
+    Packs the files of a manifest into a compressed archive unless an archive
+    of the same manifest exists already.
+
+    Next to the archive an index is written that lists its members with their
+    size and digest.
+
+    Parameters
+    ----------
+    root: `str`
+        Root of the file path hierarchy described by the manifest.
+    directories: `list`
+        Relative paths of all directories below root.
+    manifest: `dict`
+        A manifest as created by `build_manifest`.
+    archive_dir: `str`
+        Directory in which archives are kept, archives of other manifests are
+        removed from it.
+
+    Returns
+    -------
+    The location of the archive.
+    """
+    digest = manifest_digest(manifest)
+    location = os.path.join(archive_dir, u"{0}.tar.gz".format(digest))
+    if os.path.exists(location):
+        return location
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    (handle, tmp_name) = tempfile.mkstemp(dir=archive_dir)
+    os.close(handle)
+    try:
+        with closing(tarfile.open(tmp_name, "w:gz")) as archive:
+            for rel_path in sorted(directories):
+                archive.add(os.path.join(root, rel_path), arcname=rel_path,
+                        recursive=False)
+            for rel_path in sorted(manifest):
+                archive.add(os.path.join(root, rel_path), arcname=rel_path,
+                        recursive=False)
+        os.chmod(tmp_name, 0o600)
+        os.rename(tmp_name, location)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    write_state(os.path.join(archive_dir, u"{0}.json".format(digest)),
+            {"archive": os.path.basename(location), "directories": directories,
+            "files": manifest})
+    # archives of earlier manifests are not needed anymore
+    for name in os.listdir(archive_dir):
+        if not name.startswith(digest):
+            os.remove(os.path.join(archive_dir, name))
+    return location
+
+def extract_member(archive, member, dst_path, pw_entry=None):
+    """
+    Writes a regular file member of an archive that is read as a stream.
+
+    Parameters
+    ----------
+    archive: `tarfile.TarFile`
+        The opened archive.
+    member: `tarfile.TarInfo`
+        The current member of the archive.
+    dst_path: `str`
+        Location of the extracted file.
+    pw_entry: `passwd` entry (optional)
+        The user that should own the file. Ownership is changed on the open
+        file descriptor before any data is written.
+
+    Returns
+    -------
+    The number of bytes written.
+    """
+    src_handle = archive.extractfile(member)
+    with create_file(dst_path) as dst_handle:
+        if pw_entry is not None:
+            os.fchown(dst_handle.fileno(), pw_entry.pw_uid, pw_entry.pw_gid)
+        shutil.copyfileobj(src_handle, dst_handle, CHUNK_SIZE)
+        os.fchmod(dst_handle.fileno(), member.mode & 0o7777)
+    os.utime(dst_path, (member.mtime, member.mtime))
+    return member.size
+
+
+class ContentStore(object):
+    """
+    A directory that holds one read-only copy of each distinct file content,
+    named by the digest of that content.
+    """
+
+    def __init__(self, root, **kw_args):
+        super(ContentStore, self).__init__(**kw_args)
+        self.root = root
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+            os.chmod(self.root, 0o700)
+
+    def path(self, digest):
+        """
+        The location of the content with the given digest.
+        """
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def add(self, path, digest=None):
+        """
+        Adds the content of a file to the store unless present already.
+
+        Parameters
+        ----------
+        path: `str`
+            Location of the file.
+        digest: `str` (optional)
+            The digest of the file's content if known already.
+
+        Returns
+        -------
+        The digest of the content.
+        """
+        if digest is None:
+            digest = file_digest(path)
+        blob = self.path(digest)
+        if not os.path.exists(blob):
+            parent = os.path.dirname(blob)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            # a partially written blob must never appear under its name
+            (handle, tmp_name) = tempfile.mkstemp(dir=parent)
+            os.close(handle)
+            shutil.copyfile(path, tmp_name)
+            os.chmod(tmp_name, 0o444)
+            os.rename(tmp_name, blob)
+        return digest
+
+
+class Material(object):
+    """
+    The course material as it is delivered to each user during one run.
+
+    A manifest of the material directory is built once per run and a record
+    of the files delivered to each user is kept in the state directory. Only
+    new or changed files are delivered. A file that a user modified since the
+    last delivery, which is detected by its size and modification time, is
+    only replaced after confirmation.
+
+    In the 'copy' delivery mode every user receives a copy of each file. In
+    the 'link' mode the material is added to a content-addressed store and
+    users receive copy-on-write clones of the stored files, files matching the
+    read-only asset patterns are hardlinked to the store instead. Where
+    neither is possible a file is copied. In the 'archive' mode the material is
+    packed into a compressed archive once, which is reused until the manifest
+    changes, and the archive is extracted for every user.
+    """
+
+    def __init__(self, config, **kw_args):
+        super(Material, self).__init__(**kw_args)
+        self.root = config["material dir"]
+        self.mode = config["delivery"]
+        self.readonly = config["read-only assets"]
+        self.state_dir = config["state dir"]
+        # answers to 'All' or 'Zero' hold for the whole run
+        self.all_or_none = [False, False]
+        location = os.path.join(self.state_dir, "manifest.json")
+        previous = read_state(location, dict())
+        if previous.get("root") != os.path.abspath(self.root):
+            previous = dict()
+        (self.directories, self.manifest) = build_manifest(self.root,
+                previous.get("files"), [self.state_dir, config["store dir"]])
+        write_state(location, {"root": os.path.abspath(self.root),
+                "files": self.manifest})
+        self.store = None
+        self.archive = None
+        if self.mode == u"link":
+            self.store = ContentStore(config["store dir"])
+            for (rel_path, entry) in self.manifest.iteritems():
+                self.store.add(os.path.join(self.root, rel_path), entry["sha1"])
+        elif self.mode == u"archive":
+            self.archive = pack_archive(self.root, self.directories,
+                    self.manifest, os.path.join(self.state_dir, "archives"))
+
+    def is_readonly(self, rel_path):
+        """
+        Whether a file of the material is a read-only asset.
+        """
+        name = os.path.basename(rel_path)
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.readonly)
+
+    def record_location(self, username):
+        """
+        Location of the record of files delivered to a user.
+        """
+        return os.path.join(self.state_dir, "delivered",
+                u"{0}.json".format(username))
+
+    def deliver(self, dst, username=None, pw_entry=None):
+        """
+        Adds the material to a destination directory.
+
+        Parameters
+        ----------
+        dst: `str`
+            File path to which the material is added.
+        username: `str` (optional)
+            The user that receives the material. Without it, no record of the
+            delivery is kept and all existing files are treated as modified.
+        pw_entry: `passwd` entry (optional)
+            The user that should own the delivered files and created
+            directories, shared read-only assets stay with root.
+
+        Returns
+        -------
+        The number of entries (files and created directories) and bytes that
+        were delivered.
+        """
+        record = dict()
+        if username is not None:
+            record = read_state(self.record_location(username), dict())
+        entries = make_dirs(dst, pw_entry)
+        for rel_path in self.directories:
+            entries += make_dirs(os.path.join(dst, rel_path), pw_entry)
+        (wanted, delivered) = self._select(dst, record)
+        with span(u"deliver", mode=self.mode) as trace:
+            if self.archive is None:
+                (placed, num_bytes, error) = self._place_all(dst, wanted,
+                        pw_entry)
+            else:
+                (placed, num_bytes, error) = self._unpack(dst, wanted, pw_entry)
+            trace.update(files=len(placed), bytes=num_bytes)
+        for rel_path in placed:
+            stat = os.lstat(os.path.join(dst, rel_path))
+            delivered[rel_path] = {"size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "sha1": self.manifest[rel_path]["sha1"]}
+        entries += len(placed)
+        if username is not None:
+            write_state(self.record_location(username), delivered)
+        if error is not None:
+            raise error
+        return (entries, num_bytes)
+
+    def _select(self, dst, record):
+        # decide which files need to be delivered and keep the records of the
+        # others
+        wanted = list()
+        delivered = dict()
+        for rel_path in sorted(self.manifest):
+            entry = self.manifest[rel_path]
+            previous = record.get(rel_path)
+            dst_path = os.path.join(dst, rel_path)
+            if os.path.lexists(dst_path):
+                stat = os.lstat(dst_path)
+                untouched = previous is not None and\
+                        previous["size"] == stat.st_size and\
+                        previous["mtime"] == stat.st_mtime
+                if previous is not None and previous["sha1"] == entry["sha1"]:
+                    # nothing new for this file
+                    delivered[rel_path] = previous
+                    continue
+                if not untouched and\
+                        not query_replace(dst_path, self.all_or_none):
+                    if previous is not None:
+                        delivered[rel_path] = previous
+                    continue
+                os.remove(dst_path)
+            wanted.append(rel_path)
+        return (wanted, delivered)
+
+    def _place_all(self, dst, wanted, pw_entry):
+        # files are placed concurrently
+        pending = [(rel_path, submit_copy(self._place, rel_path,
+                os.path.join(dst, rel_path), pw_entry)) for rel_path in wanted]
+        # wait for all files to be placed before reporting the first failure
+        placed = list()
+        num_bytes = 0
+        error = None
+        for (rel_path, result) in pending:
+            try:
+                num_bytes += result.get()
+            except EnvironmentError as err:
+                LOGGER.debug(u"pssst:", exc_info=True)
+                if error is None:
+                    error = err
+                continue
+            placed.append(rel_path)
+        return (placed, num_bytes, error)
+
+    def _place(self, rel_path, dst_path, pw_entry):
+        src_path = os.path.join(self.root, rel_path)
+        if self.store is None:
+            return copy_file(src_path, dst_path, pw_entry)
+        blob = self.store.path(self.manifest[rel_path]["sha1"])
+        if self.is_readonly(rel_path):
+            try:
+                os.link(blob, dst_path)
+                return 0
+            except OSError:
+                # e.g., different file systems or too many links
+                LOGGER.debug(u"pssst:", exc_info=True)
+        if reflink(blob, dst_path, pw_entry):
+            num_bytes = 0
+        else:
+            num_bytes = copy_file(blob, dst_path, pw_entry)
+        # the blob is read-only, use the permissions of the original instead
+        shutil.copystat(src_path, dst_path)
+        return num_bytes
+
+    def _unpack(self, dst, wanted, pw_entry):
+        # stream through the archive once and write the wanted members
+        wanted = set(wanted)
+        placed = list()
+        num_bytes = 0
+        if not wanted:
+            return (placed, num_bytes, None)
+        try:
+            with closing(tarfile.open(self.archive, "r|gz")) as archive:
+                for member in archive:
+                    if not member.isfile() or member.name not in wanted:
+                        continue
+                    num_bytes += extract_member(archive, member,
+                            os.path.join(dst, member.name), pw_entry)
+                    placed.append(member.name)
+        except (EnvironmentError, tarfile.TarError) as err:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            return (placed, num_bytes, err)
+        return (placed, num_bytes, None)
@@ -21,15 +21,26 @@ import logging
 import sys
 import os
 import shutil
-import pwd
-import grp
-import subprocess
 import errno
 import random
 import codecs
+import time
+import threading
+import argparse
+import gzip
+import hashlib
+import json
+import socket
+import signal
 
 import nblauncher.genericutils as gutil
 
+from nblauncher.material import Material
+from nblauncher.supervisor import Registry, Supervisor, is_supervised,\
+        wait_until_ready
+from nblauncher.proxy import proxy_handlers
+from nblauncher.tracing import TRACER
+
 if os.uname()[0] == "Linux":
     import nblauncher.linuxutils as usrt
 elif os.uname()[0] == "Darwin":
@@ -38,105 +49,488 @@ else:
     raise StandardError("unkown operating system")
 
 from glob import glob
+from itertools import izip
+from contextlib import closing, contextmanager
+from cStringIO import StringIO
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 # non-standard but must for ipython notebook
 import tornado.ioloop
 import tornado.web
 import tornado.template
+import tornado.netutil
+import tornado.httpserver
+
+import IPython
 
 from IPython.utils.path import get_ipython_dir
 from IPython.lib import passwd
+from IPython.lib.security import passwd_check
 
 
 LOGGER = logging.getLogger()
 
+# serialises changes to the account databases between worker threads
+ACCOUNT_LOCK = threading.Lock()
+
+# stands in for the notebook password hash in the profile template
+PASSWORD_PLACEHOLDER = u"@NBLAUNCHER_PASSWORD@"
+
+
+################################################################################
+# Execution
+################################################################################
+
+
+class UserExecutor(object):
+    """
+    Runs a per-user function for every user in the database on a bounded pool
+    of worker threads.
+
+    Log records emitted while working on a particular user, including those of
+    the copy pool on the user's behalf, are held back and replayed in roster
+    order, such that the output reads as if the users had been processed one
+    after another.
+    """
+
+    def __init__(self, jobs=1, **kw_args):
+        super(UserExecutor, self).__init__(**kw_args)
+        self.jobs = max(1, int(jobs))
+        self._local = threading.local()
+
+    def filter(self, record):
+        """
+        Logging filter that buffers records emitted by a worker thread.
+        """
+        records = getattr(self._local, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    @contextmanager
+    def _buffer(self, records):
+        previous = getattr(self._local, "records", None)
+        self._local.records = records
+        try:
+            yield
+        finally:
+            self._local.records = previous
+
+    def inherit(self):
+        """
+        A context manager that buffers the records of another thread with those
+        of the user that the current thread works on.
+        """
+        return self._buffer(getattr(self._local, "records", None))
+
+    def _call(self, args):
+        (func, user, config) = args
+        self._local.records = list()
+        try:
+            with TRACER.user(user["username"]):
+                result = func(user, config)
+            error = None
+        except Exception as err:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            result = None
+            error = err
+        finally:
+            records = self._local.records
+            self._local.records = None
+        return (result, error, records)
+
+    def map(self, func, users, config):
+        """
+        Call `func(user, config)` for each user.
+
+        Parameters
+        ----------
+        func: callable
+            A per-user function such as `send_out`.
+        users: `list`
+            A list of dictionaries as parsed from the database describing
+            individual users.
+        config: `dict`
+            A dictionary as parsed from the configuration file.
+
+        Returns
+        -------
+        An iterator over tuples of user, the return value of `func` and the
+        exception raised by it (`None` if it succeeded) in roster order.
+        Exceptions do not affect the processing of any other user.
+        """
+        if not users:
+            return
+        if self.jobs == 1:
+            for usr in users:
+                (result, error, records) = self._call((func, usr, config))
+                yield (usr, result, error)
+            return
+        tasks = ((func, usr, config) for usr in users)
+        pool = ThreadPool(min(self.jobs, len(users)))
+        LOGGER.addFilter(self)
+        gutil.COPY_CONTEXTS.append(self.inherit)
+        try:
+            for (usr, (result, error, records)) in izip(users,
+                    pool.imap(self._call, tasks)):
+                # the main thread's records pass through the filter
+                for record in records:
+                    LOGGER.handle(record)
+                yield (usr, result, error)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            # all workers must be finished before the database is written
+            pool.join()
+            gutil.COPY_CONTEXTS.remove(self.inherit)
+            LOGGER.removeFilter(self)
+
 
 ################################################################################
 # Setup
 ################################################################################
 
 
-def create_user_environment(user, config):
+def generate_password(config):
     """
-    Sets up the user working directories as needed.
+    Generates a (weak) password using numbers and letters.
 
-    Creates a user account if necessary, creates a password for it, adds it to
-    a general usergroup, creates an IPython profile, and makes the user the
-    owner of those files and directories.
+    Parameters
+    ----------
+    config: `dict`
+        A dictionary as parsed from the configuration file.
+    """
+    return u"".join(random.choice(config["passwd selection"])\
+            for x in range(config["passwd length"]))
+
+def add_missing_users(config, missing):
+    """
+    Creates the system accounts of users that do not exist yet in one batch.
 
     Parameters
     ----------
-    user: `dict`
-        A dictionary as parsed from the database describing a user.
     config: `dict`
         A dictionary as parsed from the configuration file.
+    missing: `list`
+        A list of dictionaries as parsed from the database describing the
+        users without an account.
     """
-    # check for existance of user
-    try:
-        pw_entry = pwd.getpwnam(user["username"])
-    except KeyError:
-        # add a new user
-        rc = usrt.add_user(user["username"], [config["group"]])
-        if rc != 0:
-            return rc
-        # set the (weak) password using numbers, letters, and the exclamation
-        # mark
-        if not user["sys-pass"]:
-            user["sys-pass"] = u"".join(random.choice(config["passwd selection"])\
-                    for x in range(config["passwd length"]))
-            rc = usrt.add_password(user["username"], user["sys-pass"])
-            if rc != 0:
-                return rc
-    # should not fail now
-    pw_entry = pwd.getpwnam(user["username"])
-    # potentially add the user to the desired (supplementary) group
-    grp_entry = grp.getgrnam(config["group"])
-    if not user["nb-pass"]:
-        user["nb-pass"] = u"".join(random.choice(config["passwd selection"])\
-                for x in range(config["passwd length"]))
-    if not user["username"] in grp_entry.gr_mem:
-        usrt.append_to_group(config["group"], user["username"])
-    # create the ipython config
-    cmd = ["ipython", "profile", "create", config["profile"]]
-    try:
-        gutil.launch_as(pw_entry, cmd, pw_entry.pw_dir)
-    except subprocess.CalledProcessError as err:
-        LOGGER.debug(u"pssst:", exc_info=True)
-        LOGGER.warn(err.output.strip())
-        return err.returncode
-    # location of the ipython directory created with the profile
-    # get_ipython_dir currently returns different results for other users :S
-    cmd = ["ipython_dir"]
-    user_ipython_dir = gutil.launch_as(pw_entry, cmd, os.getcwd()).strip()
-    # if the specified profile exists we copy the contents
+    if not missing:
+        return
+    passwords = [usr["sys-pass"] or generate_password(config)\
+            for usr in missing]
+    with ACCOUNT_LOCK:
+        rcs = usrt.add_users(zip([usr["username"] for usr in missing],
+                passwords))
+    for (usr, new_pw, rc) in zip(missing, passwords, rcs):
+        if rc == 0:
+            usr["sys-pass"] = new_pw
+    LOGGER.info(u"Added {0:d} of {1:d} new user account(s).".format(
+            rcs.count(0), len(missing)))
+
+def template_key(config):
+    """
+    Identifies the inputs of the profile template, the IPython version, the
+    profile name, and the files of the local profile of the same name.
+    """
+    profile = "profile_{0}".format(config["profile"])
+    prfl_loc = os.path.join(get_ipython_dir(), profile)
+    parts = [IPython.__version__, config["profile"]]
+    for filename in sorted(glob(os.path.join(prfl_loc, "*.py")) +\
+            glob(os.path.join(prfl_loc, "startup", "*.py"))):
+        stat = os.stat(filename)
+        parts.append(u"{0}:{1:d}:{2!r}".format(filename, stat.st_size,
+                stat.st_mtime))
+    return hashlib.sha1(u"\n".join(parts).encode("utf-8")).hexdigest()
+
+def build_profile_template(config, staging):
+    """
+    Creates the IPython profile that is cloned for every user.
+
+    The profile is created once in a staging area, the `*.py` and
+    `startup/*.py` files of the local profile of the same name are copied into
+    it, and the notebook password in its configuration is replaced by a
+    placeholder.
+
+    Parameters
+    ----------
+    config: `dict`
+        A dictionary as parsed from the configuration file.
+    staging: `str`
+        Directory that is used as the IPython directory for the template.
+
+    Returns
+    -------
+    The path to the profile template.
+    """
+    cmd = ["ipython", "profile", "create", config["profile"],
+            "--ipython-dir={0}".format(staging)]
+    gutil.execute_command(cmd)
     profile = "profile_{0}".format(config["profile"])
+    tmpl_loc = os.path.join(staging, profile)
+    # if the specified profile exists we copy the contents
     prfl_loc = os.path.join(get_ipython_dir(), profile)
-    usr_prfl_loc = os.path.join(user_ipython_dir, profile)
     if os.path.exists(prfl_loc):
         # copy profile files
         for filename in glob(os.path.join(prfl_loc, "*.py")):
-            shutil.copy2(filename, usr_prfl_loc)
-            dst_file = os.path.join(usr_prfl_loc, os.path.basename(filename))
-            os.chown(dst_file, pw_entry.pw_uid, pw_entry.pw_gid)
+            shutil.copy2(filename, tmpl_loc)
         # copy startup files
+        startup = os.path.join(tmpl_loc, "startup")
+        if not os.path.exists(startup):
+            os.makedirs(startup)
         for filename in glob(os.path.join(prfl_loc, "startup", "*.py")):
-            shutil.copy2(filename, usr_prfl_loc)
-            dst_file = os.path.join(usr_prfl_loc, os.path.basename(filename))
-            os.chown(dst_file, pw_entry.pw_uid, pw_entry.pw_gid)
-    password = passwd(user["nb-pass"])
-    location = os.path.join(usr_prfl_loc, u"ipython_notebook_config.py")
-    with codecs.open(location, "rb", encoding="utf-8") as file_handle:
-        content = file_handle.readlines()
-    if content:
-        i = 0
-        for (i, line) in enumerate(content):
-            if line.find(u"c.NotebookApp.password") > -1:
-                break
-        content[i] = u"c.NotebookApp.password = u'{0}'".format(password)
+            shutil.copy2(filename, startup)
+    location = os.path.join(tmpl_loc, u"ipython_notebook_config.py")
+    content = list()
+    if os.path.exists(location):
+        with codecs.open(location, "rb", encoding="utf-8") as file_handle:
+            content = file_handle.readlines()
+    line = u"c.NotebookApp.password = u'{0}'\n".format(PASSWORD_PLACEHOLDER)
+    for (i, old) in enumerate(content):
+        if old.find(u"c.NotebookApp.password") > -1:
+            content[i] = line
+            break
+    else:
+        content.append(line)
     with codecs.open(location, "wb", encoding="utf-8") as file_handle:
         file_handle.writelines(content)
+    return tmpl_loc
+
+def clone_profile(template, user, pw_entry):
+    """
+    Copies the profile template into the IPython directory of a user and sets
+    their notebook password.
+
+    Parameters
+    ----------
+    template: `str`
+        Path to the profile template as created by `build_profile_template`.
+    user: `dict`
+        A dictionary as parsed from the database describing a user.
+    pw_entry: `passwd` entry
+        The user's entry of the `passwd` database.
+
+    Returns
+    -------
+    The hash of the notebook password in the profile.
+    """
+    user_ipython_dir = user["ipython-dir"]
+    gutil.make_dirs(user_ipython_dir, pw_entry)
+    usr_prfl_loc = os.path.join(user_ipython_dir, os.path.basename(template))
+    gutil.tree_copy(template, usr_prfl_loc, pw_entry)
+    # the copy in the user's directory is replaced, never read or written in
+    # place
+    source = os.path.join(template, u"ipython_notebook_config.py")
+    with codecs.open(source, "rb", encoding="utf-8") as file_handle:
+        content = file_handle.read()
+    hashed = passwd(user["nb-pass"])
+    content = content.replace(PASSWORD_PLACEHOLDER, hashed)
+    location = os.path.join(usr_prfl_loc, u"ipython_notebook_config.py")
+    with gutil.create_file(location) as file_handle:
+        os.fchown(file_handle.fileno(), pw_entry.pw_uid, pw_entry.pw_gid)
+        os.fchmod(file_handle.fileno(), os.stat(source).st_mode & 0o7777)
+        file_handle.write(content.encode("utf-8"))
+    return hashed
+
+
+class SetupState(object):
+    """
+    A snapshot of the accounts, the group, the home directories, and the
+    IPython profiles of the users in the database, and the difference to the
+    state that `setup` establishes.
+
+    The snapshot is taken once. The account databases are read once into the
+    account cache, and a profile is only cloned again if the template, the
+    notebook password, or the IPython directory of the user changed since it
+    was last cloned or if it was removed. The template itself is kept in the
+    state directory and only built again if its inputs changed.
+    """
+
+    def __init__(self, config, users, **kw_args):
+        super(SetupState, self).__init__(**kw_args)
+        self.config = config
+        self.users = users
+        self.staging = os.path.join(config["state dir"], "template")
+        self.template = os.path.join(self.staging,
+                "profile_{0}".format(config["profile"]))
+        self.key = template_key(config)
+        self.built = gutil.read_state(os.path.join(config["state dir"],
+                "template.json"), dict()).get("key")
+        if not os.path.isdir(self.template):
+            self.built = None
+        self.profiles = gutil.read_state(self.profiles_location(), dict())
+        # changes by others since the cache was loaded are picked up
+        cache = gutil.ACCOUNT_CACHE
+        cache.refresh()
+        self.accounts = dict()
+        for usr in users:
+            try:
+                self.accounts[usr["username"]] = cache.getpwnam(usr["username"])
+            except KeyError:
+                LOGGER.debug(u"pssst:", exc_info=True)
+        try:
+            self.members = set(cache.getgrnam(config["group"]).gr_mem)
+            self.has_group = True
+        except KeyError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            self.members = set()
+            self.has_group = False
+        self.missing = [usr for usr in users\
+                if usr["username"] not in self.accounts]
+        self.outsiders = [usr["username"] for usr in users\
+                if usr["username"] not in self.members]
+        self.homeless = [usr for usr in users\
+                if usr["username"] in self.accounts and\
+                not os.path.isdir(self.accounts[usr["username"]].pw_dir)]
+        homeless = set(usr["username"] for usr in self.homeless)
+        self.stale = set(usr["username"] for usr in users\
+                if usr["username"] in homeless or not self.is_current(usr))
+
+    def profiles_location(self):
+        """
+        Location of the record of the profiles cloned for each user.
+        """
+        return os.path.join(self.config["state dir"], "profiles.json")
+
+    def is_current(self, user):
+        """
+        Whether the profile of a user is the one that setup would clone now.
+        """
+        record = self.profiles.get(user["username"])
+        if record is None or record["template"] != self.key or\
+                not user["nb-pass"] or\
+                record["ipython-dir"] != user["ipython-dir"] or\
+                user["username"] not in self.accounts:
+            return False
+        location = os.path.join(user["ipython-dir"],
+                os.path.basename(self.template), u"ipython_notebook_config.py")
+        return os.path.isfile(location) and\
+                passwd_check(record["password"], user["nb-pass"])
+
+    def plan(self):
+        """
+        Describes the operations that `apply` and the per-user setup perform.
+
+        Returns
+        -------
+        A list of lines.
+        """
+        group = self.config["group"]
+        lines = list()
+        if not self.has_group:
+            lines.append(u"add group '{0}'".format(group))
+        if self.missing:
+            lines.append(u"add {0:d} account(s): {1}".format(len(self.missing),
+                    u", ".join(usr["username"] for usr in self.missing)))
+        if self.outsiders:
+            lines.append(u"add {0:d} user(s) to group '{1}': {2}".format(
+                    len(self.outsiders), group, u", ".join(self.outsiders)))
+        if self.homeless:
+            lines.append(u"create {0:d} missing home directory(ies): {1}"\
+                    .format(len(self.homeless), u", ".join(usr["username"]\
+                    for usr in self.homeless)))
+        if self.stale and self.built != self.key:
+            lines.append(u"build the template of profile '{0}'".format(
+                    self.config["profile"]))
+        if self.stale:
+            lines.append(u"clone the profile for {0:d} user(s): {1}".format(
+                    len(self.stale), u", ".join(usr["username"]\
+                    for usr in self.users if usr["username"] in self.stale)))
+        lines.append(u"deliver new or changed material to {0:d} user(s)"\
+                .format(len(self.users)))
+        return lines
+
+    def apply(self):
+        """
+        Performs the operations on the group, the accounts, the home
+        directories, and the template that concern all users at once.
+        """
+        group = self.config["group"]
+        if not self.has_group:
+            rc = usrt.add_group(group)
+            if rc != 0:
+                raise OSError("failed to add new group '{0}'".format(group))
+        # create all new accounts at once
+        add_missing_users(self.config, self.missing)
+        for usr in self.missing:
+            try:
+                self.accounts[usr["username"]] =\
+                        gutil.ACCOUNT_CACHE.getpwnam(usr["username"])
+            except KeyError:
+                LOGGER.debug(u"pssst:", exc_info=True)
+        # and make them members of the group in a single update, accounts that
+        # could not be created are left out
+        self.outsiders = [name for name in self.outsiders\
+                if name in self.accounts]
+        if self.outsiders:
+            with ACCOUNT_LOCK:
+                rc = usrt.append_all_to_group(group, self.outsiders)
+            if rc != 0:
+                LOGGER.warn(u"Failed to add users to group '{0}'."\
+                        .format(group))
+        for usr in self.homeless:
+            gutil.make_dirs(self.accounts[usr["username"]].pw_dir,
+                    self.accounts[usr["username"]])
+        # the ipython profile is created once and then cloned for every user
+        if self.stale and self.built != self.key:
+            if os.path.exists(self.staging):
+                shutil.rmtree(self.staging)
+            gutil.make_dirs(self.staging)
+            build_profile_template(self.config, self.staging)
+            gutil.write_state(os.path.join(self.config["state dir"],
+                    "template.json"), {"key": self.key})
+            self.built = self.key
+
+    def update_profile(self, user):
+        """
+        Clones the profile for a user unless it is current.
+        """
+        if user["username"] not in self.stale:
+            return
+        pw_entry = self.accounts[user["username"]]
+        if not user["nb-pass"]:
+            user["nb-pass"] = generate_password(self.config)
+        if not user["ipython-dir"]:
+            user["ipython-dir"] = gutil.user_ipython_dir(pw_entry)
+        hashed = clone_profile(self.template, user, pw_entry)
+        self.profiles[user["username"]] = {"template": self.key,
+                "ipython-dir": user["ipython-dir"], "password": hashed}
+
+    def save(self):
+        """
+        Writes the record of the cloned profiles.
+        """
+        gutil.write_state(self.profiles_location(), self.profiles)
+
+
+def setup_user(user, config, state, material=None):
+    """
+    Sets up the environment of a single user and sends the material to it.
 
-def setup(config, users):
+    Parameters
+    ----------
+    user: `dict`
+        A dictionary as parsed from the database describing a user.
+    config: `dict`
+        A dictionary as parsed from the configuration file.
+    state: `SetupState`
+        The snapshot of the state of all users after its `apply`.
+    material: `Material` (optional)
+        The material prepared for delivery to all users of a run.
+    """
+    if user["username"] not in state.accounts:
+        LOGGER.warn(u"User '{0}' has no account.".format(user["username"]))
+        return 1
+    state.update_profile(user)
+    send_out(user, config, material)
+    return 0
+
+def setup(config, users, executor=None, plan=False):
     """
     Adds a general usergroup, creates each student as a system user, creates
     IPython profile.
@@ -148,21 +542,38 @@ def setup(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Runs the per-user work, by default one user at a time.
+    plan: `bool` (optional)
+        Only report the operations that would be performed.
+
+    Notes
+    -----
+    Only the operations that are missing according to a `SetupState` snapshot
+    are performed, running setup again after adding users to the database
+    touches the new users only, apart from delivering changed material.
     """
-    # should add the group if it doesn't exist already
-    rc = usrt.add_group(config["group"])
-    if rc != 0:
-        raise OSError("failed to add new group '{0}'".format(config["group"]))
-    # create users in the list
-    # mac hack, because mac pwd database does not update
-    for usr in users:
-        if create_user_environment(usr, config) > 0:
-            LOGGER.warn(u"Failed to setup environment for user '{0}'.".format(
-                    usr["username"]))
-        else:
-            send_out(usr, config)
-            LOGGER.info(u"Setup environment for user '{0}'."\
-                    .format(usr["username"]))
+    if executor is None:
+        executor = UserExecutor()
+    state = SetupState(config, users)
+    if plan:
+        LOGGER.warn(u"Setup of {0:d} user(s) would:".format(len(users)))
+        for line in state.plan():
+            LOGGER.warn(u"  " + line)
+        return
+    state.apply()
+    material = Material(config)
+    try:
+        for (usr, rc, err) in executor.map(partial(setup_user, state=state,
+                material=material), users, config):
+            if err is not None or rc > 0:
+                LOGGER.warn(u"Failed to setup environment for user '{0}'."\
+                        .format(usr["username"]))
+            else:
+                LOGGER.info(u"Setup environment for user '{0}'."\
+                        .format(usr["username"]))
+    finally:
+        state.save()
 
 
 ################################################################################
@@ -170,7 +581,7 @@ def setup(config, users):
 ################################################################################
 
 
-def send_out(user, config):
+def send_out(user, config, material=None):
     """
     Copies material to user account and makes the user owner of it.
 
@@ -180,25 +591,29 @@ def send_out(user, config):
         A dictionary as parsed from the database describing a user.
     config: `dict`
         A dictionary as parsed from the configuration file.
+    material: `Material` (optional)
+        The material prepared for delivery to all users of a run.
     """
+    if material is None:
+        material = Material(config)
     # must not fail
-    pw_entry = pwd.getpwnam(user["username"])
+    pw_entry = gutil.ACCOUNT_CACHE.getpwnam(user["username"])
     # copy content of material dir into user directory
     destination_path = os.path.normpath(os.path.join(pw_entry.pw_dir,
             config["tutorial dir"]))
-    material = os.path.basename(config["material dir"])
-    if not material:
-        material = os.path.dirname(config["material dir"])
+    subdir = os.path.basename(config["material dir"])
+    if not subdir:
+        subdir = os.path.dirname(config["material dir"])
+    # the user owns the files as they are written
+    gutil.make_dirs(destination_path, pw_entry)
     try:
-        gutil.interactive_tree_copy(config["material dir"],
-                os.path.join(destination_path, material))
+        return material.deliver(os.path.join(destination_path, subdir),
+                user["username"], pw_entry)
     except shutil.Error:
         raise OSError(errno.ENOENT,
                 u"copying files for user '{0}' failed".format(user["username"]))
-    # change the owner of the files in the user directory
-    gutil.tree_chown(pw_entry, destination_path)
 
-def send(config, users):
+def send(config, users, executor=None):
     """
     Copy course material to user accounts.
 
@@ -209,13 +624,17 @@ def send(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Runs the per-user work, by default one user at a time.
     """
-    for usr in users:
-        try:
-            send_out(usr, config)
+    if executor is None:
+        executor = UserExecutor()
+    material = Material(config)
+    for (usr, _, err) in executor.map(partial(send_out, material=material),
+            users, config):
+        if err is None:
             LOGGER.info(u"Sent material to user '{0}'.".format(usr["username"]))
-        except OSError:
-            LOGGER.debug(u"pssst:", exc_info=True)
+        else:
             LOGGER.warn(u"Sending files to user '{0}' failed."\
                     .format(usr["username"]))
 
@@ -225,6 +644,525 @@ def send(config, users):
 ################################################################################
 
 
+# shown while a notebook server started on demand is coming up
+STARTING_PAGE = u"""<html>
+    <head>
+        <title>{{ mytitle }}</title>
+        {% if not failed %}<meta http-equiv="refresh" content="{{ interval }}">{% end %}
+    </head>
+    <body>
+        {% if failed %}
+        <p>Your notebook server could not be started. <a href="?retry=1">Try again</a>
+        or contact your instructor.</p>
+        {% else %}
+        <p>Starting your notebook server, this page reloads until it is
+        ready&hellip;</p>
+        {% end %}
+    </body>
+</html>
+"""
+# seconds between reloads of the page above
+STARTING_INTERVAL = 2
+# seconds between checks for idle notebook servers
+CULL_INTERVAL = 60
+# number of users listed per page of the website
+PAGE_SIZE = 50
+# maximum number of rendered pages of the website kept in memory
+PAGE_CACHE_SIZE = 256
+# seconds that a status poll waits for the ports to accept connections
+STATUS_PROBE_TIMEOUT = 2.0
+# files in the state directory that are shared with the portal workers
+SNAPSHOT_FILE = "portal.json"
+CONTROL_SOCKET = "portal.sock"
+# seconds between updates of the snapshot and between reads in the workers
+SNAPSHOT_INTERVAL = 0.25
+# maximum size of a message from a portal worker
+CONTROL_MESSAGE_SIZE = 1 << 16
+
+
+class InstanceTracker(object):
+    """
+    Keeps track of which notebook servers are ready and starts servers on
+    demand.
+
+    A server that is requested on demand is started and probed for readiness
+    in a background thread, the result is handed back to the IOLoop such that
+    all state is only changed from within the IOLoop.
+
+    The time of the last activity of each ready server is tracked, a server
+    counts as active while it has an established connection or, behind the
+    proxy, an open web socket. Servers that stay idle for longer than the
+    idle_timeout are culled, i.e., shut down just like by the shutdown
+    command, and started again on the next visit.
+    """
+
+    def __init__(self, config, users, supervisor, io_loop, **kw_args):
+        super(InstanceTracker, self).__init__(**kw_args)
+        self.config = config
+        self.users = users
+        self.supervisor = supervisor
+        self.io_loop = io_loop
+        self.by_name = dict((usr["username"], usr) for usr in users)
+        self.ready = set()
+        self.starting = set()
+        self.failed = set()
+        self.stopping = set()
+        self.culled = set()
+        self.last_activity = dict()
+        self.connections = dict()
+        # changes whenever the listed users or their links change
+        self.version = 0
+
+    def listed(self):
+        """
+        The users shown on the website, in roster order.
+        """
+        if self.config["on demand"]:
+            return self.users
+        return [usr for usr in self.users if usr["username"] in self.ready or\
+                usr["username"] in self.culled]
+
+    def link(self, user):
+        """
+        The address through which a user reaches their notebook server.
+        """
+        if self.config["on demand"] or user["username"] in self.culled:
+            return u"/start/{0}".format(user["username"])
+        return self.server_url(user)
+
+    def server_url(self, user):
+        """
+        The address of the notebook server of a user.
+        """
+        if self.config["proxy"]:
+            return u"/user/{0}/".format(user["username"])
+        return u"https://{0}:{1}".format(self.config["server"], user["port"])
+
+    def state(self, username):
+        """
+        The state of a user's notebook server.
+        """
+        for (name, group) in (("ready", self.ready),
+                ("starting", self.starting),
+                ("stopping", self.stopping),
+                ("culled", self.culled),
+                ("failed", self.failed)):
+            if username in group:
+                return name
+        return "stopped"
+
+    def touch(self, username):
+        """
+        Records activity of a user.
+        """
+        self.last_activity[username] = time.time()
+
+    def connect(self, username):
+        """
+        Records that a user opened a web socket.
+        """
+        self.connections[username] = self.connections.get(username, 0) + 1
+        self.touch(username)
+
+    def disconnect(self, username):
+        """
+        Records that a user closed a web socket.
+        """
+        self.connections[username] = max(0,
+                self.connections.get(username, 0) - 1)
+        self.touch(username)
+
+    def mark_ready(self, username):
+        """
+        Records that the server of a user accepts connections.
+        """
+        self.ready.add(username)
+        self.culled.discard(username)
+        self.version += 1
+        self.touch(username)
+
+    def request(self, username):
+        """
+        Starts the server of a user unless it is ready or starting already.
+        """
+        self.touch(username)
+        if username in self.ready or username in self.starting or\
+                username in self.stopping:
+            return
+        user = self.by_name[username]
+        self.failed.discard(username)
+        self.starting.add(username)
+        # stopping a stale server and forking may block for seconds
+        thread = threading.Thread(target=self._start, args=(user,))
+        thread.daemon = True
+        thread.start()
+
+    def _start(self, user):
+        try:
+            pid = launch_user_instance(user, self.config, self.supervisor)
+        except (OSError, KeyError):
+            LOGGER.debug(u"pssst:", exc_info=True)
+            LOGGER.warn(u"Failed to start notebook kernel(s) for user '{0}'."\
+                    .format(user["username"]))
+            self.io_loop.add_callback(partial(self._start_failed, user))
+            return
+        LOGGER.info(u"Started notebook kernel(s) for user '{0}' (PID {1})."\
+                .format(user["username"], pid))
+        self._probe(user)
+
+    def _start_failed(self, user):
+        self.starting.discard(user["username"])
+        self.failed.add(user["username"])
+
+    def _probe(self, user):
+        ready = wait_until_ready([user["port"]], self.config["ready timeout"],
+                tls=not self.config["proxy"])
+        self.io_loop.add_callback(partial(self._probed, user,
+                ready.get(int(user["port"]))))
+
+    def _probed(self, user, elapsed):
+        username = user["username"]
+        self.starting.discard(username)
+        if elapsed is None:
+            LOGGER.warn(u"Notebook server of user '{0}' did not become ready"\
+                    u" on port {1} within {2:g} s.".format(username,
+                    user["port"], self.config["ready timeout"]))
+            self.failed.add(username)
+        else:
+            LOGGER.info(u"Notebook server of user '{0}' ready after {1:.2f} s."\
+                    .format(username, elapsed))
+            self.mark_ready(username)
+
+    def watch(self):
+        """
+        Periodically culls idle servers from within the IOLoop.
+        """
+        if self.config["idle timeout"] <= 0:
+            return
+        interval = min(CULL_INTERVAL, self.config["idle timeout"])
+        tornado.ioloop.PeriodicCallback(self.cull, interval * 1000,
+                io_loop=self.io_loop).start()
+
+    def cull(self):
+        """
+        Updates the activity of all ready servers and shuts down idle ones.
+        """
+        ports = dict((int(self.by_name[name]["port"]), name)\
+                for name in self.ready)
+        now = time.time()
+        if self.config["proxy"]:
+            # the proxy's own upstream connections do not mean activity
+            active = [name for (name, count) in self.connections.iteritems()\
+                    if count > 0]
+        else:
+            active = [ports[port] for port in usrt.active_ports(ports)]
+        for name in active:
+            self.last_activity[name] = now
+        deadline = now - self.config["idle timeout"]
+        idle = [usr for usr in self.users if usr["username"] in self.ready and\
+                self.last_activity.get(usr["username"], now) < deadline]
+        if not idle:
+            return
+        for usr in idle:
+            LOGGER.info(u"Culling notebook server of user '{0}' after {1:.0f} s"\
+                    u" of inactivity.".format(usr["username"],
+                    now - self.last_activity[usr["username"]]))
+            self.ready.discard(usr["username"])
+            self.stopping.add(usr["username"])
+        self.version += 1
+        # the shutdown waits for the processes to exit
+        thread = threading.Thread(target=self._stop, args=(idle,))
+        thread.daemon = True
+        thread.start()
+
+    def _stop(self, users):
+        try:
+            shutdown(self.config, users)
+        finally:
+            self.io_loop.add_callback(partial(self._stopped, users))
+
+    def _stopped(self, users):
+        for usr in users:
+            self.stopping.discard(usr["username"])
+            self.culled.add(usr["username"])
+        self.version += 1
+
+
+class SharedTracker(InstanceTracker):
+    """
+    The view of a portal worker on the tracker of the launching process.
+
+    The state of the notebook servers is read from the snapshot that the
+    launching process publishes. Requests to start servers and reports of
+    activity are sent to it as datagrams.
+    """
+
+    def __init__(self, config, users, io_loop, **kw_args):
+        super(SharedTracker, self).__init__(config, users, None, io_loop,
+                **kw_args)
+        self.location = os.path.join(config["state dir"], SNAPSHOT_FILE)
+        self.control = os.path.join(config["state dir"], CONTROL_SOCKET)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.parent = os.getppid()
+        self.stamp = None
+        self.touched = set()
+        self.body = json.dumps({"updated": None, "users": []})
+
+    def send(self, **message):
+        """
+        Sends a message to the launching process.
+        """
+        try:
+            self.sock.sendto(json.dumps(message), self.control)
+        except socket.error:
+            LOGGER.debug(u"pssst:", exc_info=True)
+
+    def request(self, username):
+        """
+        Asks the launching process to start the server of a user.
+        """
+        if username in self.ready or username in self.starting or\
+                username in self.stopping:
+            return
+        self.send(start=username)
+        # until the next snapshot says otherwise
+        self.starting.add(username)
+
+    def touch(self, username):
+        """
+        Records activity of a user, which is reported in batches.
+        """
+        self.touched.add(username)
+
+    def connect(self, username):
+        """
+        Reports that a user opened a web socket.
+        """
+        self.send(connect=username)
+
+    def disconnect(self, username):
+        """
+        Reports that a user closed a web socket.
+        """
+        self.send(disconnect=username)
+
+    def watch(self):
+        """
+        Periodically reads the snapshot and reports activity.
+        """
+        self.refresh()
+        tornado.ioloop.PeriodicCallback(self.refresh, SNAPSHOT_INTERVAL * 1000,
+                io_loop=self.io_loop).start()
+
+    def refresh(self):
+        """
+        Reads the snapshot if it changed and reports activity.
+        """
+        if os.getppid() != self.parent:
+            # the launching process is gone
+            self.io_loop.stop()
+            return
+        if self.touched:
+            self.send(touch=sorted(self.touched))
+            self.touched.clear()
+        try:
+            stat = os.stat(self.location)
+        except OSError:
+            return
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if stamp == self.stamp:
+            return
+        snapshot = gutil.read_state(self.location)
+        if snapshot is None:
+            return
+        self.stamp = stamp
+        groups = dict((name, set()) for name in ("ready", "starting",
+                "stopping", "culled", "failed"))
+        for entry in snapshot["users"]:
+            if entry["state"] in groups:
+                groups[entry["state"]].add(entry["username"])
+        self.ready = groups["ready"]
+        self.starting = groups["starting"]
+        self.stopping = groups["stopping"]
+        self.culled = groups["culled"]
+        self.failed = groups["failed"]
+        self.body = json.dumps(snapshot["status"])
+        self.version += 1
+
+
+class PortalPublisher(object):
+    """
+    Shares the state of the notebook servers with the portal workers and
+    handles their messages.
+    """
+
+    def __init__(self, config, tracker, poller, workers, **kw_args):
+        super(PortalPublisher, self).__init__(**kw_args)
+        self.tracker = tracker
+        self.poller = poller
+        self.workers = list(workers)
+        self.location = os.path.join(config["state dir"], SNAPSHOT_FILE)
+        self.control = os.path.join(config["state dir"], CONTROL_SOCKET)
+        if os.path.exists(self.control):
+            os.remove(self.control)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.control)
+        # only the portal workers, running as root, may send messages
+        os.chmod(self.control, 0o600)
+        self.sock.setblocking(0)
+        self.published = None
+
+    def watch(self):
+        """
+        Handles messages and publishes snapshots from within the IOLoop.
+        """
+        io_loop = self.tracker.io_loop
+        io_loop.add_handler(self.sock.fileno(), self.receive, io_loop.READ)
+        self.publish()
+        tornado.ioloop.PeriodicCallback(self.publish, SNAPSHOT_INTERVAL * 1000,
+                io_loop=io_loop).start()
+
+    def publish(self):
+        """
+        Writes a new snapshot if the state of any server or the status report
+        changed.
+        """
+        users = [(usr["username"], usr["port"],
+                self.tracker.state(usr["username"]))\
+                for usr in self.tracker.users]
+        key = (users, self.poller.report["updated"])
+        if key != self.published:
+            gutil.write_state(self.location, {"users": [{"username": name,
+                    "port": port, "state": state} for (name, port, state)\
+                    in users], "status": self.poller.report})
+            self.published = key
+        for pid in list(self.workers):
+            try:
+                (done, status) = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done = pid
+                status = None
+            if done == pid:
+                LOGGER.warn(u"Portal worker {0:d} exited ({1}).".format(pid,
+                        status))
+                self.workers.remove(pid)
+
+    def receive(self, fd, events):
+        """
+        Handles all pending messages of the portal workers.
+        """
+        while True:
+            try:
+                data = self.sock.recv(CONTROL_MESSAGE_SIZE)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            try:
+                message = json.loads(data)
+            except ValueError:
+                LOGGER.debug(u"pssst:", exc_info=True)
+                continue
+            by_name = self.tracker.by_name
+            if message.get("start") in by_name:
+                self.tracker.request(message["start"])
+            if message.get("connect") in by_name:
+                self.tracker.connect(message["connect"])
+            if message.get("disconnect") in by_name:
+                self.tracker.disconnect(message["disconnect"])
+            for name in message.get("touch", []):
+                if name in by_name:
+                    self.tracker.touch(name)
+        # workers see the effect of their requests as soon as possible
+        self.publish()
+
+    def close(self):
+        """
+        Stops the portal workers and removes the control socket.
+        """
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                LOGGER.debug(u"pssst:", exc_info=True)
+        self.sock.close()
+        if os.path.exists(self.control):
+            os.remove(self.control)
+
+
+class PortalPage(object):
+    """
+    The rendered website, kept in memory together with a compressed copy and
+    an entity tag.
+
+    The listing can be searched and is split into pages of a fixed size. The
+    template is loaded once and pages are only rendered again when the listed
+    users or their links have changed since.
+    """
+
+    def __init__(self, title, server, tracker, **kw_args):
+        super(PortalPage, self).__init__(**kw_args)
+        self.title = title
+        self.server = server
+        self.tracker = tracker
+        loader = tornado.template.Loader(os.getcwd())
+        self.template = loader.load("template.html")
+        self.version = None
+        self.listed = list()
+        self.keys = list()
+        self.cache = dict()
+
+    def get(self, query=u"", page=1):
+        """
+        Returns the content of one page of the listing, its compressed form,
+        and its entity tag.
+
+        Parameters
+        ----------
+        query: `unicode` (optional)
+            Only users whose name or username contain it are listed.
+        page: `int` (optional)
+            The number of the page, starting at one.
+        """
+        if self.version != self.tracker.version:
+            self.listed = self.tracker.listed()
+            self.keys = [u" ".join([usr["name"], usr["surname"],
+                    usr["username"]]).lower() for usr in self.listed]
+            self.cache.clear()
+            self.version = self.tracker.version
+        query = query.strip().lower()
+        key = (query, page)
+        if key not in self.cache:
+            if len(self.cache) >= PAGE_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = self.render(query, page)
+        return self.cache[key]
+
+    def render(self, query, page):
+        """
+        Renders one page of the listing.
+        """
+        if query:
+            users = [usr for (usr, text) in izip(self.listed, self.keys)\
+                    if query in text]
+        else:
+            users = self.listed
+        pages = max(1, (len(users) + PAGE_SIZE - 1) // PAGE_SIZE)
+        page = min(max(1, page), pages)
+        users = users[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        links = dict((usr["username"], self.tracker.link(usr)) for usr in users)
+        content = self.template.generate(mytitle=self.title,
+                server_adress=self.server, users=users, links=links,
+                query=query, page=page, pages=pages)
+        buf = StringIO()
+        # a fixed time stamp keeps the compressed copy reproducible
+        with closing(gzip.GzipFile(fileobj=buf, mode="wb", mtime=0)) as gz_file:
+            gz_file.write(content)
+        etag = u'"{0}"'.format(hashlib.sha1(content).hexdigest())
+        return (content, buf.getvalue(), etag)
+
+
 class MainHandler(tornado.web.RequestHandler):
     """
     Tornado webserver subclass.
@@ -233,22 +1171,216 @@ class MainHandler(tornado.web.RequestHandler):
     handle http requests to those.
     """
 
-    def initialize(self, title, server, users):
+    def initialize(self, page):
         """
         This method negates the need for an __init__ method.
         """
-        loader = tornado.template.Loader(os.getcwd())
-        self.content = loader.load("template.html").generate(mytitle=title,
-                server_adress=server, users=users)
+        self.page = page
 
     def get(self):
         """
         Any http get requests will call this method.
         """
-        self.write(self.content)
+        try:
+            number = int(self.get_argument("page", u"1"))
+        except ValueError:
+            number = 1
+        (content, compressed, etag) = self.page.get(self.get_argument("q", u""),
+                number)
+        self.set_header("Etag", etag)
+        # browsers must ask again but may use their copy if it is unchanged
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Vary", "Accept-Encoding")
+        if etag in self.request.headers.get("If-None-Match", ""):
+            self.set_status(304)
+            return
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(compressed)
+        else:
+            self.write(content)
+
+    def compute_etag(self):
+        # set explicitly above
+        return None
+
+
+class StatusPoller(object):
+    """
+    Keeps a status report of all notebook servers in memory.
+
+    The report is refreshed in a background thread at a fixed interval. It
+    lists for each user the state known to the tracker, the port, whether the
+    port accepts connections, and the PID, resident memory, and CPU usage of
+    the server's process group.
+    """
+
+    def __init__(self, config, tracker, **kw_args):
+        super(StatusPoller, self).__init__(**kw_args)
+        self.config = config
+        self.tracker = tracker
+        self.busy = False
+        # process group -> (time, CPU seconds) of the previous poll
+        self.samples = dict()
+        self.report = {"updated": None, "users": []}
+        self.body = json.dumps(self.report)
+
+    def watch(self):
+        """
+        Periodically refreshes the report from within the IOLoop.
+        """
+        self.refresh()
+        tornado.ioloop.PeriodicCallback(self.refresh,
+                self.config["status interval"] * 1000,
+                io_loop=self.tracker.io_loop).start()
+
+    def refresh(self):
+        """
+        Starts a poll unless the previous one is still running.
+        """
+        if self.busy:
+            return
+        self.busy = True
+        # the tracker is only read from within the IOLoop
+        users = [(usr["username"], usr["port"],
+                self.tracker.state(usr["username"]),
+                self.tracker.last_activity.get(usr["username"]))\
+                for usr in self.tracker.users]
+        thread = threading.Thread(target=self._poll, args=(users,))
+        thread.daemon = True
+        thread.start()
+
+    def _poll(self, users):
+        try:
+            report = self.collect(users)
+        except Exception as err:
+            LOGGER.warn(u"Failed to collect the status of the notebook"\
+                    u" servers: {0}".format(err))
+            LOGGER.debug(u"pssst:", exc_info=True)
+            report = None
+        self.tracker.io_loop.add_callback(partial(self._update, report))
+
+    def collect(self, users):
+        """
+        Gathers the status of all users, probing all ports and reading all
+        process statistics at once.
+        """
+        now = time.time()
+        entries = self.tracker.supervisor.registry.load()
+        pids = dict((name, entry["pid"]) for (name, entry) in\
+                entries.iteritems() if is_supervised(entry))
+        stats = usrt.process_stats(pids.values())
+        listening = wait_until_ready([port for (name, port, _, _) in users\
+                if name in pids], STATUS_PROBE_TIMEOUT,
+                tls=not self.config["proxy"])
+        samples = dict()
+        report = list()
+        for (name, port, state, activity) in users:
+            pid = pids.get(name)
+            (rss, cpu) = stats.get(pid, (None, None))
+            usage = None
+            if cpu is not None:
+                samples[pid] = (now, cpu)
+                if pid in self.samples and now > self.samples[pid][0]:
+                    (then, before) = self.samples[pid]
+                    usage = round(100.0 * (cpu - before) / (now - then), 1)
+            report.append({"username": name, "state": state,
+                    "port": int(port) if port else None,
+                    "listening": port != u"" and int(port) in listening,
+                    "pid": pid, "rss": rss, "cpu": usage,
+                    "last_activity": activity})
+        self.samples = samples
+        return {"updated": now, "users": report}
+
+    def _update(self, report):
+        if report is None:
+            # keep the last known status but mark it as stale
+            report = dict(self.report, updated=None)
+        self.report = report
+        self.body = json.dumps(report)
+        self.busy = False
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    """
+    Serves the cached status report of all notebook servers as JSON.
+    """
+
+    def initialize(self, poller):
+        """
+        This method negates the need for an __init__ method.
+        """
+        self.poller = poller
+
+    def get(self):
+        """
+        Any http get requests will call this method.
+        """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(self.poller.body)
+
+
+class UserHandler(tornado.web.RequestHandler):
+    """
+    Sends a user straight to their notebook server.
+    """
+
+    def initialize(self, tracker):
+        """
+        This method negates the need for an __init__ method.
+        """
+        self.tracker = tracker
+
+    def get(self, username):
+        """
+        Any http get requests will call this method.
+        """
+        user = self.tracker.by_name.get(username)
+        if user is None:
+            raise tornado.web.HTTPError(404)
+        if username in self.tracker.ready:
+            self.redirect(self.tracker.server_url(user))
+        else:
+            self.redirect(u"/start/{0}".format(username))
+
 
+class StartHandler(tornado.web.RequestHandler):
+    """
+    Starts a user's notebook server on the first visit and redirects to it once
+    it accepts connections.
+    """
 
-def launch_user_instance(user, config):
+    def initialize(self, title, server, tracker):
+        """
+        This method negates the need for an __init__ method.
+        """
+        self.title = title
+        self.server = server
+        self.tracker = tracker
+
+    def get(self, username):
+        """
+        Any http get requests will call this method.
+        """
+        if username not in self.tracker.by_name:
+            raise tornado.web.HTTPError(404)
+        if username in self.tracker.ready:
+            self.redirect(self.tracker.server_url(self.tracker.by_name[username]))
+            return
+        if self.get_argument("retry", None):
+            self.tracker.failed.discard(username)
+            self.redirect(self.request.path)
+            return
+        if username not in self.tracker.failed:
+            self.tracker.request(username)
+        failed = username in self.tracker.failed
+        self.set_header("Cache-Control", "no-cache")
+        self.write(tornado.template.Template(STARTING_PAGE).generate(
+                mytitle=self.title, failed=failed, interval=STARTING_INTERVAL))
+
+
+def launch_user_instance(user, config, supervisor):
     """
     Launches an IPython Notebook for a specified user in an environment defined
     by config.
@@ -259,26 +1391,16 @@ def launch_user_instance(user, config):
         A dictionary as parsed from the database describing a user.
     config: `dict`
         A dictionary as parsed from the configuration file.
+    supervisor: `Supervisor`
+        Starts and watches the notebook server process.
     """
     # must not fail, should have been taken care of by setup script
-    pw_entry = pwd.getpwnam(user["username"])
-    # assume student user status and launch notebook
-    # because the notebook kernel runs inside of screen we cannot catch errors
-    # (unless we pipe the output into a file or we could pipe the commands and
-    # then detach, TODO)
-    args = ["screen", "-dmS", user["username"],
-            "ipython", "notebook",
-            "--ip", "'*'",
-            "--port", user["port"],
-            "--certfile", config["certificate"],
-            "--profile", config["profile"],
-#            "--pylab", "inline",
-            "--no-browser"]
-    cwd = os.path.join(pw_entry.pw_dir, config["launch dir"])
-    # should not fail
-    gutil.launch_as(pw_entry, args, cwd)
-
-def launch(config, users):
+    pw_entry = gutil.ACCOUNT_CACHE.getpwnam(user["username"])
+    # assume student user status and launch notebook, its output ends up in a
+    # log file in the state directory
+    return supervisor.start(user, pw_entry)
+
+def launch(config, users, executor=None):
     """
     Start notebook kernels for each user and launch a website from which to
     reach them.
@@ -290,26 +1412,173 @@ def launch(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Runs the per-user work, by default one user at a time.
 
     Notes
     -----
-    This process will continue to run indefinitely, ending it will cause the
-    webserver to be shut down but the notebook kernels to continue running.
+    The servers are started without waiting for each other and are then probed
+    concurrently until they accept TLS connections or the ready_timeout passes.
+    Only servers that became ready are listed on the website.
+
+    With on_demand enabled, no servers are started up front. Instead all users
+    are listed and a user's server is started when they first follow their
+    link, which shows a page that redirects to the server once it is ready.
+
+    With an idle_timeout, servers without connections for that long are shut
+    down and started again on demand on the next visit.
+
+    With proxy enabled, the notebook servers only listen on the loopback
+    interface and are reached through /user/<username>/ on the website, which
+    then uses TLS itself.
+
+    With more than one portal_workers, the website is served by that many
+    forked processes that share the listening socket. They read the state of
+    the notebook servers from a snapshot file and send requests to start
+    servers and reports of activity back through a datagram socket, while
+    this process keeps starting, supervising, and culling the servers.
+
+    This process will continue to run indefinitely and restarts notebook
+    servers that crash. Ending it will cause the webserver to be shut down but
+    the notebook kernels to continue running, unsupervised.
     """
-    # launch per-user notebook kernels
-    for (i, usr) in enumerate(users):
-        usr["port"] = str(config["port"] + 1 + i)
-        launch_user_instance(usr, config)
-        LOGGER.info(u"Started notebook kernel(s) for user '{0}'."\
-                .format(usr["username"]))
+    if executor is None:
+        executor = UserExecutor()
+    supervisor = Supervisor(config)
+    # the IOLoop is only created once the portal workers have been forked
+    tracker = InstanceTracker(config, users, supervisor, None)
+    # ports of servers that are still running from an earlier launch remain
+    # theirs, the supervisor replaces those servers
+    owned = dict((name, int(entry["port"])) for (name, entry) in\
+            supervisor.registry.load().iteritems() if is_supervised(entry))
+    (first, last) = config["port range"]
+    for usr in gutil.assign_ports(users, first, last, [config["port"]], owned):
+        LOGGER.info(u"Assigned port {0} to user '{1}'.".format(usr["port"],
+                usr["username"]))
+    if config["on demand"]:
+        LOGGER.warn(u"Notebook servers will be started on demand.")
+    else:
+        start_all(config, users, executor, tracker)
     # generate webserver with content
     LOGGER.warn("\nSpawning webserver at {0}:{1}\n".format(config["server"],
             config["port"]))
-    application = tornado.web.Application([(r"/", MainHandler,
-            dict(title=config["title"], server=config["server"],
-            users=users)),])
-    application.listen(config["port"])
-    tornado.ioloop.IOLoop.instance().start()
+    ssl_options = None
+    if config["proxy"]:
+        # the certificate file of the notebook contains the key, too
+        ssl_options = {"certfile": config["certificate"],
+                "keyfile": config["certificate"]}
+    workers = list()
+    if config["portal workers"] > 1:
+        sockets = tornado.netutil.bind_sockets(config["port"])
+        for i in range(config["portal workers"]):
+            pid = os.fork()
+            if pid == 0:
+                serve_portal(config, users, sockets, ssl_options)
+            workers.append(pid)
+        for sock in sockets:
+            sock.close()
+        LOGGER.info(u"Started {0:d} portal workers.".format(len(workers)))
+    io_loop = tornado.ioloop.IOLoop.instance()
+    tracker.io_loop = io_loop
+    poller = StatusPoller(config, tracker)
+    publisher = None
+    if workers:
+        publisher = PortalPublisher(config, tracker, poller, workers)
+        publisher.watch()
+    else:
+        application = tornado.web.Application(portal_handlers(config, tracker,
+                poller))
+        application.listen(config["port"], ssl_options=ssl_options)
+    supervisor.watch(io_loop)
+    tracker.watch()
+    poller.watch()
+    try:
+        io_loop.start()
+    finally:
+        if publisher is not None:
+            publisher.close()
+
+def portal_handlers(config, tracker, status):
+    """
+    The URL routes of the website.
+
+    Parameters
+    ----------
+    config: `dict`
+        A dictionary as parsed from the configuration file.
+    tracker: `InstanceTracker`
+        The state of the notebook servers.
+    status:
+        An object whose body attribute is the current status report.
+    """
+    options = dict(title=config["title"], server=config["server"],
+            tracker=tracker)
+    handlers = [
+            (r"/", MainHandler, dict(page=PortalPage(config["title"],
+                    config["server"], tracker))),
+            (r"/start/([^/]+)", StartHandler, options),
+            (r"/u/([^/]+)", UserHandler, dict(tracker=tracker)),
+            (r"/api/status", StatusHandler, dict(poller=status)),
+            ]
+    if config["proxy"]:
+        handlers.extend(proxy_handlers(tracker))
+    return handlers
+
+def serve_portal(config, users, sockets, ssl_options):
+    """
+    Runs a forked portal worker, never returns.
+    """
+    rc = 0
+    try:
+        io_loop = tornado.ioloop.IOLoop.instance()
+        tracker = SharedTracker(config, users, io_loop)
+        application = tornado.web.Application(portal_handlers(config, tracker,
+                tracker))
+        server = tornado.httpserver.HTTPServer(application,
+                ssl_options=ssl_options)
+        server.add_sockets(sockets)
+        tracker.watch()
+        io_loop.start()
+    except BaseException:
+        LOGGER.debug(u"pssst:", exc_info=True)
+        rc = 1
+    finally:
+        # must not return into the launching code, e.g., to write the database
+        logging.shutdown()
+        os._exit(rc)
+
+def start_all(config, users, executor, tracker):
+    """
+    Starts the notebook servers of all users and waits for them to become
+    ready.
+    """
+    # launch per-user notebook kernels
+    started = list()
+    for (usr, pid, err) in executor.map(partial(launch_user_instance,
+            supervisor=tracker.supervisor), users, config):
+        if err is None:
+            LOGGER.info(u"Started notebook kernel(s) for user '{0}' (PID {1})."\
+                    .format(usr["username"], pid))
+            started.append(usr)
+        else:
+            LOGGER.warn(u"Failed to start notebook kernel(s) for user '{0}'."\
+                    .format(usr["username"]))
+    # wait for the servers to come up
+    ready = wait_until_ready([usr["port"] for usr in started],
+            config["ready timeout"], tls=not config["proxy"])
+    for usr in started:
+        elapsed = ready.get(int(usr["port"]))
+        if elapsed is None:
+            LOGGER.warn(u"Notebook server of user '{0}' did not become ready"\
+                    u" on port {1} within {2:g} s.".format(usr["username"],
+                    usr["port"], config["ready timeout"]))
+            tracker.failed.add(usr["username"])
+        else:
+            LOGGER.info(u"Notebook server of user '{0}' ready after {1:.2f} s."\
+                    .format(usr["username"], elapsed))
+            tracker.mark_ready(usr["username"])
+    LOGGER.warn(u"{0:d} of {1:d} notebook servers are ready.".format(
+            len(tracker.ready), len(users)))
 
 
 ################################################################################
@@ -317,7 +1586,7 @@ def launch(config, users):
 ################################################################################
 
 
-def shutdown(config, users):
+def shutdown(config, users, executor=None):
     """
     Shutdown each user's notebook kernel(s).
 
@@ -328,11 +1597,28 @@ def shutdown(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Not used, all users are shut down together.
+
+    Notes
+    -----
+    The process table is read once for all users. All matching processes and
+    those recorded by the supervisor are asked to terminate at once and are
+    killed if they are still running after a shared deadline.
     """
+    usernames = [usr["username"] for usr in users]
+    # removing the entries first keeps the supervisor from restarting servers
+    entries = Registry(config["state dir"]).pop_all(usernames)
+    known = dict((entry["pid"], name) for (name, entry) in entries.iteritems()\
+            if is_supervised(entry))
+    rcs = usrt.kill_processes(usernames, "ipython notebook", known=known)
     for usr in users:
-        usrt.kill_process(usr["username"], "ipython notebook")
-        LOGGER.info(u"Shutdown notebook kernel(s) for user '{0}'."\
-                .format(usr["username"]))
+        if rcs[usr["username"]] == 0:
+            LOGGER.info(u"Shutdown notebook kernel(s) for user '{0}'."\
+                    .format(usr["username"]))
+        else:
+            LOGGER.warn(u"Failed to shutdown notebook kernel(s) for user"\
+                    u" '{0}'.".format(usr["username"]))
 
 
 ################################################################################
@@ -340,10 +1626,31 @@ def shutdown(config, users):
 ################################################################################
 
 
+def snapshot_name(user_storage):
+    """
+    Chooses a new, unique, and chronologically sortable snapshot name.
+
+    Parameters
+    ----------
+    user_storage: `str`
+        The directory that holds all snapshots of a user.
+    """
+    name = time.strftime("%Y-%m-%dT%H%M%S")
+    candidate = name
+    i = 0
+    while os.path.exists(os.path.join(user_storage, candidate)):
+        i += 1
+        candidate = u"{0}-{1:d}".format(name, i)
+    return candidate
+
 def retrieve_from(user, config):
     """
     Retrieve all data in the material directory of the user.
 
+    Each retrieval creates a new snapshot in the user's storage directory.
+    Files that did not change since the last snapshot are hardlinked to it
+    rather than copied. The file 'index.json' there lists all snapshots.
+
     Parameters
     ----------
     user: `dict`
@@ -353,7 +1660,7 @@ def retrieve_from(user, config):
     """
     # retrieve user generated material
     try:
-        pw_entry = pwd.getpwnam(user["username"])
+        pw_entry = gutil.ACCOUNT_CACHE.getpwnam(user["username"])
     except KeyError:
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(u"Failed to get passwd entry for '{0}'."\
@@ -361,27 +1668,39 @@ def retrieve_from(user, config):
         return
     source_path = os.path.normpath(os.path.join(pw_entry.pw_dir,
             config["tutorial dir"]))
-    material = os.path.basename(config["material dir"])
-    if not material:
-        material = os.path.dirname(config["material dir"])
-    dest_path = os.path.join(config["storage dir"], user["username"])
+    # the owner is given the files as they are copied
+    try:
+        owner_entry = gutil.ACCOUNT_CACHE.getpwnam(config["owner"])
+    except KeyError:
+        LOGGER.warn(u"Failed to get passwd entry for owner '{0}',"\
+                u" did you set it in the config file?".format(config["owner"]))
+        owner_entry = None
+    user_storage = os.path.join(config["storage dir"], user["username"])
+    gutil.make_dirs(user_storage, owner_entry)
+    index_location = os.path.join(user_storage, "index.json")
+    index = gutil.read_state(index_location, list())
+    previous = None
+    if index:
+        previous = os.path.join(user_storage, index[-1]["name"])
+        if not os.path.isdir(previous):
+            previous = None
+    name = snapshot_name(user_storage)
+    dest_path = os.path.join(user_storage, name)
     try:
-        gutil.tree_copy(source_path, dest_path)
+        (copied, linked, num_bytes) = gutil.tree_snapshot(source_path,
+                dest_path, previous, owner_entry)
     except shutil.Error:
         LOGGER.debug(u"pssst:", exc_info=True)
         LOGGER.warn(u"Retrieving files for user '{0}' failed."\
                 .format(user["username"]))
-    user["port"] = u""
-    # change the owner of the files in the storage directory
-    try:
-        owner_entry = pwd.getpwnam(config["owner"])
-    except KeyError:
-        LOGGER.warn(u"Failed to get passwd entry for owner '{0}',"\
-                u" did you set it in the config file?".format(config["owner"]))
-        return
-    gutil.tree_chown(owner_entry, dest_path)
+    else:
+        index.append({"name": name, "created": time.time(),
+                "copied": copied, "linked": linked, "bytes": num_bytes})
+        gutil.write_state(index_location, index)
+        if owner_entry is not None:
+            os.chown(index_location, owner_entry.pw_uid, owner_entry.pw_gid)
 
-def retrieve(config, users):
+def retrieve(config, users, executor=None):
     """
     Retrieve created files from users.
 
@@ -392,10 +1711,18 @@ def retrieve(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Runs the per-user work, by default one user at a time.
     """
-    for usr in users:
-        retrieve_from(usr, config)
-        LOGGER.info(u"Retrieved files from user '{0}'.".format(usr["username"]))
+    if executor is None:
+        executor = UserExecutor()
+    for (usr, _, err) in executor.map(retrieve_from, users, config):
+        if err is None:
+            LOGGER.info(u"Retrieved files from user '{0}'."\
+                    .format(usr["username"]))
+        else:
+            LOGGER.warn(u"Retrieving files for user '{0}' failed."\
+                    .format(usr["username"]))
 
 
 ################################################################################
@@ -403,7 +1730,28 @@ def retrieve(config, users):
 ################################################################################
 
 
-def remove(config, users):
+def remove_user(user, config):
+    """
+    Retrieve the files of a specified user and delete the account.
+
+    Parameters
+    ----------
+    user: `dict`
+        A dictionary as parsed from the database describing a user.
+    config: `dict`
+        A dictionary as parsed from the configuration file.
+    """
+    retrieve_from(user, config)
+    with ACCOUNT_LOCK:
+        rc = usrt.delete_user(user["username"])
+    if rc == 0:
+        user["sys-pass"] = ""
+        user["nb-pass"] = ""
+        # the port may be assigned to another user from now on
+        user["port"] = u""
+    return rc
+
+def remove(config, users, executor=None):
     """
     Remove all files and accounts of users listed in the database file.
 
@@ -414,16 +1762,18 @@ def remove(config, users):
     users: `list`
         A list of dictionaries as parsed from the database describing individual
         users.
+    executor: `UserExecutor` (optional)
+        Runs the per-user work, by default one user at a time.
     """
+    if executor is None:
+        executor = UserExecutor()
     choice = raw_input("Do you really want to remove the users '{0}'? (y/[n]):"\
             .format(", ".join(usr["username"] for usr in users)))
     if choice.lower() == "y":
-        for usr in users:
-            retrieve_from(usr, config)
-            rc = usrt.delete_user(usr["username"])
-            if rc == 0:
-                usr["sys-pass"] = ""
-                usr["nb-pass"] = ""
+        for (usr, rc, err) in executor.map(remove_user, users, config):
+            if err is not None:
+                LOGGER.warn(u"Failed to remove user '{0}'."\
+                        .format(usr["username"]))
     choice = raw_input("Do you really want to remove the group '{0}'? (y/[n]):"\
             .format(config["group"]))
     if choice.lower() == "y":
@@ -435,60 +1785,98 @@ def remove(config, users):
 ################################################################################
 
 
+COMMANDS = ["setup", "send", "launch", "shutdown", "retrieve", "remove"]
+
+
+def parse_arguments(argv):
+    """
+    Parses the command line arguments of `nblauncher`.
+
+    Parameters
+    ----------
+    argv: `list`
+        The command line arguments without the program name.
+    """
+    parser = argparse.ArgumentParser(prog="nblauncher",
+            description="account management for multiple ipython notebook users")
+    parser.add_argument("command", type=str.lower, choices=COMMANDS,
+            help="the function to perform for all users in the database")
+    parser.add_argument("config_file", nargs="?", default=u"notebooks.cfg",
+            help="path to the configuration file (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="number of users that are processed concurrently"\
+            " (default: %(default)s)")
+    parser.add_argument("--plan", action="store_true",
+            help="only show the changes that setup would make")
+    parser.add_argument("--trace", metavar="FILE",
+            help="where the timing trace of the run is written"\
+            " (default: trace-<command>.json in the state directory)")
+    return parser.parse_args(argv)
+
 def main(argv):
     """
     Handles configuration and user database parsing and writing, and calls
     chosen program function.
     """
+    args = parse_arguments(argv)
     # basic sanity checks
     # check for privileges
     if os.geteuid() != 0:
         raise StandardError("You need to have superuser privileges to run this script.")
     # existance of config file
-    if len(argv) == 2:
-        config_file = argv[1]
-    else:
-        config_file = u"notebooks.cfg"
+    config_file = args.config_file
     if not os.path.exists(config_file):
         raise IOError(errno.ENOENT, u"no such file '{0}'".format(config_file))
+    if args.jobs < 1:
+        raise ValueError(u"the number of jobs must be positive")
+    if args.plan and args.command != "setup":
+        raise ValueError(u"only setup can show a plan")
     # parse configuration
     config = gutil.parse_config(config_file)
     # get the list of notebook users
     (users, csv_dialect) = gutil.read_database(config["user list"])
+    executor = UserExecutor(args.jobs)
+    trace_file = args.trace
+    if trace_file is None:
+        trace_file = os.path.join(config["state dir"],
+                u"trace-{0}.json".format(args.command))
+    TRACER.reset()
     try:
         # call appropriate function
-        if argv[0].lower() == "setup":
-            setup(config, users)
-        elif argv[0].lower() == "send":
-            send(config, users)
-        elif argv[0].lower() == "launch":
-            launch(config, users)
-        elif argv[0].lower() == "shutdown":
-            shutdown(config, users)
-        elif argv[0].lower() == "retrieve":
-            retrieve(config, users)
-        elif argv[0].lower() == "remove":
-            remove(config, users)
+        if args.command == "setup":
+            setup(config, users, executor, args.plan)
+        elif args.command == "send":
+            send(config, users, executor)
+        elif args.command == "launch":
+            launch(config, users, executor)
+        elif args.command == "shutdown":
+            shutdown(config, users, executor)
+        elif args.command == "retrieve":
+            retrieve(config, users, executor)
+        elif args.command == "remove":
+            remove(config, users, executor)
         else:
-            raise ValueError(u"unrecognised option: '{0}'".format(argv[0]))
+            raise ValueError(u"unrecognised option: '{0}'".format(args.command))
     except BaseException as err:
         LOGGER.debug(u"pssst:", exc_info=True)
         raise err
     finally:
         # write user information
         gutil.write_database(config["user list"], users, csv_dialect)
+        trace = TRACER.trace(args.command)
+        try:
+            gutil.write_state(trace_file, trace)
+        except EnvironmentError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            LOGGER.warn(u"Could not write the trace file '{0}'.".format(
+                    trace_file))
+        TRACER.report(trace["summary"])
 
 
 def main_command():
     LOGGER.setLevel(logging.INFO)
 #    LOGGER.setLevel(logging.DEBUG)
     LOGGER.addHandler(logging.StreamHandler())
-    argc = len(sys.argv)
-    if argc < 2 or argc > 3:
-        LOGGER.critical(u"Usage:\nsudo python {0} <setup | send | launch |"\
-                u" shutdown | retrieve | remove>"\
-                u" [config file: path]".format(sys.argv[0]))
-        sys.exit(2)
     rec = 0
     try:
         main(sys.argv[1:])
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+====================
+Notebook Proxy Tools
+====================
+
+:File:
+    proxy.py
+"""
+
+
+__all__ = ["ProxyHandler", "WebSocketProxyHandler", "proxy_handlers"]
+
+
+import logging
+import socket
+
+import tornado.web
+import tornado.websocket
+
+from tornado import gen
+from tornado.httputil import HTTPHeaders
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+
+LOGGER = logging.getLogger()
+
+# headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP = frozenset(["connection", "keep-alive", "proxy-authenticate",
+        "proxy-authorization", "te", "trailer", "transfer-encoding", "upgrade",
+        "content-length"])
+# maximum number of concurrent requests to all notebook servers together
+MAX_UPSTREAM = 100
+# seconds that an upstream connection may take to be established
+CONNECT_TIMEOUT = 10.0
+# seconds that an upstream request may take in total
+REQUEST_TIMEOUT = 300.0
+# URLs below a user's prefix that are kernel or terminal web sockets
+WEBSOCKET_PATH = r"/(?:api/)?kernels/[^/]+/(?:shell|iopub|stdin|channels)"\
+        r"|/terminals/websocket/[^/]+"
+
+
+def upstream_url(scheme, user, uri):
+    """
+    The URL of a request on the notebook server of a user, which serves the
+    same paths as the portal below /user/<username>/.
+    """
+    return u"{0}://127.0.0.1:{1}{2}".format(scheme, user["port"], uri)
+
+def forward_headers(request):
+    """
+    Copies the end-to-end headers of a request and adds the forwarding ones.
+    """
+    headers = HTTPHeaders()
+    for (name, value) in request.headers.get_all():
+        if name.lower() not in HOP_BY_HOP:
+            headers.add(name, value)
+    headers["X-Forwarded-For"] = request.remote_ip
+    headers["X-Forwarded-Proto"] = request.protocol
+    headers["X-Real-Ip"] = request.remote_ip
+    return headers
+
+
+class ProxyHandler(tornado.web.RequestHandler):
+    """
+    Forwards HTTP requests below /user/<username>/ to that user's notebook
+    server and streams the responses back.
+    """
+
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH",
+            "OPTIONS")
+
+    def initialize(self, tracker):
+        """
+        This method negates the need for an __init__ method.
+        """
+        self.tracker = tracker
+        self._headers_received = False
+
+    @gen.coroutine
+    def get(self, username, path=None):
+        """
+        Any http requests will call this method.
+        """
+        user = self.tracker.by_name.get(username)
+        if user is None:
+            raise tornado.web.HTTPError(404)
+        if not path:
+            self.redirect(u"/user/{0}/".format(username))
+            return
+        if username not in self.tracker.ready:
+            # servers that are not running are started on demand
+            self.redirect(u"/start/{0}".format(username))
+            return
+        self.tracker.touch(username)
+        body = self.request.body
+        if not body and self.request.method not in ("POST", "PUT", "PATCH"):
+            body = None
+        request = HTTPRequest(upstream_url("http", user, self.request.uri),
+                method=self.request.method,
+                headers=forward_headers(self.request),
+                body=body,
+                follow_redirects=False,
+                decompress_response=False,
+                allow_nonstandard_methods=True,
+                connect_timeout=CONNECT_TIMEOUT,
+                request_timeout=REQUEST_TIMEOUT,
+                header_callback=self._on_header,
+                streaming_callback=self._on_chunk)
+        try:
+            yield AsyncHTTPClient().fetch(request)
+        except HTTPError as err:
+            # non-2xx responses have been streamed already
+            if err.code == 599 and not self._headers_received:
+                self._unreachable(username)
+        except (socket.error, IOError):
+            # e.g., the connection was refused
+            if not self._headers_received:
+                self._unreachable(username)
+        self.finish()
+
+    head = get
+    post = get
+    put = get
+    delete = get
+    patch = get
+    options = get
+
+    def _unreachable(self, username):
+        LOGGER.debug(u"pssst:", exc_info=True)
+        LOGGER.warn(u"Notebook server of user '{0}' is unreachable."\
+                .format(username))
+        raise tornado.web.HTTPError(502)
+
+    def _on_header(self, line):
+        line = line.strip()
+        if line.startswith("HTTP/"):
+            # a new status line, e.g., after '100 Continue', starts over
+            (_, code, reason) = (line.split(None, 2) + [""])[:3]
+            self._headers_received = True
+            self.clear()
+            for name in ("Content-Type", "Server"):
+                self.clear_header(name)
+            self.set_status(int(code), reason or None)
+        elif line:
+            (name, value) = line.split(":", 1)
+            if name.lower() not in HOP_BY_HOP:
+                self.add_header(name.strip(), value.strip())
+
+    def _on_chunk(self, chunk):
+        self.write(chunk)
+        self.flush()
+
+    def compute_etag(self):
+        # the notebook server sets its own
+        return None
+
+
+class WebSocketProxyHandler(tornado.websocket.WebSocketHandler):
+    """
+    Relays the messages of a kernel or terminal web socket between the browser
+    and the notebook server of a user.
+    """
+
+    def initialize(self, tracker):
+        """
+        This method negates the need for an __init__ method.
+        """
+        self.tracker = tracker
+        self.upstream = None
+        self.pending = list()
+
+    def open(self, username, path):
+        """
+        Called when the browser's web socket is established.
+        """
+        user = self.tracker.by_name.get(username)
+        if user is None or username not in self.tracker.ready:
+            self.close()
+            return
+        self.username = username
+        self.tracker.connect(username)
+        headers = forward_headers(self.request)
+        # the handshake with the notebook server is a new one
+        for name in list(headers.keys()):
+            if name.lower().startswith("sec-websocket-"):
+                del headers[name]
+        request = HTTPRequest(upstream_url("ws", user, self.request.uri),
+                headers=headers, connect_timeout=CONNECT_TIMEOUT)
+        self._relay(request)
+
+    @gen.coroutine
+    def _relay(self, request):
+        try:
+            self.upstream = yield tornado.websocket.websocket_connect(request)
+        except Exception:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            LOGGER.warn(u"Cannot connect web socket of user '{0}'."\
+                    .format(self.username))
+            self.close()
+            return
+        for message in self.pending:
+            self.upstream.write_message(message,
+                    binary=isinstance(message, bytes))
+        self.pending = None
+        while True:
+            message = yield self.upstream.read_message()
+            if message is None:
+                break
+            self.tracker.touch(self.username)
+            try:
+                self.write_message(message, binary=isinstance(message, bytes))
+            except tornado.websocket.WebSocketClosedError:
+                break
+        self.close()
+
+    def on_message(self, message):
+        """
+        Called for each message from the browser.
+        """
+        self.tracker.touch(self.username)
+        if self.upstream is None:
+            self.pending.append(message)
+            return
+        try:
+            self.upstream.write_message(message,
+                    binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            self.close()
+
+    def on_close(self):
+        """
+        Called when the browser's web socket is closed.
+        """
+        if hasattr(self, "username"):
+            self.tracker.disconnect(self.username)
+        if self.upstream is not None:
+            self.upstream.close()
+
+
+def proxy_handlers(tracker):
+    """
+    The URL routes of the proxy for a tornado Application.
+
+    Upstream connections are kept alive and reused if pycurl is available,
+    otherwise each request opens a new connection to the notebook server.
+    """
+    if pycurl is None:
+        AsyncHTTPClient.configure(None, max_clients=MAX_UPSTREAM)
+    else:
+        AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
+                max_clients=MAX_UPSTREAM)
+    options = dict(tracker=tracker)
+    return [
+            (r"/user/([^/]+)({0})".format(WEBSOCKET_PATH),
+                    WebSocketProxyHandler, options),
+            (r"/user/([^/]+)(/.*)?", ProxyHandler, options),
+            ]
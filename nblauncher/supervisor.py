@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+==========================
+Notebook Server Supervisor
+==========================
+
+:File:
+    supervisor.py
+"""
+
+
+__all__ = ["Registry", "Supervisor", "is_supervised", "stop_process",
+        "wait_until_ready"]
+
+
+import os
+import logging
+import errno
+import signal
+import socket
+import select
+import ssl
+import fcntl
+import time
+import codecs
+import threading
+import subprocess
+
+from contextlib import contextmanager
+from functools import partial
+
+import tornado.ioloop
+
+from .genericutils import (read_state, write_state, make_dirs, is_running,
+        terminate_processes, KILL_TIMEOUT)
+from .tracing import span
+
+
+LOGGER = logging.getLogger()
+
+# delay before the first restart of a crashed server, doubled with each
+# consecutive crash up to the maximum (in seconds)
+BACKOFF_START = 1.0
+BACKOFF_MAX = 60.0
+# a server that ran this long is considered to have started successfully
+STABLE_TIME = 30.0
+# interval in which the supervised processes are checked (in milliseconds)
+POLL_INTERVAL = 1000
+# delay between connection attempts to a server that is not yet up (in seconds)
+PROBE_INTERVAL = 0.25
+# maximum number of readiness probes in flight, which keeps the number of open
+# file descriptors well below the usual limit
+MAX_PROBES = 256
+
+
+def notebook_command(user, config):
+    """
+    The command line that starts the notebook server of a user.
+
+    The server must not fall back to another port than the assigned one, which
+    the portal and the readiness probes rely on.
+    """
+    if config["proxy"]:
+        # only reachable through the portal, which terminates TLS
+        base_url = u"/user/{0}/".format(user["username"])
+        return ["ipython", "notebook",
+                "--ip", "127.0.0.1",
+                "--port", user["port"],
+                "--profile", config["profile"],
+                "--NotebookApp.base_project_url={0}".format(base_url),
+                "--NotebookApp.base_kernel_url={0}".format(base_url),
+                "--NotebookApp.port_retries=0",
+                "--no-browser"]
+    return ["ipython", "notebook",
+            "--ip", "*",
+            "--port", user["port"],
+            "--certfile", config["certificate"],
+            "--profile", config["profile"],
+            "--NotebookApp.port_retries=0",
+            "--no-browser"]
+
+def is_supervised(entry):
+    """
+    Whether the process of a registry entry is still running as the recorded
+    user, which guards against process IDs that have been reused.
+    """
+    if not is_running(entry["pid"]):
+        return False
+    try:
+        return os.stat(u"/proc/{0:d}".format(entry["pid"])).st_uid == entry["uid"]
+    except OSError:
+        # no procfs, e.g., Mac OS X
+        return True
+
+def stop_process(pid, sig=signal.SIGTERM):
+    """
+    Sends a signal to the process group led by a supervised process.
+
+    Parameters
+    ----------
+    pid: `int`
+        ID of a process that was started in its own session.
+    sig: `int` (optional)
+        The signal to send.
+
+    Returns
+    -------
+    False if the process did not exist anymore, True otherwise.
+    """
+    try:
+        os.killpg(pid, sig)
+    except OSError as err:
+        if err.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+def wait_until_ready(ports, timeout, host="127.0.0.1",
+        interval=PROBE_INTERVAL, tls=True, limit=MAX_PROBES):
+    """
+    Probes many ports concurrently until each of them completes a TLS handshake
+    or the deadline passes.
+
+    All probes are multiplexed on non-blocking sockets in a single thread. At
+    most `limit` probes are in flight at any time, the remaining ports wait
+    their turn. A probe whose connection is refused or reset, or whose socket
+    cannot be created, is retried after a short interval.
+
+    Parameters
+    ----------
+    ports: iterable
+        The ports to probe.
+    timeout: `float`
+        Seconds after which probing ends.
+    host: `str` (optional)
+        The address at which the servers listen.
+    interval: `float` (optional)
+        Seconds between failed attempts on the same port.
+    tls: `bool` (optional)
+        Whether the servers speak TLS, otherwise a port is ready as soon as it
+        accepts connections.
+    limit: `int` (optional)
+        The maximum number of sockets that are open at the same time.
+
+    Returns
+    -------
+    A dictionary that maps each port that became ready to the seconds it took.
+    """
+    start = time.time()
+    deadline = start + timeout
+    # port -> next attempt, and file descriptor -> [port, socket, connected]
+    retry = dict((int(port), start) for port in ports)
+    active = dict()
+    ready = dict()
+    # unlike select, poll is not limited to file descriptors below FD_SETSIZE
+    poller = select.poll()
+
+    def close(fd):
+        poller.unregister(fd)
+        attempt = active.pop(fd)
+        attempt[1].close()
+        return attempt[0]
+
+    def fail(fd):
+        retry[close(fd)] = time.time() + interval
+
+    def handshake(fd):
+        attempt = active[fd]
+        try:
+            attempt[1].do_handshake()
+        except ssl.SSLError as err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                poller.modify(fd, select.POLLIN)
+            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                poller.modify(fd, select.POLLOUT)
+            else:
+                fail(fd)
+            return
+        except socket.error:
+            fail(fd)
+            return
+        ready[attempt[0]] = time.time() - start
+        close(fd)
+
+    def connect(port, now):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except socket.error:
+            # e.g., too many open files, try again later
+            LOGGER.debug(u"pssst:", exc_info=True)
+            retry[port] = now + interval
+            return
+        try:
+            sock.setblocking(0)
+            rc = sock.connect_ex((host, port))
+        except socket.error as err:
+            rc = err.errno
+        if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            retry[port] = now + interval
+            return
+        active[sock.fileno()] = [port, sock, False]
+        poller.register(sock.fileno(), select.POLLOUT)
+
+    while (retry or active) and time.time() < deadline:
+        now = time.time()
+        due = [port for (port, when) in retry.iteritems() if when <= now]
+        for port in due[:max(0, limit - len(active))]:
+            del retry[port]
+            connect(port, now)
+        wait = max(0.0, min(interval, deadline - time.time()))
+        if not active:
+            time.sleep(wait)
+            continue
+        try:
+            events = poller.poll(wait * 1000.0)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        for (fd, event) in events:
+            if fd not in active:
+                continue
+            attempt = active[fd]
+            if attempt[2]:
+                handshake(fd)
+                continue
+            if event & (select.POLLERR | select.POLLHUP) or\
+                    attempt[1].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                fail(fd)
+                continue
+            if not tls:
+                ready[attempt[0]] = time.time() - start
+                close(fd)
+                continue
+            # connected, the certificate is not verified since we only care
+            # that the server speaks TLS
+            try:
+                attempt[1] = ssl.wrap_socket(attempt[1],
+                        do_handshake_on_connect=False)
+            except (ssl.SSLError, socket.error):
+                fail(fd)
+                continue
+            attempt[2] = True
+            handshake(fd)
+    for fd in active.keys():
+        close(fd)
+    return ready
+
+class Registry(object):
+    """
+    Persistent record of the supervised notebook servers.
+
+    The registry is a directory in the state directory with one JSON file per
+    user that holds the process ID, port, and start time of their notebook
+    server, such that recording a single server does not rewrite the others.
+    It is shared between the launching process and later invocations, e.g.,
+    the shutdown command, and thus all changes happen under an exclusive lock.
+    """
+
+    def __init__(self, state_dir, **kw_args):
+        super(Registry, self).__init__(**kw_args)
+        self.root = os.path.join(state_dir, "processes")
+        make_dirs(self.root)
+        self._lock_location = os.path.join(state_dir, "processes.lock")
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_location, "a") as lock_handle:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_handle.fileno(), fcntl.LOCK_UN)
+
+    def location(self, username):
+        """
+        The file that holds the entry of a user.
+        """
+        return os.path.join(self.root, u"{0}.json".format(username))
+
+    def load(self):
+        """
+        Returns a copy of all entries.
+        """
+        entries = dict()
+        for name in os.listdir(self.root):
+            # skips files that are being written
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+            username = name[:-len(".json")]
+            entry = self.get(username)
+            if entry is not None:
+                entries[username] = entry
+        return entries
+
+    def get(self, username):
+        """
+        Returns the entry of a user or None.
+        """
+        return read_state(self.location(username))
+
+    def set(self, username, entry):
+        """
+        Adds or replaces the entry of a user.
+        """
+        with self._locked():
+            write_state(self.location(username), entry)
+
+    def _pop(self, username, pid=None):
+        entry = self.get(username)
+        if entry is None or (pid is not None and entry["pid"] != pid):
+            return None
+        try:
+            os.remove(self.location(username))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return entry
+
+    def pop(self, username, pid=None):
+        """
+        Removes and returns the entry of a user.
+
+        If a process ID is given, the entry is only removed if it still refers
+        to that process.
+        """
+        with self._locked():
+            return self._pop(username, pid)
+
+    def pop_all(self, usernames):
+        """
+        Removes and returns the entries of many users while holding the lock
+        once.
+        """
+        removed = dict()
+        with self._locked():
+            for name in usernames:
+                entry = self._pop(name)
+                if entry is not None:
+                    removed[name] = entry
+        return removed
+
+
+class Supervisor(object):
+    """
+    Starts the notebook servers as direct child processes and restarts them
+    when they exit unexpectedly.
+
+    Each server runs in its own session such that it and its kernels can be
+    signalled as one process group. Its output is written to a log file per
+    user in the state directory. A server that crashes is restarted with
+    exponential backoff. A server whose registry entry was removed, e.g., by
+    the shutdown command, is not restarted.
+    """
+
+    def __init__(self, config, **kw_args):
+        super(Supervisor, self).__init__(**kw_args)
+        self.config = config
+        self.registry = Registry(config["state dir"])
+        self.log_dir = os.path.join(config["state dir"], "logs")
+        make_dirs(self.log_dir)
+        # servers may be started from other threads than the IOLoop's
+        self._lock = threading.Lock()
+        self.children = dict()
+        self.users = dict()
+        self.failures = dict()
+        self.io_loop = None
+
+    def start(self, user, pw_entry):
+        """
+        Starts the notebook server of a user and records it in the registry.
+
+        A server of the user that is still running from an earlier launch is
+        stopped first and its process group is waited for, such that the port
+        is free again.
+
+        Parameters
+        ----------
+        user: `dict`
+            A dictionary as parsed from the database describing a user.
+        pw_entry: `passwd` entry
+            The user under which the server runs.
+
+        Returns
+        -------
+        The process ID of the server.
+        """
+        username = user["username"]
+        previous = self.registry.get(username)
+        if previous is not None and previous["pid"] not in self.children and\
+                is_supervised(previous):
+            pid = previous["pid"]
+            if terminate_processes([pid], KILL_TIMEOUT, groups=[pid]):
+                LOGGER.warn(u"Stale notebook server of user '{0}' survived"\
+                        u" SIGKILL.".format(username))
+            else:
+                LOGGER.info(u"Stopped stale notebook server of user '{0}'."\
+                        .format(username))
+        cwd = os.path.join(pw_entry.pw_dir, self.config["launch dir"])
+        env = os.environ.copy()
+        env["HOME"] = pw_entry.pw_dir
+        env["LOGNAME"] = pw_entry.pw_name
+        env["PWD"] = cwd
+        env["USER"] = pw_entry.pw_name
+        log_name = os.path.join(self.log_dir, u"{0}.log".format(username))
+        with codecs.open(log_name, "ab", encoding="utf-8") as log_handle,\
+                open(os.devnull, "rb") as null_handle:
+            log_handle.write(u"--- {0} starting on port {1}\n".format(
+                    time.strftime("%Y-%m-%d %H:%M:%S"), user["port"]))
+            log_handle.flush()
+            with span(u"spawn notebook", forks=1):
+                prcs = subprocess.Popen(notebook_command(user, self.config),
+                        cwd=cwd, env=env, stdin=null_handle,
+                        stdout=log_handle, stderr=subprocess.STDOUT,
+                        close_fds=True,
+                        preexec_fn=partial(self._prepare_child,
+                        pw_entry.pw_uid, pw_entry.pw_gid))
+        with self._lock:
+            self.children[prcs.pid] = (username, prcs)
+            self.users[username] = (user, pw_entry)
+        self.registry.set(username, {"pid": prcs.pid, "port": user["port"],
+                "started": time.time(), "uid": pw_entry.pw_uid})
+        return prcs.pid
+
+    @staticmethod
+    def _prepare_child(uid, gid):
+        # a session of its own keeps the server alive when the launching
+        # terminal goes away and makes its kernels one process group
+        os.setsid()
+        os.setgid(gid)
+        os.setuid(uid)
+
+    def poll(self):
+        """
+        Reaps exited servers and schedules the restart of crashed ones.
+        """
+        with self._lock:
+            children = self.children.items()
+        for (pid, (username, prcs)) in children:
+            if prcs.poll() is None:
+                continue
+            with self._lock:
+                del self.children[pid]
+            entry = self.registry.get(username)
+            if entry is None or entry["pid"] != pid:
+                LOGGER.info(u"Notebook server of user '{0}' was shut down."\
+                        .format(username))
+                continue
+            if time.time() - entry["started"] >= STABLE_TIME:
+                self.failures[username] = 0
+            failures = self.failures.get(username, 0)
+            delay = min(BACKOFF_MAX, BACKOFF_START * 2 ** failures)
+            self.failures[username] = failures + 1
+            LOGGER.warn(u"Notebook server of user '{0}' exited with status {1},"\
+                    u" restarting in {2:.0f} s.".format(username,
+                    prcs.returncode, delay))
+            if self.io_loop is None:
+                self._restart(username, pid)
+            else:
+                self.io_loop.add_timeout(time.time() + delay,
+                        partial(self._restart, username, pid))
+
+    def _restart(self, username, pid):
+        # the entry of the crashed server is kept until its restart, unless the
+        # server is shut down in the meantime
+        entry = self.registry.get(username)
+        if entry is None or entry["pid"] != pid:
+            return
+        try:
+            self.start(*self.users[username])
+        except OSError:
+            LOGGER.debug(u"pssst:", exc_info=True)
+            LOGGER.warn(u"Failed to restart notebook server of user '{0}'."\
+                    .format(username))
+
+    def watch(self, io_loop):
+        """
+        Supervises the servers from within a running tornado IOLoop.
+        """
+        self.io_loop = io_loop
+        tornado.ioloop.PeriodicCallback(self.poll, POLL_INTERVAL,
+                io_loop=io_loop).start()
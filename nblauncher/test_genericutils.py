@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+==============================
+Test Generic Utility Functions
+==============================
+
+:File:
+    test_genericutils.py
+"""
+
+
+import os
+import pwd
+import time
+import errno
+import signal
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+
+import nose.tools as nt
+
+from . import fakeutils as fake
+from .genericutils import assign_ports, AccountCache, tree_copy, make_dirs,\
+        terminate_processes
+
+
+# number of ports in the range that the tests assign from
+RANGE_SIZE = 50
+
+
+def listen():
+    # occupies a port on all interfaces until the socket is closed
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("", 0))
+    sock.listen(1)
+    return sock
+
+def stubborn(group=False):
+    # a child that ignores SIGTERM, optionally leading its own process group
+    def ignore():
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if group:
+            os.setsid()
+    child = subprocess.Popen(["sleep", "30"], preexec_fn=ignore)
+    # reaped right away, a zombie would count as running
+    thread = threading.Thread(target=child.wait)
+    thread.daemon = True
+    thread.start()
+    return (child, thread)
+
+def port_range(port):
+    if port + RANGE_SIZE <= 65535:
+        return (port, port + RANGE_SIZE)
+    return (port - RANGE_SIZE, port)
+
+
+def test_assign_ports():
+    sock = listen()
+    try:
+        busy = sock.getsockname()[1]
+        (first, last) = port_range(busy)
+        reserved = first if busy != first else last
+        users = [{"username": "keep", "port": u""},
+                {"username": "owner", "port": unicode(busy)},
+                {"username": "busy", "port": unicode(busy)},
+                {"username": "outside", "port": unicode(last + 1)},
+                {"username": "reserved", "port": unicode(reserved)},
+                {"username": "new", "port": u""}]
+        assign_ports(users[:1], first, last, [reserved])
+        kept = users[0]["port"]
+        changed = assign_ports(users, first, last, [reserved],
+                owned={"owner": busy})
+        ports = dict((usr["username"], int(usr["port"])) for usr in users)
+        nt.assert_equal(ports["keep"], int(kept))
+        # the server of the owner itself holds the port
+        nt.assert_equal(ports["owner"], busy)
+        nt.assert_equal(sorted(usr["username"] for usr in changed),
+                ["busy", "new", "outside", "reserved"])
+        nt.assert_equal(len(set(ports.itervalues())), len(users))
+        for port in ports.itervalues():
+            nt.assert_true(first <= port <= last)
+            nt.assert_not_equal(port, reserved)
+        # an assignment that is still valid stays the same
+        nt.assert_equal(assign_ports(users, first, last, [reserved],
+                owned={"owner": busy}), [])
+    finally:
+        sock.close()
+
+def test_exhausted_ports():
+    sock = listen()
+    try:
+        busy = sock.getsockname()[1]
+        users = [{"username": "foo", "port": u""}]
+        nt.assert_raises(ValueError, assign_ports, users, busy, busy)
+    finally:
+        sock.close()
+
+def test_account_cache():
+    root = tempfile.mkdtemp()
+    try:
+        fake.reset(root)
+        fake.add_group("labrats")
+        fake.add_user("foo", ["labrats"])
+        cache = AccountCache(passwd=fake, group=fake)
+        nt.assert_equal(cache.getpwnam("foo").pw_dir,
+                os.path.join(root, "foo"))
+        nt.assert_equal(cache.getgrnam("labrats").gr_mem, ["foo"])
+        nt.assert_equal(cache.groups_of("foo"), set(["labrats"]))
+        nt.assert_equal(cache.max_uid(), os.getuid())
+        # names missing from the snapshot are looked up individually
+        fake.add_user("bar")
+        nt.assert_equal(cache.getpwnam("bar").pw_name, "bar")
+        nt.assert_raises(KeyError, cache.getpwnam, "baz")
+        nt.assert_raises(KeyError, cache.getgrnam, "labtools")
+        # changes are recorded by the utilities
+        cache.add_members("labrats", ["bar", "foo"])
+        nt.assert_equal(cache.getgrnam("labrats").gr_mem, ["foo", "bar"])
+        nt.assert_equal(cache.groups_of("bar"), set(["labrats"]))
+        cache.remove_user("foo")
+        nt.assert_equal(cache.getgrnam("labrats").gr_mem, ["bar"])
+        nt.assert_equal(cache.groups_of("foo"), set())
+        cache.remove_group("labrats")
+        nt.assert_equal(cache.groups_of("bar"), set())
+        # otherwise they are only seen after a refresh
+        fake.delete_user("bar")
+        nt.assert_equal(cache.getpwnam("bar").pw_name, "bar")
+        cache.refresh()
+        nt.assert_raises(KeyError, cache.getpwnam, "bar")
+        nt.assert_equal(cache.getgrnam("labrats").gr_mem, ["foo"])
+        cache.reload_user("foo")
+        nt.assert_equal(cache.groups_of("foo"), set(["labrats"]))
+    finally:
+        fake.reset(None)
+        shutil.rmtree(root)
+
+def test_planted_symlinks():
+    root = tempfile.mkdtemp()
+    try:
+        pw_entry = pwd.getpwuid(os.getuid())
+        src = os.path.join(root, "src")
+        os.makedirs(os.path.join(src, "sub"))
+        with open(os.path.join(src, "config.py"), "wb") as file_handle:
+            file_handle.write(b"new")
+        secret = os.path.join(root, "secret")
+        with open(secret, "wb") as file_handle:
+            file_handle.write(b"secret")
+        os.chmod(secret, 0o640)
+        dst = os.path.join(root, "dst")
+        os.makedirs(dst)
+        os.symlink(secret, os.path.join(dst, "config.py"))
+        tree_copy(src, dst, pw_entry)
+        # the symlink is replaced, its target is left alone
+        nt.assert_false(os.path.islink(os.path.join(dst, "config.py")))
+        with open(os.path.join(dst, "config.py"), "rb") as file_handle:
+            nt.assert_equal(file_handle.read(), b"new")
+        with open(secret, "rb") as file_handle:
+            nt.assert_equal(file_handle.read(), b"secret")
+        nt.assert_equal(os.stat(secret).st_mode & 0o777, 0o640)
+        # directories are not descended into through a symlink
+        outside = os.path.join(root, "outside")
+        os.makedirs(outside)
+        shutil.rmtree(dst)
+        os.makedirs(dst)
+        os.symlink(outside, os.path.join(dst, "sub"))
+        with open(os.path.join(src, "sub", "notebook.ipynb"), "wb") as\
+                file_handle:
+            file_handle.write(b"notebook")
+        with nt.assert_raises(OSError) as context:
+            tree_copy(src, dst, pw_entry)
+        nt.assert_equal(context.exception.errno, errno.ELOOP)
+        nt.assert_equal(os.listdir(outside), [])
+        with nt.assert_raises(OSError):
+            make_dirs(os.path.join(dst, "sub"), pw_entry)
+        # without a user, e.g., for the state directory, symlinks are fine
+        nt.assert_equal(make_dirs(os.path.join(dst, "sub")), 0)
+    finally:
+        shutil.rmtree(root)
+
+def test_terminate_processes():
+    children = [stubborn(), stubborn(True), stubborn()]
+    polite = subprocess.Popen(["sleep", "30"])
+    waiter = threading.Thread(target=polite.wait)
+    waiter.daemon = True
+    waiter.start()
+    children.append((polite, waiter))
+    start = time.time()
+    survivors = terminate_processes([child.pid for (child, _) in children],
+            timeout=1.0, groups=[children[1][0].pid])
+    elapsed = time.time() - start
+    for (_, thread) in children:
+        thread.join(5.0)
+    nt.assert_equal(survivors, [])
+    # all processes share one deadline
+    nt.assert_true(1.0 <= elapsed < 2.5)
+    nt.assert_equal([child.returncode for (child, _) in children],
+            [-signal.SIGKILL, -signal.SIGKILL, -signal.SIGKILL,
+            -signal.SIGTERM])
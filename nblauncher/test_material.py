@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+===========================
+Test Material Distribution
+===========================
+
+:File:
+    test_material.py
+"""
+
+
+import os
+import shutil
+import tempfile
+
+import nose.tools as nt
+
+from . import genericutils as gutil
+from .material import build_manifest, manifest_digest, Material
+
+
+FILES = {"intro.ipynb": b"first notebook",
+        os.path.join("week1", "exercise.ipynb"): b"second notebook",
+        os.path.join("week1", "data", "logo.png"): b"an image"}
+
+
+def make_material(root):
+    for (rel_path, content) in FILES.iteritems():
+        path = os.path.join(root, rel_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as file_handle:
+            file_handle.write(content)
+
+def write_file(path, content, mtime=None):
+    with open(path, "wb") as file_handle:
+        file_handle.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def read_file(path):
+    with open(path, "rb") as file_handle:
+        return file_handle.read()
+
+def make_config(root, delivery=u"copy"):
+    config = {"material dir": os.path.join(root, "material"),
+            "state dir": os.path.join(root, "state"),
+            "store dir": os.path.join(root, "store"),
+            "delivery": delivery, "read-only assets": ["*.png"]}
+    make_material(config["material dir"])
+    return config
+
+def answer(replies):
+    # stands in for the console while asking whether to replace files
+    questions = list()
+    def raw_input(prompt):
+        questions.append(prompt)
+        return replies.pop(0)
+    gutil.raw_input = raw_input
+    return questions
+
+
+def test_build_manifest():
+    root = tempfile.mkdtemp()
+    try:
+        make_material(root)
+        os.symlink(os.path.join(root, "intro.ipynb"),
+                os.path.join(root, "link.ipynb"))
+        os.makedirs(os.path.join(root, "state"))
+        write_file(os.path.join(root, "state", "manifest.json"), b"{}")
+        (directories, manifest) = build_manifest(root,
+                exclude=[os.path.join(root, "state")])
+        nt.assert_equal(sorted(directories), ["week1",
+                os.path.join("week1", "data")])
+        nt.assert_equal(sorted(manifest), sorted(FILES))
+        entry = manifest["intro.ipynb"]
+        nt.assert_equal(entry["size"], len(FILES["intro.ipynb"]))
+        # unchanged size and modification time, the digest is not recomputed
+        previous = dict(manifest)
+        previous["intro.ipynb"] = dict(entry, sha1="cached")
+        (_, again) = build_manifest(root, previous,
+                [os.path.join(root, "state")])
+        nt.assert_equal(again["intro.ipynb"]["sha1"], "cached")
+        nt.assert_equal(manifest_digest(again), manifest_digest(previous))
+        # a modified file gets a new digest
+        write_file(os.path.join(root, "intro.ipynb"), b"changed notebook")
+        (_, changed) = build_manifest(root, previous,
+                [os.path.join(root, "state")])
+        nt.assert_not_equal(changed["intro.ipynb"]["sha1"], "cached")
+        nt.assert_not_equal(manifest_digest(changed),
+                manifest_digest(manifest))
+    finally:
+        shutil.rmtree(root)
+
+def test_delivery_modes():
+    for delivery in (u"copy", u"link", u"archive"):
+        yield check_delivery, delivery
+
+def check_delivery(delivery):
+    root = tempfile.mkdtemp()
+    try:
+        config = make_config(root, delivery)
+        material = Material(config)
+        dst = os.path.join(root, "home")
+        (entries, num_bytes) = material.deliver(dst, "foo")
+        # three files and the directories 'home', 'week1', and 'week1/data'
+        nt.assert_equal(entries, 6)
+        for (rel_path, content) in FILES.iteritems():
+            nt.assert_equal(read_file(os.path.join(dst, rel_path)), content)
+        if delivery == u"link":
+            # read-only assets are shared with the store
+            logo = os.path.join("week1", "data", "logo.png")
+            blob = material.store.path(material.manifest[logo]["sha1"])
+            nt.assert_equal(os.stat(os.path.join(dst, logo)).st_ino,
+                    os.stat(blob).st_ino)
+        # nothing new to deliver
+        nt.assert_equal(Material(config).deliver(dst, "foo"), (0, 0))
+    finally:
+        shutil.rmtree(root)
+
+def test_changed_material():
+    root = tempfile.mkdtemp()
+    try:
+        config = make_config(root)
+        dst = os.path.join(root, "home")
+        Material(config).deliver(dst, "foo")
+        source = os.path.join(config["material dir"], "intro.ipynb")
+        write_file(source, b"updated notebook", os.stat(source).st_mtime + 10)
+        questions = answer([])
+        try:
+            # the user did not touch the file, it is replaced without asking
+            nt.assert_equal(Material(config).deliver(dst, "foo")[0], 1)
+        finally:
+            del gutil.raw_input
+        nt.assert_equal(questions, [])
+        nt.assert_equal(read_file(os.path.join(dst, "intro.ipynb")),
+                b"updated notebook")
+    finally:
+        shutil.rmtree(root)
+
+def test_conflicting_changes():
+    for (reply, expected) in (("n", b"my solution"),
+            ("y", b"updated notebook")):
+        yield check_conflict, reply, expected
+
+def check_conflict(reply, expected):
+    root = tempfile.mkdtemp()
+    try:
+        config = make_config(root)
+        dst = os.path.join(root, "home")
+        Material(config).deliver(dst, "foo")
+        target = os.path.join(dst, "intro.ipynb")
+        write_file(target, b"my solution", os.stat(target).st_mtime + 10)
+        source = os.path.join(config["material dir"], "intro.ipynb")
+        write_file(source, b"updated notebook", os.stat(source).st_mtime + 10)
+        questions = answer([reply])
+        try:
+            Material(config).deliver(dst, "foo")
+        finally:
+            del gutil.raw_input
+        nt.assert_equal(len(questions), 1)
+        nt.assert_true(target in questions[0])
+        nt.assert_equal(read_file(target), expected)
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+===================
+Test Notebook Tools
+===================
+
+:File:
+    test_notebooks.py
+"""
+
+
+import os
+import time
+import getpass
+import shutil
+import socket
+import logging
+import tempfile
+
+import nose.tools as nt
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+
+from tornado.httpclient import AsyncHTTPClient
+
+from . import notebooks as nbl
+from . import fakeutils as fake
+from .benchmark import fake_backend
+
+
+# lists the users of a page and their links
+TEMPLATE = u"""{{ mytitle }} {{ page }}/{{ pages }}
+{% for usr in users %}{{ usr["username"] }} {{ links[usr["username"]] }}
+{% end %}"""
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the messages of all records that it handles.
+    """
+
+    def __init__(self, **kw_args):
+        logging.Handler.__init__(self, **kw_args)
+        self.messages = list()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class Tracker(object):
+    """
+    Lists all users and links them to a fixed location.
+    """
+
+    def __init__(self, users, **kw_args):
+        super(Tracker, self).__init__(**kw_args)
+        self.users = users
+        self.prefix = u"/start"
+        self.version = 0
+
+    def listed(self):
+        return self.users
+
+    def link(self, user):
+        return u"{0}/{1}".format(self.prefix, user["username"])
+
+
+def make_users(num):
+    return [{"username": u"user{0:d}".format(i), "name": u"Student",
+            "surname": u"{0:d}".format(i), "port": u""} for i in range(num)]
+
+def work(user, config):
+    # later users finish first
+    index = int(user["username"][4:])
+    nbl.LOGGER.warn(u"start {0}".format(user["username"]))
+    time.sleep(0.01 * (config["users"] - index))
+    if index == 2:
+        raise ValueError(u"failed {0}".format(user["username"]))
+    nbl.LOGGER.warn(u"end {0}".format(user["username"]))
+    return index
+
+
+def test_executor_order():
+    for jobs in (1, 4):
+        yield check_executor_order, jobs
+
+def check_executor_order(jobs):
+    users = make_users(6)
+    handler = RecordingHandler()
+    nbl.LOGGER.addHandler(handler)
+    try:
+        results = list(nbl.UserExecutor(jobs).map(work, users,
+                {"users": len(users)}))
+    finally:
+        nbl.LOGGER.removeHandler(handler)
+    nt.assert_equal([usr["username"] for (usr, _, _) in results],
+            [usr["username"] for usr in users])
+    nt.assert_equal([result for (_, result, _) in results],
+            [0, 1, None, 3, 4, 5])
+    nt.assert_true(isinstance(results[2][2], ValueError))
+    # the records of each user are replayed together and in roster order
+    expected = list()
+    for usr in users:
+        expected.append(u"start {0}".format(usr["username"]))
+        if usr["username"] != u"user2":
+            expected.append(u"end {0}".format(usr["username"]))
+    nt.assert_equal([msg for msg in handler.messages\
+            if msg.startswith((u"start", u"end"))], expected)
+
+def copy_work(user, config):
+    # later users finish first, in a thread of the copy pool
+    def task():
+        with nbl.TRACER.span(u"copy task"):
+            time.sleep(0.01 * (config["users"] - int(user["username"][4:])))
+            nbl.LOGGER.warn(u"copied {0}".format(user["username"]))
+    nbl.gutil.submit_copy(task).get()
+
+def test_copy_pool_context():
+    users = make_users(6)
+    handler = RecordingHandler()
+    nbl.LOGGER.addHandler(handler)
+    nbl.TRACER.reset()
+    try:
+        for (_, _, err) in nbl.UserExecutor(4).map(copy_work, users,
+                {"users": len(users)}):
+            nt.assert_is_none(err)
+    finally:
+        nbl.LOGGER.removeHandler(handler)
+    nt.assert_equal([msg for msg in handler.messages\
+            if msg.startswith(u"copied")],
+            [u"copied {0}".format(usr["username"]) for usr in users])
+    nt.assert_equal(sorted(record["user"] for record in nbl.TRACER.spans\
+            if record["phase"] == u"copy task"),
+            [usr["username"] for usr in users])
+    nt.assert_equal(nbl.gutil.COPY_CONTEXTS, [nbl.TRACER.inherit])
+    nbl.TRACER.reset()
+
+def make_page(tracker):
+    # the template is loaded from the working directory
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(root, "template.html"), "wb") as file_handle:
+            file_handle.write(TEMPLATE.encode("utf-8"))
+        os.chdir(root)
+        return nbl.PortalPage(u"Course", u"localhost", tracker)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+def listing(content):
+    # the page number, the number of pages, and the usernames
+    lines = content.decode("utf-8").strip().split(u"\n")
+    (page, pages) = lines[0].split()[1].split(u"/")
+    return (int(page), int(pages), [line.split()[0] for line in lines[1:]])
+
+def fetch_page(page, **headers):
+    io_loop = tornado.ioloop.IOLoop()
+    io_loop.make_current()
+    try:
+        app = tornado.web.Application([(r"/", nbl.MainHandler,
+                dict(page=page))])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(128)
+        sock.setblocking(0)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        url = "http://127.0.0.1:{0:d}/".format(sock.getsockname()[1])
+        client = AsyncHTTPClient(force_instance=True)
+        response = io_loop.run_sync(lambda: client.fetch(url, headers=headers,
+                decompress_response=False, raise_error=False), timeout=30)
+        client.close()
+        server.stop()
+        return response
+    finally:
+        tornado.ioloop.IOLoop.clear_current()
+        io_loop.close(all_fds=True)
+
+
+def test_portal_pagination():
+    users = make_users(2 * nbl.PAGE_SIZE + 1)
+    page = make_page(Tracker(users))
+    (number, pages, names) = listing(page.get()[0])
+    nt.assert_equal((number, pages), (1, 3))
+    nt.assert_equal(names, [usr["username"] for usr in\
+            users[:nbl.PAGE_SIZE]])
+    (number, pages, names) = listing(page.get(page=3)[0])
+    nt.assert_equal(number, 3)
+    nt.assert_equal(names, [users[-1]["username"]])
+    # pages outside of the listing are clamped
+    nt.assert_equal(listing(page.get(page=99)[0])[0], 3)
+    nt.assert_equal(listing(page.get(page=0)[0])[0], 1)
+
+def test_portal_search():
+    users = make_users(30)
+    users[7]["name"] = u"Ada"
+    users[7]["surname"] = u"Lovelace"
+    page = make_page(Tracker(users))
+    nt.assert_equal(listing(page.get(u" LOVELACE ")[0])[2], [u"user7"])
+    nt.assert_equal(listing(page.get(u"user1")[0])[2],
+            [u"user1"] + [u"user{0:d}".format(i) for i in range(10, 20)])
+    (number, pages, names) = listing(page.get(u"nobody")[0])
+    nt.assert_equal((number, pages, names), (1, 1, []))
+
+def test_portal_etag():
+    tracker = Tracker(make_users(3))
+    page = make_page(tracker)
+    (content, compressed, etag) = page.get()
+    # served from the cache until the tracker changes
+    nt.assert_equal(page.get()[2], etag)
+    tracker.prefix = u"/user"
+    tracker.version += 1
+    (changed, _, new_etag) = page.get()
+    nt.assert_not_equal(new_etag, etag)
+    nt.assert_true(u"/user/user0" in changed.decode("utf-8"))
+    response = fetch_page(page)
+    nt.assert_equal(response.code, 200)
+    nt.assert_equal(response.headers["Etag"], new_etag)
+    nt.assert_equal(response.body, changed)
+    response = fetch_page(page, **{"If-None-Match": new_etag})
+    nt.assert_equal(response.code, 304)
+    response = fetch_page(page, **{"If-None-Match": etag})
+    nt.assert_equal(response.code, 200)
+    response = fetch_page(page, **{"Accept-Encoding": "gzip"})
+    nt.assert_equal(response.headers["Content-Encoding"], "gzip")
+    nt.assert_equal(response.body, page.get()[1])
+
+class SlowSupervisor(object):
+    """
+    Takes its time to start a server, like one that stops a stale server first.
+    """
+
+    def __init__(self, delay, error=None, **kw_args):
+        super(SlowSupervisor, self).__init__(**kw_args)
+        self.delay = delay
+        self.error = error
+
+    def start(self, user, pw_entry):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return 1
+
+
+def run_request(supervisor, port):
+    # the user must exist since the server runs under that account
+    user = {"username": getpass.getuser(), "port": unicode(port)}
+    config = {"on demand": True, "proxy": True, "ready timeout": 5.0}
+    io_loop = tornado.ioloop.IOLoop()
+    try:
+        tracker = nbl.InstanceTracker(config, [user], supervisor, io_loop)
+        start = time.time()
+        tracker.request(user["username"])
+        blocked = time.time() - start
+        nt.assert_equal(tracker.state(user["username"]), "starting")
+        # the result arrives as a callback
+        deadline = time.time() + 10.0
+        while tracker.state(user["username"]) == "starting" and\
+                time.time() < deadline:
+            io_loop.add_timeout(time.time() + 0.05, io_loop.stop)
+            io_loop.start()
+        return (blocked, tracker.state(user["username"]))
+    finally:
+        io_loop.close(all_fds=True)
+
+def test_request_off_loop():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    try:
+        (blocked, state) = run_request(SlowSupervisor(0.5),
+                sock.getsockname()[1])
+        nt.assert_true(blocked < 0.25)
+        nt.assert_equal(state, "ready")
+        (blocked, state) = run_request(SlowSupervisor(0.5, OSError(1, "no")),
+                sock.getsockname()[1])
+        nt.assert_true(blocked < 0.25)
+        nt.assert_equal(state, "failed")
+    finally:
+        sock.close()
+
+def make_accounts(root, names):
+    # users of the database with a current profile record for each
+    users = [{"username": name, "sys-pass": u"", "nb-pass": u"secret",
+            "ipython-dir": os.path.join(root, name, ".ipython")}\
+            for name in names]
+    config = {"state dir": os.path.join(root, "state"), "profile": u"nbserver",
+            "group": u"students", "passwd selection": u"abc",
+            "passwd length": 4}
+    os.makedirs(config["state dir"])
+    key = nbl.template_key(config)
+    profiles = dict()
+    for usr in users:
+        location = os.path.join(usr["ipython-dir"], u"profile_nbserver")
+        os.makedirs(location)
+        with open(os.path.join(location, u"ipython_notebook_config.py"),
+                "wb") as file_handle:
+            file_handle.write(b"")
+        profiles[usr["username"]] = {"template": key,
+                "ipython-dir": usr["ipython-dir"],
+                "password": nbl.passwd(usr["nb-pass"])}
+    nbl.gutil.write_state(os.path.join(config["state dir"], "profiles.json"),
+            profiles)
+    return (config, users)
+
+def test_setup_state():
+    root = tempfile.mkdtemp()
+    try:
+        with fake_backend(os.path.join(root, "home"), getpass.getuser()):
+            (config, users) = make_accounts(os.path.join(root, "home"),
+                    ["member", "outsider", "homeless", "stale", "missing"])
+            fake.add_group("students")
+            for usr in users[:4]:
+                fake.add_user(usr["username"])
+            fake.append_all_to_group("students", ["member", "homeless",
+                    "stale"])
+            shutil.rmtree(os.path.join(root, "home", "homeless"))
+            profiles = nbl.gutil.read_state(os.path.join(config["state dir"],
+                    "profiles.json"))
+            profiles["stale"]["template"] = u"previous"
+            nbl.gutil.write_state(os.path.join(config["state dir"],
+                    "profiles.json"), profiles)
+            state = nbl.SetupState(config, users)
+            nt.assert_true(state.has_group)
+            nt.assert_equal([usr["username"] for usr in state.missing],
+                    ["missing"])
+            nt.assert_equal(state.outsiders, ["outsider", "missing"])
+            nt.assert_equal([usr["username"] for usr in state.homeless],
+                    ["homeless"])
+            nt.assert_equal(state.stale, set(["homeless", "stale", "missing"]))
+            nt.assert_true(state.is_current(users[0]))
+            # a changed notebook password makes the profile stale, too
+            users[1]["nb-pass"] = u"changed"
+            nt.assert_false(state.is_current(users[1]))
+    finally:
+        shutil.rmtree(root)
+
+def test_setup_plan():
+    root = tempfile.mkdtemp()
+    handler = RecordingHandler(level=logging.WARN)
+    nbl.LOGGER.addHandler(handler)
+    try:
+        with fake_backend(os.path.join(root, "home"), getpass.getuser()):
+            (config, users) = make_accounts(os.path.join(root, "home"),
+                    ["current", "missing"])
+            fake.add_user("current")
+            nbl.setup(config, users, plan=True)
+            # nothing is changed
+            nt.assert_raises(KeyError, fake.getgrnam, "students")
+            nt.assert_raises(KeyError, fake.getpwnam, "missing")
+    finally:
+        nbl.LOGGER.removeHandler(handler)
+        shutil.rmtree(root)
+    nt.assert_equal(handler.messages, [u"Setup of 2 user(s) would:",
+            u"  add group 'students'",
+            u"  add 1 account(s): missing",
+            u"  add 2 user(s) to group 'students': current, missing",
+            u"  build the template of profile 'nbserver'",
+            u"  clone the profile for 1 user(s): missing",
+            u"  deliver new or changed material to 2 user(s)"])
+
+def test_failed_accounts():
+    root = tempfile.mkdtemp()
+    add_users = fake.add_users
+    # the account of the first new user cannot be created
+    fake.add_users = lambda accounts: [1] + add_users(accounts[1:])
+    try:
+        with fake_backend(os.path.join(root, "home"), getpass.getuser()):
+            (config, users) = make_accounts(os.path.join(root, "home"),
+                    ["failed", "added"])
+            state = nbl.SetupState(config, users)
+            # the template is current
+            state.built = state.key
+            state.apply()
+            nt.assert_equal(sorted(state.accounts), ["added"])
+            nt.assert_equal(state.outsiders, ["added"])
+            nt.assert_equal(fake.getgrnam("students").gr_mem, ["added"])
+            nt.assert_not_equal(users[1]["sys-pass"], u"")
+            nt.assert_equal(users[0]["sys-pass"], u"")
+    finally:
+        fake.add_users = add_users
+        shutil.rmtree(root)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+================
+Test Proxy Tools
+================
+
+:File:
+    test_proxy.py
+"""
+
+
+import socket
+
+import nose.tools as nt
+import tornado.web
+import tornado.ioloop
+import tornado.httpserver
+
+from tornado.httpclient import AsyncHTTPClient
+
+from .proxy import proxy_handlers
+
+
+class Tracker(object):
+    """
+    Knows a single user whose notebook server is considered to be running.
+    """
+
+    def __init__(self, port, **kw_args):
+        super(Tracker, self).__init__(**kw_args)
+        self.by_name = {"foo": {"username": "foo", "port": str(port)}}
+        self.ready = set(["foo"])
+
+    def touch(self, username):
+        pass
+
+
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    # nothing listens on the port anymore
+    sock.close()
+    return port
+
+def fetch_through_proxy(upstream, path):
+    io_loop = tornado.ioloop.IOLoop()
+    io_loop.make_current()
+    try:
+        app = tornado.web.Application(proxy_handlers(Tracker(upstream)))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(128)
+        sock.setblocking(0)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        url = "http://127.0.0.1:{0:d}{1}".format(sock.getsockname()[1], path)
+        client = AsyncHTTPClient(force_instance=True)
+        response = io_loop.run_sync(lambda: client.fetch(url,
+                raise_error=False), timeout=30)
+        client.close()
+        server.stop()
+        return response
+    finally:
+        tornado.ioloop.IOLoop.clear_current()
+        io_loop.close(all_fds=True)
+
+def test_closed_port():
+    response = fetch_through_proxy(closed_port(), "/user/foo/tree")
+    nt.assert_equal(response.code, 502)
+
+def test_unknown_user():
+    response = fetch_through_proxy(closed_port(), "/user/bar/tree")
+    nt.assert_equal(response.code, 404)
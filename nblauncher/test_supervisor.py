@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+=========================
+Test Notebook Supervision
+=========================
+
+:File:
+    test_supervisor.py
+"""
+
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+
+import nose.tools as nt
+
+from .supervisor import Registry, wait_until_ready
+
+
+def test_registry():
+    root = tempfile.mkdtemp()
+    try:
+        registry = Registry(root)
+        nt.assert_equal(registry.load(), dict())
+        registry.set("foo", {"pid": 10, "port": u"9000"})
+        registry.set("bar", {"pid": 11, "port": u"9001"})
+        # another process sees the entries
+        other = Registry(root)
+        nt.assert_equal(other.get("foo")["pid"], 10)
+        nt.assert_equal(sorted(other.load()), ["bar", "foo"])
+        nt.assert_equal(sorted(os.listdir(registry.root)),
+                ["bar.json", "foo.json"])
+        # an entry of a restarted server is kept
+        nt.assert_is_none(registry.pop("foo", pid=9))
+        nt.assert_equal(registry.pop("foo", pid=10)["pid"], 10)
+        nt.assert_is_none(registry.get("foo"))
+        nt.assert_is_none(registry.pop("foo"))
+        registry.set("baz", {"pid": 12, "port": u"9002"})
+        nt.assert_equal(sorted(registry.pop_all(["bar", "baz", "foo"])),
+                ["bar", "baz"])
+        nt.assert_equal(registry.load(), dict())
+    finally:
+        shutil.rmtree(root)
+
+def test_wait_until_ready():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(("127.0.0.1", 0))
+    ports = [listener.getsockname()[1], closed.getsockname()[1]]
+    # nothing listens on the second port anymore
+    closed.close()
+    try:
+        start = time.time()
+        ready = wait_until_ready(ports, 1.0, tls=False, interval=0.05)
+        nt.assert_equal(sorted(ready), ports[:1])
+        nt.assert_true(0.0 <= ready[ports[0]] < 1.0)
+        # the closed port is retried until the deadline
+        nt.assert_true(1.0 <= time.time() - start < 2.0)
+        # a listener that never completes a handshake is not ready
+        start = time.time()
+        nt.assert_equal(wait_until_ready(ports[:1], 0.5, interval=0.05),
+                dict())
+        nt.assert_true(time.time() - start < 1.5)
+    finally:
+        listener.close()
@@ -59,6 +59,26 @@ def test_user():
         usrt.delete_group(group)
         yield check_delete_group, group
 
+def test_users():
+    accounts = [("foo", "fooman"), ("bar", "barman")]
+    group = "labrats"
+    usrt.add_group(group)
+    yield check_add_group, group
+    rcs = usrt.add_users(accounts)
+    for ((username, plain_pw), rc) in zip(accounts, rcs):
+        yield nt.assert_equal, rc, 0
+        yield check_add_user, username, ()
+        yield check_add_password, username, plain_pw
+    usernames = [username for (username, plain_pw) in accounts]
+    usrt.append_all_to_group(group, usernames)
+    for username in usernames:
+        yield check_append_to_group, group, username
+    for username in usernames:
+        usrt.delete_user(username)
+        yield check_delete_user, username
+    usrt.delete_group(group)
+    yield check_delete_group, group
+
 
 def check_add_user(username, args):
     reload(pwd)
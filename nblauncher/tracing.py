@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+=============
+Timing Traces
+=============
+
+:File:
+    tracing.py
+"""
+
+
+__all__ = ["Tracer", "TRACER", "span"]
+
+
+import logging
+import math
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+LOGGER = logging.getLogger()
+
+
+def percentile(values, fraction):
+    """
+    The nearest-rank percentile of a sorted, non-empty list of values.
+    """
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Tracer(object):
+    """
+    Collects timing spans of the phases of a run, e.g., external commands and
+    copy passes, together with the user that they were performed for.
+
+    The user is set per thread such that the workers of a `UserExecutor` can
+    be told apart. Threads that work on behalf of another one, e.g., those of
+    the copy pool, take over its user with `inherit`.
+    """
+
+    def __init__(self, **kw_args):
+        super(Tracer, self).__init__(**kw_args)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Discards all spans and counters.
+        """
+        with self._lock:
+            self.started = time.time()
+            self.spans = list()
+            self.forks = 0
+            self.num_bytes = 0
+
+    @contextmanager
+    def user(self, username):
+        """
+        Attributes all spans of the current thread to a user.
+        """
+        previous = getattr(self._local, "user", None)
+        self._local.user = username
+        try:
+            yield
+        finally:
+            self._local.user = previous
+
+    def inherit(self):
+        """
+        A context manager that attributes the spans of another thread to the
+        user of the current thread.
+        """
+        return self.user(getattr(self._local, "user", None))
+
+    @contextmanager
+    def span(self, phase, forks=0, **details):
+        """
+        Times the enclosed block as one span of a phase.
+
+        Parameters
+        ----------
+        phase: `str`
+            Name of the phase, e.g., 'exec useradd' or 'copy'.
+        forks: `int` (optional)
+            The number of subprocesses that the block creates.
+        details:
+            Further information stored with the span. The yielded dictionary
+            can be updated within the block, a 'bytes' entry is added to the
+            total number of bytes copied.
+        """
+        record = dict(details)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            elapsed = time.time() - start
+            record.update(phase=phase, user=getattr(self._local, "user", None),
+                    start=start - self.started, duration=elapsed)
+            with self._lock:
+                self.spans.append(record)
+                self.forks += forks
+                self.num_bytes += record.get("bytes", 0)
+
+    def summary(self):
+        """
+        Aggregates the spans per phase and per user.
+
+        Returns
+        -------
+        A dictionary that can be serialised to JSON.
+        """
+        with self._lock:
+            spans = list(self.spans)
+            forks = self.forks
+            num_bytes = self.num_bytes
+        durations = dict()
+        users = dict()
+        for record in spans:
+            durations.setdefault(record["phase"], list()).append(
+                    record["duration"])
+            if record["user"] is not None:
+                phases = users.setdefault(record["user"], dict())
+                phases[record["phase"]] = phases.get(record["phase"], 0.0) +\
+                        record["duration"]
+        phases = dict()
+        for (phase, values) in durations.iteritems():
+            values.sort()
+            phases[phase] = {"count": len(values), "total": sum(values),
+                    "p50": percentile(values, 0.5),
+                    "p95": percentile(values, 0.95)}
+        return {"wall": time.time() - self.started, "forks": forks,
+                "bytes": num_bytes, "phases": phases, "users": users}
+
+    def trace(self, command):
+        """
+        The complete trace of a run, the spans and their summary.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        return {"command": command, "pid": os.getpid(),
+                "started": self.started, "summary": self.summary(),
+                "spans": spans}
+
+    def report(self, summary):
+        """
+        Logs a table of the time spent per phase.
+        """
+        phases = summary["phases"]
+        if phases:
+            width = max(len(phase) for phase in phases)
+            LOGGER.info(u"{0:<{1}} {2:>7} {3:>10} {4:>9} {5:>9}".format(u"phase",
+                    width, u"count", u"total [s]", u"p50 [s]", u"p95 [s]"))
+        for (phase, stats) in sorted(phases.iteritems(),
+                key=lambda item: item[1]["total"], reverse=True):
+            LOGGER.info(u"{0:<{1}} {2:>7d} {3:>10.3f} {4:>9.3f} {5:>9.3f}"\
+                    .format(phase, width, stats["count"], stats["total"],
+                    stats["p50"], stats["p95"]))
+        LOGGER.info(u"Finished in {0:.3f} s with {1:d} subprocess(es) and {2:d}"\
+                u" byte(s) copied.".format(summary["wall"], summary["forks"],
+                summary["bytes"]))
+
+
+# the tracer of this process
+TRACER = Tracer()
+
+span = TRACER.span
+
@@ -30,6 +30,8 @@ setup(
     author_email = "moritz (dot) beber (at) gmail (dot) com",
     url = "https://github.com/Midnighter/Notebooks-Launcher",
     packages = ["nblauncher"],
+    # os.scandir was added in Python 3.5
+    install_requires = ["scandir; python_version < '3.5'"],
     entry_points = {"console_scripts": [
             "nblauncher = nblauncher.notebooks:main_command",
             "ipython_dir = nblauncher.genericutils:ipython_dir_command"